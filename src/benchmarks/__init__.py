@@ -0,0 +1,7 @@
+# -*- coding: utf-8 -*-
+"""
+Microbenchmarks for the hot paths of MoCo4SRec.
+
+Run from the `src` folder, e.g. `python -m benchmarks.bench_momentum`.
+`python -m benchmarks` runs the component suite (suite.py) and compares it with baseline.json.
+"""
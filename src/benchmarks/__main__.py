@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+"""
+Run the component benchmarks of benchmarks/suite.py and compare them with a stored baseline.
+
+    python -m benchmarks                                  # run, compare with benchmarks/baseline.json
+    python -m benchmarks --only augment/ --output results.json
+    python -m benchmarks --num_users 50000 --item_size 100000 --no_compare
+    python -m benchmarks --update_baseline                # store this run as the baseline
+    python -m benchmarks --update_baseline --merge_baseline   # fold one more run into it
+
+Each benchmark runs --rounds rounds of calls after --warmup_seconds of untimed calls. It
+reports the median ms per call of its fastest round ("best_ms"), the median and mean over
+all calls, and the spread between its slowest and fastest round medians. Shared machines
+drift between rounds and between processes, so the fastest round is compared with the
+baseline's. A benchmark regresses when it is slower by more than --threshold plus the
+larger of the two spreads; the run then exits with status 1. Some benchmarks also differ
+by up to 2x between processes on shared machines, which one run cannot see: record the
+baseline with --merge_baseline over a few runs, so its spread covers that too. Baselines are only compared
+at the same scale and are specific to the machine they were recorded on: re-record one
+after changing hardware.
+
+On glibc the malloc mmap and trim thresholds are pinned at startup. glibc otherwise raises
+them the first time a large block is freed, and from then on MB-sized allocations stop
+paying page faults. A benchmark would then run up to 2x faster or slower depending on what
+ran before it in the same process (e.g. --only metrics/ vs the full suite).
+"""
+
+import argparse
+import ctypes
+import ctypes.util
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+
+import torch
+
+from benchmarks.common import synchronize
+from benchmarks.suite import DEFAULT_CONFIG, build_suite
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+M_TRIM_THRESHOLD, M_MMAP_THRESHOLD = -1, -3  # mallopt parameters of glibc
+
+
+def pin_malloc_thresholds(mmap_threshold=32 * 2 ** 20):
+    """
+    fix glibc's mmap and trim thresholds; False where mallopt is not available
+    """
+    try:
+        mallopt = ctypes.CDLL(ctypes.util.find_library('c')).mallopt
+    except (OSError, AttributeError, TypeError):
+        return False
+    return bool(mallopt(M_MMAP_THRESHOLD, mmap_threshold)) and bool(mallopt(M_TRIM_THRESHOLD, 2 * mmap_threshold))
+
+
+def time_calls(fn, device, repeats, warmup_seconds=0.5):
+    """
+    wall time of every call in milliseconds, after at least one and warmup_seconds of untimed calls
+    """
+    end = time.perf_counter() + warmup_seconds
+    fn()
+    while time.perf_counter() < end:
+        fn()
+    times = []
+    for _ in range(repeats):
+        synchronize(device)
+        start = time.perf_counter()
+        fn()
+        synchronize(device)
+        times.append((time.perf_counter() - start) * 1000.0)
+    return times
+
+
+def measure(fn, device, repeats, rounds, warmup_seconds):
+    """
+    best_ms (median of the fastest round), median_ms and mean_ms over all calls, and the
+    spread (slowest / fastest round median - 1)
+    """
+    round_times = [time_calls(fn, device, repeats, warmup_seconds if i == 0 else 0.0) for i in range(rounds)]
+    round_medians = [statistics.median(times) for times in round_times]
+    times = [t for round_time in round_times for t in round_time]
+    return {"best_ms": round(min(round_medians), 4), "median_ms": round(statistics.median(times), 4),
+            "mean_ms": round(statistics.fmean(times), 4),
+            "spread": round(max(round_medians) / min(round_medians) - 1.0, 4), "calls": len(times)}
+
+
+def environment(device, malloc_pinned):
+    return {"python": platform.python_version(), "torch": torch.__version__, "machine": platform.machine(),
+            "cpu_count": os.cpu_count(), "torch_threads": torch.get_num_threads(), "device": device.type,
+            "malloc_pinned": malloc_pinned}
+
+
+def compare(results, baseline, threshold):
+    """
+    {name: best / baseline best} and the names slower than 1 + threshold + the larger spread
+    """
+    ratios, regressions = {}, []
+    for name, result in results.items():
+        if name not in baseline["results"]:
+            continue
+        reference = baseline["results"][name]
+        ratios[name] = result["best_ms"] / reference["best_ms"]
+        if ratios[name] > 1.0 + threshold + max(result["spread"], reference["spread"]):
+            regressions.append(name)
+    return ratios, regressions
+
+
+def merge_results(results, baseline_results):
+    """
+    the fastest best_ms of both recordings, with a spread covering both runs and the gap between them
+    """
+    merged = {}
+    for name, result in results.items():
+        if name not in baseline_results:
+            merged[name] = result
+            continue
+        reference = baseline_results[name]
+        fastest, slowest = sorted([result["best_ms"], reference["best_ms"]])
+        merged[name] = dict(min([result, reference], key=lambda r: r["best_ms"]),
+                            spread=round(max(result["spread"], reference["spread"], slowest / fastest - 1.0), 4),
+                            recordings=reference.get("recordings", 1) + 1)
+    return merged
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    for key, value in DEFAULT_CONFIG.items():
+        parser.add_argument(f'--{key}', default=value, type=type(value))
+    parser.add_argument('--only', default='', type=str, help="run the benchmarks whose name contains this")
+    parser.add_argument('--repeat_scale', default=1.0, type=float, help="multiplies the number of timed calls")
+    parser.add_argument('--rounds', default=5, type=int, help="rounds of timed calls per benchmark")
+    parser.add_argument('--warmup_seconds', default=0.5, type=float, help="untimed calls before the first round")
+    parser.add_argument('--output', default='', type=str, help="write the results as JSON to this file")
+    parser.add_argument('--baseline', default=BASELINE_PATH, type=str)
+    parser.add_argument('--threshold', default=0.25, type=float,
+                        help="allowed slowdown of the best round over the baseline's on top of the measured "
+                             "spread, 0.25 = 25%%")
+    parser.add_argument('--no_compare', action='store_true')
+    parser.add_argument('--update_baseline', action='store_true', help="store the results as the baseline")
+    parser.add_argument('--merge_baseline', action='store_true',
+                        help="with --update_baseline, merge the results into the stored baseline of the same config")
+    parser.add_argument("--no_cuda", action="store_true")
+    cli = parser.parse_args()
+
+    malloc_pinned = pin_malloc_thresholds()
+    config = {key: getattr(cli, key) for key in DEFAULT_CONFIG}
+    device = torch.device("cuda" if torch.cuda.is_available() and not cli.no_cuda else "cpu")
+    print(f"building inputs: {config}")
+    results = {}
+    with build_suite(config, device, cli.only) as suite:
+        for name, (fn, repeats) in suite.items():
+            results[name] = measure(fn, device, max(1, round(repeats * cli.repeat_scale)), cli.rounds,
+                                    cli.warmup_seconds)
+            print(f"{name:<40} best {results[name]['best_ms']:10.3f} ms   "
+                  f"median {results[name]['median_ms']:10.3f} ms   spread {results[name]['spread']:6.1%}")
+
+    report = {"config": config, "environment": environment(device, malloc_pinned), "results": results}
+    regressions = []
+    if not cli.no_compare and not cli.update_baseline and os.path.exists(cli.baseline):
+        with open(cli.baseline) as f:
+            baseline = json.load(f)
+        if baseline["config"] != config:
+            print(f"{cli.baseline} was recorded at {baseline['config']}, not compared")
+        elif any("best_ms" not in result for result in baseline["results"].values()):
+            print(f"{cli.baseline} has no per-round statistics, re-record it with --update_baseline")
+        else:
+            ratios, regressions = compare(results, baseline, cli.threshold)
+            print(f"--------------------vs baseline (threshold +{cli.threshold:.0%})------------")
+            for name, ratio in ratios.items():
+                flag = "  REGRESSION" if name in regressions else ""
+                print(f"{name:<40} : {ratio:>8.3f}x{flag}")
+            report["baseline_ratios"] = {name: round(ratio, 4) for name, ratio in ratios.items()}
+            report["regressions"] = regressions
+
+    if cli.output:
+        with open(cli.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if cli.update_baseline:
+        if cli.only:
+            raise ValueError("--update_baseline needs the full suite, drop --only")
+        if cli.merge_baseline and os.path.exists(cli.baseline):
+            with open(cli.baseline) as f:
+                baseline = json.load(f)
+            if baseline["config"] != config:
+                raise ValueError(f"{cli.baseline} was recorded at {baseline['config']}, can not merge")
+            results = merge_results(results, baseline["results"])
+        with open(cli.baseline, 'w') as f:
+            json.dump({"config": config, "environment": report["environment"], "results": results}, f, indent=2)
+        print(f"baseline written to {cli.baseline}")
+    if regressions:
+        print(f"{len(regressions)} regression(s): {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""
+Exact full-sort top-k: one dense [batch item_size] score matrix vs item blocks.
+"""
+
+import argparse
+
+import numpy as np
+import scipy.sparse as sp
+import torch
+
+from retrieval import blocked_topk, train_matrix_histories
+from benchmarks.common import get_device, timeit, print_results
+
+
+def dense_topk(queries, item_embeddings, topk, train_matrix):
+    # Trainer.predict_full + Trainer.full_sort_topk
+    rating_pred = torch.matmul(queries, item_embeddings.transpose(0, 1))
+    rating_pred[:, 0] = float('-inf')
+    rating_pred[:, -1] = float('-inf')
+    rows = torch.from_numpy(np.repeat(np.arange(train_matrix.shape[0]), np.diff(train_matrix.indptr)))
+    cols = torch.from_numpy(train_matrix.indices).long()
+    rating_pred[rows.to(queries.device), cols.to(queries.device)] = float('-inf')
+    scores, items = torch.topk(rating_pred, topk, dim=-1)
+    return items, scores
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--item_size', default=1000000, type=int)
+    parser.add_argument('--hidden_size', default=64, type=int)
+    parser.add_argument('--batch_size', default=256, type=int)
+    parser.add_argument('--block_size', default=65536, type=int)
+    parser.add_argument('--topk', default=20, type=int)
+    parser.add_argument('--repeats', default=5, type=int)
+    parser.add_argument("--no_cuda", action="store_true")
+    cli = parser.parse_args()
+
+    cli.cuda_condition = torch.cuda.is_available() and not cli.no_cuda
+    device = get_device(cli)
+    item_embeddings = torch.randn(cli.item_size, cli.hidden_size, device=device)
+    queries = torch.randn(cli.batch_size, cli.hidden_size, device=device)
+    train_matrix = sp.random(cli.batch_size, cli.item_size, density=50 / cli.item_size, format='csr',
+                             random_state=np.random.RandomState(0))
+    history = train_matrix_histories(train_matrix, torch.arange(cli.batch_size), device, (0, cli.item_size - 1))
+
+    dense_items, dense_scores = dense_topk(queries, item_embeddings, cli.topk, train_matrix)
+    blocked_items, blocked_scores = blocked_topk(queries, item_embeddings, cli.topk, cli.block_size, history)
+    results = {
+        "identical items": float(torch.equal(dense_items, blocked_items)),
+        "identical scores": float(torch.equal(dense_scores, blocked_scores)),
+        "dense score matrix (MB)": cli.batch_size * cli.item_size * 4 / 2 ** 20,
+        "block score matrix (MB)": cli.batch_size * min(cli.block_size, cli.item_size) * 4 / 2 ** 20,
+        "dense (ms)": timeit(lambda: dense_topk(queries, item_embeddings, cli.topk, train_matrix),
+                             device, cli.repeats),
+        "blocked (ms)": timeit(lambda: blocked_topk(queries, item_embeddings, cli.topk, cli.block_size, history),
+                               device, cli.repeats),
+    }
+    print_results(f"exact top-{cli.topk}, {cli.item_size} items, batch {cli.batch_size}", results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+Encoder throughput in real (non-padding) tokens/sec per bundled dataset, with batches
+padded to max_seq_length vs length-bucketed batches trimmed by TrimPaddingCollator, and
+a parity check that trimming does not change the contrastive loss.
+"""
+
+import argparse
+import glob
+import os
+import time
+
+import torch
+
+from datasets import LengthBucketBatchSampler, TrimPaddingCollator
+from utils import get_user_seqs
+from benchmarks.common import make_args, make_trainer, get_device, synchronize, print_results
+
+
+def padded_inputs(user_seq, max_len):
+    # validation inputs: every item but the last two
+    sequences = [items[:-2][-max_len:] for items in user_seq]
+    return torch.tensor([[0] * (max_len - len(items)) + items for items in sequences], dtype=torch.long)
+
+
+def real_tokens_per_sec(model, batches, device):
+    num_tokens = sum(int((input_ids > 0).sum()) for input_ids in batches)
+    synchronize(device)
+    start = time.perf_counter()
+    with torch.no_grad():
+        for input_ids in batches:
+            model.transformer_encoder(input_ids.to(device))
+    synchronize(device)
+    return num_tokens / (time.perf_counter() - start)
+
+
+@torch.no_grad()
+def trimmed_cl_loss_difference(trainer, inputs, collator):
+    """
+    |CL loss of a padded pair - CL loss of the same pair trimmed by the collator|, dropout off
+    """
+    trainer.model.eval()
+    # the shortest sequences, so the pair is actually trimmed
+    shortest = inputs[(inputs > 0).sum(1).argsort()[:trainer.args.batch_size]]
+    pair = [shortest, shortest.roll(1, 0)]
+    trimmed_pair = collator._trim_pairs([pair])[0]
+    assert trimmed_pair[0].size(1) < inputs.size(1)
+    padded_loss = trainer._one_pair_contrastive_learning_sep(list(pair))
+    trimmed_loss = trainer._one_pair_contrastive_learning_sep(list(trimmed_pair))
+    return abs(float(padded_loss) - float(trimmed_loss))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_dir', default='../data/', type=str)
+    parser.add_argument('--batch_size', default=256, type=int)
+    parser.add_argument('--max_seq_length', default=50, type=int)
+    parser.add_argument('--trim_multiple', default=8, type=int)
+    parser.add_argument('--max_batches', default=20, type=int, help="batches timed per dataset and mode")
+    parser.add_argument("--no_cuda", action="store_true")
+    cli = parser.parse_args()
+
+    collator = TrimPaddingCollator(cli.trim_multiple)
+    for data_file in sorted(glob.glob(os.path.join(cli.data_dir, '*.txt'))):
+        user_seq, max_item, _, _ = get_user_seqs(data_file)
+        # the flags of a bucketed+trimmed run: padding outputs are zeroed on both sides of the check
+        args = make_args(item_size=max_item + 2, batch_size=cli.batch_size,
+                         max_seq_length=cli.max_seq_length, k=256, length_bucketing=True, trim_padding=True)
+        args.cuda_condition = torch.cuda.is_available() and not cli.no_cuda
+        device = get_device(args)
+        trainer = make_trainer(args)
+        model = trainer.model.eval()
+
+        inputs = padded_inputs(user_seq, cli.max_seq_length)
+        padded_batches = list(torch.split(inputs, cli.batch_size))
+        seq_lengths = (inputs > 0).sum(1).tolist()
+        sampler = LengthBucketBatchSampler(seq_lengths, cli.batch_size, shuffle=False)
+        trimmed_batches = []
+        for batch_indices in sampler:
+            batch = inputs[batch_indices]
+            trimmed_batches.append(batch[:, -collator._width(batch):].contiguous())
+
+        padded = real_tokens_per_sec(model, padded_batches[:cli.max_batches], device)
+        # time a spread of widths, not only the shortest buckets
+        step = max(1, len(trimmed_batches) // cli.max_batches)
+        trimmed = real_tokens_per_sec(model, trimmed_batches[::step][:cli.max_batches], device)
+        print_results(os.path.basename(data_file), {
+            "padding fraction": 1.0 - sum(seq_lengths) / inputs.numel(),
+            "padded tokens/sec": padded,
+            "bucketed+trimmed tokens/sec": trimmed,
+            "speedup": trimmed / padded,
+            "trimmed vs padded CL loss diff": trimmed_cl_loss_difference(trainer, inputs, collator),
+        })
+
+
+if __name__ == '__main__':
+    main()
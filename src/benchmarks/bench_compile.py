@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+"""
+Training steps/sec in eager mode and with --compile, on synthetic batches padded
+to max_seq_length, next to the one-off compile cost of the first step and the number
+of steps it takes the compiled trainer to make that cost back.
+"""
+
+import argparse
+import time
+
+import torch
+
+from benchmarks.common import make_args, make_trainer, synthetic_train_batches, synchronize, print_results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_size', default=256, type=int)
+    parser.add_argument('--max_seq_length', default=50, type=int)
+    parser.add_argument('--k', default=16000, type=int)
+    parser.add_argument('--steps', default=20, type=int)
+    parser.add_argument('--compile_cache_dir', default='output/compile_cache', type=str)
+    parser.add_argument("--no_cuda", action="store_true")
+    cli = parser.parse_args()
+
+    results = {}
+    for compile in [False, True]:
+        torch.manual_seed(0)
+        args = make_args(batch_size=cli.batch_size, max_seq_length=cli.max_seq_length, k=cli.k,
+                         compile=compile, compile_cache_dir=cli.compile_cache_dir)
+        args.cuda_condition = torch.cuda.is_available() and not cli.no_cuda
+        trainer = make_trainer(args)
+        batches = synthetic_train_batches(args, cli.steps)
+        mode = "compiled" if compile else "eager"
+        start = time.perf_counter()
+        trainer.iteration(0, batches[:1])  # compilation happens here
+        results[f"{mode} first step (s)"] = time.perf_counter() - start
+        synchronize(trainer.device)
+        start = time.perf_counter()
+        trainer.iteration(0, batches)
+        synchronize(trainer.device)
+        results[f"{mode} steps/sec"] = cli.steps / (time.perf_counter() - start)
+    compile_cost = results["compiled first step (s)"] - results["eager first step (s)"]
+    results["compile cost (s)"] = compile_cost
+    saved_per_step = 1.0 / results["eager steps/sec"] - 1.0 / results["compiled steps/sec"]
+    results["break-even steps"] = compile_cost / saved_per_step if saved_per_step > 0 else float('inf')
+    print_results("torch.compile", results)
+
+
+if __name__ == '__main__':
+    main()
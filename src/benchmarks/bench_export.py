@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+Time to first recommendation: full training checkpoint into SASRecModel vs the export.py
+artifact. Each variant runs in a fresh process so no state is shared between them.
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+
+import torch
+
+from models import SASRecModel
+from export import export_inference
+from benchmarks.common import make_args, print_results
+
+LOAD_CHECKPOINT = '''
+import time, torch
+from benchmarks.common import make_args
+from models import SASRecModel
+start = time.perf_counter()
+state_dict = torch.load({path!r}, map_location='cpu')
+args = make_args(item_size={item_size}, k={k}, cuda_condition=False)
+model = SASRecModel(args)
+model.load_state_dict(state_dict)
+model.eval()
+with torch.no_grad():
+    model.encode_sequences([[1, 2, 3]])
+print(time.perf_counter() - start)
+'''
+
+LOAD_EXPORT = '''
+import time, torch
+from export import load_inference_model
+start = time.perf_counter()
+model = load_inference_model({path!r})
+model.encode_sequences([[1, 2, 3]])
+print(time.perf_counter() - start)
+'''
+
+
+def run(code):
+    output = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True,
+                            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    return float(output.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--item_size', default=1000000, type=int)
+    parser.add_argument('--k', default=16000, type=int, help="MoCo queue size of the checkpoint")
+    cli = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    checkpoint = os.path.join(directory, 'model.pt')
+    export_dir = os.path.join(directory, 'export')
+    args = make_args(item_size=cli.item_size, k=cli.k, cuda_condition=False)
+    state_dict = SASRecModel(args).state_dict()
+    torch.save(state_dict, checkpoint)
+    export_inference(state_dict, export_dir, vars(args))
+    del state_dict
+
+    export_bytes = sum(os.path.getsize(os.path.join(export_dir, name)) for name in os.listdir(export_dir))
+    print_results(f"load to first recommendation, {cli.item_size} items, queue {cli.k}", {
+        "checkpoint (MB)": os.path.getsize(checkpoint) / 2 ** 20,
+        "export (MB)": export_bytes / 2 ** 20,
+        "checkpoint -> SASRecModel (s)": run(LOAD_CHECKPOINT.format(path=checkpoint, item_size=cli.item_size,
+                                                                    k=cli.k)),
+        "export -> inference model (s)": run(LOAD_EXPORT.format(path=export_dir)),
+    })
+
+
+if __name__ == '__main__':
+    main()
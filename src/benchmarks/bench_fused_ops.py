@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""
+Parity and speed of the native layer_norm/gelu kernels (--fused_ops) against the
+TF-style modules.LayerNorm and modules.gelu.
+"""
+
+import argparse
+
+import torch
+
+from modules import LayerNorm, gelu
+from models import SASRecModel
+from benchmarks.common import make_args, get_device, timeit, print_results
+
+
+def forward_backward(fn, x):
+    def run():
+        x.grad = None
+        fn(x).sum().backward()
+    return run
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_size', default=256, type=int)
+    parser.add_argument('--max_seq_length', default=50, type=int)
+    parser.add_argument("--hidden_size", type=int, default=64)
+    parser.add_argument('--repeats', default=50, type=int)
+    parser.add_argument("--no_cuda", action="store_true")
+    cli = parser.parse_args()
+
+    args = make_args(batch_size=cli.batch_size, max_seq_length=cli.max_seq_length,
+                     hidden_size=cli.hidden_size, k=256)
+    args.cuda_condition = torch.cuda.is_available() and not cli.no_cuda
+    device = get_device(args)
+    torch.manual_seed(0)
+    x = torch.randn(cli.batch_size, cli.max_seq_length, cli.hidden_size, device=device, requires_grad=True)
+
+    layer_norm = LayerNorm(cli.hidden_size).to(device)
+    fused_layer_norm = LayerNorm(cli.hidden_size, fused=True).to(device)
+    with torch.no_grad():
+        layer_norm.weight.normal_()
+        layer_norm.bias.normal_()
+    fused_layer_norm.load_state_dict(layer_norm.state_dict())
+
+    # encoder parity: a checkpoint of the compatible model loads into the fused one unchanged
+    args.fused_ops = False
+    model = SASRecModel(args).to(device).eval()
+    args.fused_ops = True
+    fused_model = SASRecModel(args).to(device).eval()
+    fused_model.load_state_dict(model.state_dict())
+    input_ids = torch.randint(0, args.item_size - 1, (cli.batch_size, cli.max_seq_length), device=device)
+    with torch.no_grad():
+        encoder_diff = (model.transformer_encoder(input_ids) - fused_model.transformer_encoder(input_ids)).abs().max()
+
+    results = {
+        "LayerNorm max abs diff": (layer_norm(x) - fused_layer_norm(x)).abs().max().item(),
+        "gelu max abs diff": (gelu(x) - torch.nn.functional.gelu(x)).abs().max().item(),
+        "encoder max abs diff": encoder_diff.item(),
+        "LayerNorm fwd+bwd (ms)": timeit(forward_backward(layer_norm, x), device, cli.repeats),
+        "fused LayerNorm fwd+bwd (ms)": timeit(forward_backward(fused_layer_norm, x), device, cli.repeats),
+        "gelu fwd+bwd (ms)": timeit(forward_backward(gelu, x), device, cli.repeats),
+        "fused gelu fwd+bwd (ms)": timeit(forward_backward(torch.nn.functional.gelu, x), device, cli.repeats),
+    }
+    model.train()
+    fused_model.train()
+    results["encoder fwd+bwd (ms)"] = timeit(
+        lambda: model.transformer_encoder(input_ids).sum().backward(), device, cli.repeats)
+    results["fused encoder fwd+bwd (ms)"] = timeit(
+        lambda: fused_model.transformer_encoder(input_ids).sum().backward(), device, cli.repeats)
+    print_results("fused ops", results)
+
+
+if __name__ == '__main__':
+    main()
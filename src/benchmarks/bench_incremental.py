@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""
+Per-event latency of scoring a user whose sequence grows by one item: encode_sequences over
+the whole window vs SASRecModel.append_items (cached keys and values, --position_anchor start),
+and a parity check of the incremental outputs against the full forward at every step.
+"""
+
+import argparse
+import random
+import time
+
+import torch
+
+from benchmarks.common import make_args, make_trainer, get_device, synchronize, print_results
+
+
+def mean(values):
+    return sum(values) / len(values) if values else float('nan')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--max_seq_length', default=50, type=int)
+    parser.add_argument('--hidden_size', default=64, type=int)
+    parser.add_argument('--num_hidden_layers', default=2, type=int)
+    parser.add_argument('--events', default=120, type=int, help="items appended one at a time")
+    parser.add_argument("--no_cuda", action="store_true")
+    cli = parser.parse_args()
+
+    torch.manual_seed(0)
+    random.seed(0)
+    args = make_args(max_seq_length=cli.max_seq_length, hidden_size=cli.hidden_size,
+                     num_hidden_layers=cli.num_hidden_layers, k=256, position_anchor='start')
+    args.cuda_condition = torch.cuda.is_available() and not cli.no_cuda
+    device = get_device(args)
+    model = make_trainer(args).model.eval()
+    items = [random.randint(1, args.item_size - 2) for _ in range(cli.events + 1)]
+
+    state = model.start_incremental(items[:1])
+    max_diff, full_ms, growing_ms, full_window_ms = 0.0, [], [], []
+    for end in range(2, len(items) + 1):
+        synchronize(device)
+        start = time.perf_counter()
+        state = model.append_items(state, items[end - 1:end])
+        synchronize(device)
+        # once the window is full, every append drops the oldest item and re-encodes it
+        (growing_ms if end <= args.max_seq_length else full_window_ms).append(1000 * (time.perf_counter() - start))
+        start = time.perf_counter()
+        full = model.encode_sequences([items[:end]])[0]
+        synchronize(device)
+        full_ms.append(1000 * (time.perf_counter() - start))
+        max_diff = max(max_diff, (state.output - full).abs().max().item())
+
+    print_results(f"incremental inference, {cli.events} events, max_seq_length {args.max_seq_length}", {
+        "max |incremental - full|": max_diff,
+        "full forward per event (ms)": mean(full_ms),
+        "append, window growing (ms)": mean(growing_ms),
+        "append, window full (ms)": mean(full_window_ms),
+    })
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+"""
+Inference forward computing every position vs only the final position in the last layer.
+"""
+
+import argparse
+
+import torch
+
+from models import SASRecModel
+from benchmarks.common import make_args, get_device, timeit, print_results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_size', default=256, type=int)
+    parser.add_argument('--max_seq_length', default=50, type=int)
+    parser.add_argument("--num_hidden_layers", type=int, default=2)
+    parser.add_argument('--repeats', default=20, type=int)
+    parser.add_argument("--no_cuda", action="store_true")
+    cli = parser.parse_args()
+
+    args = make_args(batch_size=cli.batch_size, max_seq_length=cli.max_seq_length,
+                     num_hidden_layers=cli.num_hidden_layers, k=256)
+    args.cuda_condition = torch.cuda.is_available() and not cli.no_cuda
+    device = get_device(args)
+    model = SASRecModel(args).to(device).eval()
+    input_ids = torch.randint(1, args.item_size - 1, (cli.batch_size, cli.max_seq_length), device=device)
+
+    with torch.no_grad():
+        full = model.transformer_encoder(input_ids)[:, -1, :]
+        last = model.transformer_encoder(input_ids, last_position_only=True)[:, -1, :]
+        results = {
+            "max abs diff": (full - last).abs().max().item(),
+            "all positions (ms)": timeit(lambda: model.transformer_encoder(input_ids), device, cli.repeats),
+            "last position only (ms)": timeit(
+                lambda: model.transformer_encoder(input_ids, last_position_only=True), device, cli.repeats),
+        }
+    print_results("inference forward", results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""
+Per-step overhead of the key encoder momentum update.
+
+The old path rebuilt every key parameter (`param_k.data * m + param_q.data * (1 - m)`)
+and ran once per MoCo pair; the new path updates in place with foreach kernels once
+per optimizer step.
+"""
+
+import argparse
+
+import torch
+
+from models import SASRecModel
+from utils import nCr
+from benchmarks.common import make_args, get_device, timeit, print_results
+
+
+@torch.no_grad()
+def legacy_momentum_update(model):
+    for param_q, param_k in zip(model.item_encoder.parameters(), model.encoder_k.parameters()):
+        param_k.data = param_k.data * model.m + param_q.data * (1. - model.m)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--hidden_size", type=int, default=64)
+    parser.add_argument("--num_hidden_layers", type=int, default=2)
+    parser.add_argument('--n_views', default=2, type=int)
+    parser.add_argument('--repeats', default=200, type=int)
+    parser.add_argument("--no_cuda", action="store_true")
+    cli = parser.parse_args()
+
+    args = make_args(hidden_size=cli.hidden_size, num_hidden_layers=cli.num_hidden_layers,
+                     n_views=cli.n_views, k=256)
+    args.cuda_condition = torch.cuda.is_available() and not cli.no_cuda
+    device = get_device(args)
+    model = SASRecModel(args).to(device)
+    updates_per_step = nCr(args.n_views, 2)
+
+    def legacy_step():
+        for _ in range(updates_per_step):
+            legacy_momentum_update(model)
+
+    # parity: one fused update equals one legacy update
+    reference = [p.clone() for p in model.encoder_k.parameters()]
+    legacy_momentum_update(model)
+    expected = [p.clone() for p in model.encoder_k.parameters()]
+    for param_k, ref in zip(model.encoder_k.parameters(), reference):
+        param_k.copy_(ref)
+    model._momentum_update_key_encoder()
+    max_diff = max((p - e).abs().max().item() for p, e in zip(model.encoder_k.parameters(), expected))
+
+    results = {
+        "legacy per step (ms)": timeit(legacy_step, device, repeats=cli.repeats),
+        "foreach per step (ms)": timeit(model._momentum_update_key_encoder, device, repeats=cli.repeats),
+        "max abs diff vs legacy": max_diff,
+    }
+    print_results(f"momentum update, {updates_per_step} pair(s) per step", results)
+
+
+if __name__ == '__main__':
+    main()
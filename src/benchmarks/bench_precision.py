@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+fp32 vs bf16 autocast: training throughput on synthetic batches, and optionally
+HR/NDCG on a bundled dataset by running main.py once per precision.
+
+On one CPU core, bf16 runs about 1.5x the synthetic train steps/sec of fp32 and trains Beauty
+17% faster (10 epochs, 2641 s vs 3200 s), but reaches HR@20 0.0105 / NDCG@20 0.0039 against
+0.0142 / 0.0053 for fp32: about a quarter lower, from a single seed and far from convergence.
+"""
+
+import argparse
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+import torch
+
+from benchmarks.common import make_args, make_trainer, synthetic_train_batches, synchronize, print_results
+
+
+def train_steps_per_sec(precision, cli):
+    torch.manual_seed(0)
+    args = make_args(batch_size=cli.batch_size, max_seq_length=cli.max_seq_length,
+                     k=cli.k, precision=precision)
+    args.cuda_condition = torch.cuda.is_available() and not cli.no_cuda
+    trainer = make_trainer(args)
+    batches = synthetic_train_batches(args, cli.steps)
+    trainer.iteration(0, batches[:1])  # warm up
+    synchronize(trainer.device)
+    start = time.perf_counter()
+    trainer.iteration(0, batches)
+    synchronize(trainer.device)
+    return cli.steps / (time.perf_counter() - start)
+
+
+def test_scores(precision, cli):
+    with tempfile.TemporaryDirectory() as output_dir:
+        command = [sys.executable, 'main.py', '--data_dir', cli.data_dir, '--data_name', cli.data_name,
+                   '--epochs', str(cli.epochs), '--k', str(cli.k),
+                   '--precision', precision, '--output_dir', output_dir, '--tune_dir', '']
+        if cli.no_cuda:
+            command.append('--no_cuda')
+        start = time.perf_counter()
+        output = subprocess.run(command, capture_output=True, text=True, check=True).stdout
+        elapsed = time.perf_counter() - start
+    result_info = output.strip().splitlines()[-1]
+    scores = {key: float(value) for key, value in re.findall(r"'((?:HIT|NDCG)@\d+)': '([\d.]+)'", result_info)}
+    scores['wall time (s)'] = elapsed
+    return scores
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_size', default=256, type=int)
+    parser.add_argument('--max_seq_length', default=50, type=int)
+    parser.add_argument('--k', default=16000, type=int)
+    parser.add_argument('--steps', default=20, type=int)
+    parser.add_argument('--data_dir', default='../data/', type=str)
+    parser.add_argument('--data_name', default=None, type=str,
+                        help="also train and test on this bundled dataset, e.g. Beauty")
+    parser.add_argument('--epochs', default=5, type=int)
+    parser.add_argument("--no_cuda", action="store_true")
+    cli = parser.parse_args()
+
+    for precision in ['fp32', 'bf16']:
+        results = {"train steps/sec": train_steps_per_sec(precision, cli)}
+        if cli.data_name is not None:
+            results.update(test_scores(precision, cli))
+        print_results(f"precision {precision}", results)
+
+
+if __name__ == '__main__':
+    main()
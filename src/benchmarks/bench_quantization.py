@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""
+fp32 vs int8 encoder and int8/fp16 item table for CPU full-catalog inference: HIT/NDCG on
+the test split of --data_file (the last item of every user), top-20 overlap with fp32,
+time per batch and bytes of the encoder and the item table.
+"""
+
+import argparse
+import random
+
+import numpy as np
+import torch
+
+from quantization import quantize_encoder, QuantizedItemTable, model_nbytes
+from retrieval import blocked_topk, padded_histories, recall_vs_exact
+from serve import load_model
+from models import SASRecModel
+from utils import FullSortMetricAccumulator
+from benchmarks.common import make_args, timeit, print_results
+
+
+def load_users(cli, item_size, max_seq_length):
+    if cli.data_file:
+        sequences = []
+        with open(cli.data_file) as f:
+            for line in f:
+                sequences.append([int(item) for item in line.strip().split(' ')[1:]])
+    else:
+        sequences = [[random.randint(1, item_size - 2) for _ in range(random.randint(4, max_seq_length))]
+                     for _ in range(cli.num_users)]
+    return sequences[:cli.num_users]
+
+
+@torch.no_grad()
+def recommend(model, table, inputs, topk, block_size):
+    seq_out = model.encode_sequences(inputs).float()
+    item_size = table.size(0)
+    history = padded_histories([items + [0, item_size - 1] for items in inputs], seq_out.device, item_size)
+    return blocked_topk(seq_out, table, topk, block_size, history)[0]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--checkpoint', default='', type=str, help="trainer checkpoint, default: random weights")
+    parser.add_argument('--data_file', default='', type=str, help="users to evaluate, default: synthetic")
+    parser.add_argument('--num_attention_heads', default=None, type=int,
+                        help="for checkpoints saved without their training args")
+    parser.add_argument('--num_users', default=4096, type=int)
+    parser.add_argument('--batch_size', default=256, type=int)
+    parser.add_argument('--block_size', default=65536, type=int)
+    parser.add_argument('--repeats', default=5, type=int)
+    cli = parser.parse_args()
+
+    device = torch.device("cpu")
+    if cli.checkpoint:
+        model = load_model(cli.checkpoint, device, num_attention_heads=cli.num_attention_heads)
+    else:
+        model = SASRecModel(make_args(k=256, cuda_condition=False)).eval()
+    sequences = load_users(cli, model.args.item_size, model.args.max_seq_length)
+    inputs = [items[:-1] for items in sequences]
+    answers = np.array([[items[-1]] for items in sequences])
+    int8_model = quantize_encoder(model)
+    fp32_table = model.item_embeddings.weight.detach()
+    variants = {
+        "fp32": (model, fp32_table),
+        "int8 encoder": (int8_model, fp32_table),
+        "int8 encoder + fp16 table": (int8_model, QuantizedItemTable(fp32_table, 'fp16')),
+        "int8 encoder + int8 table": (int8_model, QuantizedItemTable(fp32_table, 'int8')),
+    }
+
+    reference = None
+    for name, (variant_model, table) in variants.items():
+        accumulator = FullSortMetricAccumulator([10, 20])
+        predictions = []
+        for start in range(0, len(inputs), cli.batch_size):
+            batch_predictions = recommend(variant_model, table, inputs[start:start + cli.batch_size], 20,
+                                          cli.block_size)
+            accumulator.update(answers[start:start + cli.batch_size], batch_predictions.numpy())
+            predictions.append(batch_predictions)
+        predictions = torch.cat(predictions)
+        reference = predictions if reference is None else reference
+        metrics = accumulator.result()
+        table_nbytes = table.nbytes if isinstance(table, QuantizedItemTable) else table.numel() * 4
+        print_results(name, {
+            "HIT@10": metrics["HIT@10"], "NDCG@10": metrics["NDCG@10"],
+            "HIT@20": metrics["HIT@20"], "NDCG@20": metrics["NDCG@20"],
+            "top-20 overlap with fp32": recall_vs_exact(predictions, reference),
+            "ms per batch": timeit(lambda: recommend(variant_model, table, inputs[:cli.batch_size], 20,
+                                                     cli.block_size), device, cli.repeats, warmup=1),
+            "encoder (MB)": model_nbytes(variant_model.item_encoder) / 2 ** 20,
+            "item table (MB)": table_nbytes / 2 ** 20,
+        })
+
+
+if __name__ == '__main__':
+    main()
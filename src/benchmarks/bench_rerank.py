@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+"""
+Re-ranking ragged candidate lists: Trainer.rerank vs scoring the whole catalog and
+gathering the candidates' scores.
+"""
+
+import argparse
+import random
+
+import torch
+
+from benchmarks.common import make_args, make_trainer, get_device, timeit, print_results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--item_size', default=1000000, type=int)
+    parser.add_argument('--batch_size', default=256, type=int)
+    parser.add_argument('--min_candidates', default=100, type=int)
+    parser.add_argument('--max_candidates', default=500, type=int)
+    parser.add_argument('--repeats', default=5, type=int)
+    parser.add_argument("--no_cuda", action="store_true")
+    cli = parser.parse_args()
+
+    args = make_args(item_size=cli.item_size, batch_size=cli.batch_size, k=256)
+    args.cuda_condition = torch.cuda.is_available() and not cli.no_cuda
+    device = get_device(args)
+    trainer = make_trainer(args)
+    model = trainer.model.eval()
+    sequences = [[random.randint(1, args.item_size - 2) for _ in range(random.randint(3, args.max_seq_length))]
+                 for _ in range(cli.batch_size)]
+    candidates = [random.sample(range(1, args.item_size - 1), random.randint(cli.min_candidates, cli.max_candidates))
+                  for _ in range(cli.batch_size)]
+
+    def full_catalog():
+        seq_out = model.encode_sequences(sequences)
+        rating_pred = trainer.predict_full(seq_out)
+        return [rating_pred[row, items] for row, items in enumerate(candidates)]
+
+    with torch.no_grad():
+        reference = full_catalog()
+    ranked = trainer.rerank(sequences, candidates)
+    max_diff = 0.0
+    for (items, scores), row_scores, row_candidates in zip(ranked, reference, candidates):
+        expected = dict(zip(row_candidates, row_scores.tolist()))
+        max_diff = max(max_diff, max(abs(expected[item] - score) for item, score in zip(items.tolist(), scores)))
+    with torch.no_grad():
+        results = {
+            "max abs score diff": max_diff,
+            "full catalog + gather (ms)": timeit(full_catalog, device, cli.repeats),
+            "rerank (ms)": timeit(lambda: trainer.rerank(sequences, candidates), device, cli.repeats),
+        }
+    print_results(f"re-rank {cli.min_candidates}-{cli.max_candidates} candidates, {cli.item_size} items", results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""
+IVF retrieval vs the trainer's exact full-sort path (predict_full + full_sort_topk, which masks
+the train matrix history, the padding id and the mask id): recall@k of the trainer's IVF index
+against it and time per batch, over nprobe. With --checkpoint and --data_file the queries are
+the first test users, otherwise a synthetic clustered table with queries near random items.
+"""
+
+import argparse
+
+import numpy as np
+import torch
+from scipy.sparse import csr_matrix
+
+from export import inference_config, load_training_args
+from models import SASRecModel
+from retrieval import recall_vs_exact, train_matrix_histories
+from trainers import MoCo4SRecTrainer
+from utils import get_user_seqs
+from benchmarks.common import make_args, make_trainer, timeit, print_results
+
+
+def synthetic_embeddings(item_size, hidden_size, num_clusters, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    centers = torch.randn(num_clusters, hidden_size, generator=generator)
+    members = torch.randint(num_clusters, (item_size,), generator=generator)
+    return centers[members] + 0.5 * torch.randn(item_size, hidden_size, generator=generator)
+
+
+def checkpoint_trainer(cli):
+    state_dict = torch.load(cli.checkpoint, map_location='cpu')
+    config = inference_config(state_dict, load_training_args(cli.checkpoint), cli.checkpoint,
+                              num_attention_heads=cli.num_attention_heads, hidden_act=cli.hidden_act)
+    # as main.py --do_eval builds it: the query encoder only
+    args = make_args(no_cuda=cli.no_cuda, **config)
+    trainer = MoCo4SRecTrainer(SASRecModel(args, inference_only=True), None, None, None, args)
+    trainer.load(cli.checkpoint)
+    return trainer
+
+
+def test_queries(trainer, cli):
+    # test setting: each user's last item is the answer, the items before it the history
+    user_seq, _, _, test_rating_matrix = get_user_seqs(cli.data_file)
+    trainer.args.train_matrix = test_rating_matrix
+    user_ids = torch.arange(min(cli.batch_size, len(user_seq)))
+    queries = trainer.model.encode_sequences([user_seq[user][:-1] for user in user_ids.tolist()])
+    return user_ids.to(trainer.device), queries.float()
+
+
+def synthetic_queries(trainer, cli):
+    item_embeddings = trainer.model.item_embeddings.weight
+    item_embeddings.copy_(synthetic_embeddings(cli.item_size, cli.hidden_size, 1000))
+    # queries near random items, histories of a few random items
+    anchors = torch.randint(1, cli.item_size - 1, (cli.batch_size,))
+    history = np.sort(np.random.default_rng(0).integers(1, cli.item_size - 1, (cli.batch_size, 10)), axis=1)
+    indptr = np.arange(0, history.size + 1, history.shape[1])
+    trainer.args.train_matrix = csr_matrix((np.ones(history.size), history.ravel(), indptr),
+                                           shape=(cli.batch_size, cli.item_size))
+    queries = item_embeddings[anchors.to(trainer.device)] + 0.1 * torch.randn(cli.batch_size, cli.hidden_size,
+                                                                              device=trainer.device)
+    return torch.arange(cli.batch_size, device=trainer.device), queries
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--checkpoint', default='', type=str, help="trainer checkpoint to evaluate")
+    parser.add_argument('--data_file', default='', type=str, help="the checkpoint's dataset, e.g. ../data/Beauty.txt")
+    parser.add_argument('--num_attention_heads', default=None, type=int,
+                        help="only for checkpoints saved without their training args")
+    parser.add_argument('--hidden_act', default=None, type=str)
+    parser.add_argument('--item_size', default=200000, type=int)
+    parser.add_argument('--hidden_size', default=64, type=int)
+    parser.add_argument('--batch_size', default=256, type=int)
+    parser.add_argument('--topk', default=20, type=int)
+    parser.add_argument('--num_lists', default=0, type=int, help="default: 4 * sqrt(item_size)")
+    parser.add_argument('--nprobe', default='1,4,16,64', type=str)
+    parser.add_argument('--repeats', default=10, type=int)
+    parser.add_argument("--no_cuda", action="store_true")
+    cli = parser.parse_args()
+    if cli.checkpoint and not cli.data_file:
+        parser.error("--checkpoint needs --data_file for the users' histories")
+
+    with torch.no_grad():
+        if cli.checkpoint:
+            trainer = checkpoint_trainer(cli)
+        else:
+            trainer = make_trainer(make_args(item_size=cli.item_size, hidden_size=cli.hidden_size, k=256,
+                                             no_cuda=cli.no_cuda))
+        trainer.model.eval()
+        device = trainer.device
+        user_ids, queries = test_queries(trainer, cli) if cli.checkpoint else synthetic_queries(trainer, cli)
+        item_size = trainer.args.item_size
+
+        def exact():
+            return trainer.full_sort_topk(trainer.predict_full(queries), user_ids, cli.topk)
+
+        exact_items = torch.from_numpy(exact())
+        results = {"exact (ms)": timeit(exact, device, cli.repeats)}
+        trainer.args.ann_lists = cli.num_lists or int(4 * item_size ** 0.5)
+        index = trainer.build_ann_index()
+        history = train_matrix_histories(trainer.args.train_matrix, user_ids, device)
+        results["num_lists"] = index.num_lists
+        results["longest list"] = index.lists.size(1)
+        for nprobe in [int(n) for n in cli.nprobe.split(',')]:
+            items, _ = index.search(queries, cli.topk, history, nprobe=nprobe)
+            results[f"nprobe {nprobe} recall@{cli.topk}"] = recall_vs_exact(items.cpu(), exact_items)
+            results[f"nprobe {nprobe} (ms)"] = timeit(lambda: index.search(queries, cli.topk, history, nprobe=nprobe),
+                                                      device, cli.repeats)
+    print_results(f"IVF retrieval, {item_size} items, batch {len(user_ids)}", results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+End-to-end serving on localhost: concurrent clients against serve.py with and without
+micro-batching. The model is randomly initialised and round-trips through a checkpoint.
+"""
+
+import argparse
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+from models import SASRecModel
+from export import save_training_args
+from serve import load_model, Recommender, MicroBatcher, build_server
+from benchmarks.common import make_args, get_device, print_results
+
+
+def post(url, body):
+    request = urllib.request.Request(url, data=json.dumps(body).encode(),
+                                     headers={'Content-Type': 'application/json'})
+    with urllib.request.urlopen(request) as response:
+        return json.loads(response.read())
+
+
+def run_load(url, args, num_clients, num_requests):
+    sequences = [[random.randint(1, args.item_size - 2) for _ in range(random.randint(3, args.max_seq_length))]
+                 for _ in range(num_requests)]
+
+    def one(sequence):
+        start = time.perf_counter()
+        reply = post(url + '/recommend', {"sequence": sequence, "topn": 10, "exclude_seen": True})
+        assert len(reply["items"]) == 10 and not set(reply["items"]) & set(sequence)
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(num_clients) as pool:
+        latencies = np.array(list(pool.map(one, sequences))) * 1000.0
+    elapsed = time.perf_counter() - start
+    return latencies, num_requests / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--item_size', default=12103, type=int)
+    parser.add_argument('--clients', default=32, type=int)
+    parser.add_argument('--requests', default=2000, type=int)
+    parser.add_argument('--max_batch', default=64, type=int)
+    parser.add_argument('--max_wait_ms', default=2.0, type=float)
+    parser.add_argument("--no_cuda", action="store_true")
+    cli = parser.parse_args()
+
+    args = make_args(item_size=cli.item_size, k=256)
+    args.cuda_condition = torch.cuda.is_available() and not cli.no_cuda
+    device = get_device(args)
+    checkpoint = os.path.join(tempfile.mkdtemp(), 'serving.pt')
+    torch.save(SASRecModel(args).state_dict(), checkpoint)
+    save_training_args(args, checkpoint)
+    model = load_model(checkpoint, device)
+
+    for name, max_batch, max_wait_ms in [("no batching", 1, 0.0),
+                                         ("micro-batching", cli.max_batch, cli.max_wait_ms)]:
+        batcher = MicroBatcher(Recommender(model), max_batch, max_wait_ms)
+        server = build_server(batcher, port=0)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f"http://127.0.0.1:{server.server_address[1]}"
+        run_load(url, args, cli.clients, 100)  # warm up
+        post(url + '/stats/reset', {})
+        latencies, throughput = run_load(url, args, cli.clients, cli.requests)
+        with urllib.request.urlopen(url + '/stats') as response:
+            server_stats = json.loads(response.read())
+        server.shutdown()
+        server.server_close()
+        print_results(f"{name} ({cli.clients} clients)", {
+            "client p50 latency (ms)": float(np.percentile(latencies, 50)),
+            "client p99 latency (ms)": float(np.percentile(latencies, 99)),
+            "client throughput (req/s)": throughput,
+            "server p50 latency (ms)": server_stats["latency_p50_ms"],
+            "server p99 latency (ms)": server_stats["latency_p99_ms"],
+            "server mean batch size": server_stats["mean_batch_size"],
+        })
+
+
+if __name__ == '__main__':
+    main()
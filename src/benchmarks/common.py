@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import os
+import random
+import time
+
+import torch
+
+from utils import nCr
+
+
+def make_args(**kwargs):
+    """
+    args namespace with the defaults of main.py, sized for synthetic inputs
+    """
+    args = argparse.Namespace(
+        item_size=12103,
+        hidden_size=64,
+        num_hidden_layers=2,
+        num_attention_heads=2,
+        hidden_act='gelu',
+        attention_probs_dropout_prob=0.5,
+        hidden_dropout_prob=0.5,
+        initializer_range=0.02,
+        max_seq_length=50,
+        position_anchor='end',
+        fused_ops=False,
+        gradient_checkpointing=False,
+        batch_size=256,
+        n_views=2,
+        dim=3200,
+        k=16000,
+        m=0.999,
+        t=0.07,
+        phi=0.4,
+        projection_head=False,
+        cutoff=False,
+        direction='random',
+        cutoff_rate=0.1,
+        token_shuffle=False,
+        guassian_noise=False,
+        temperature=1.0,
+        rec_weight=1.0,
+        cl_weight=0.1,
+        moco_weight=0.1,
+        lr=0.001,
+        adam_beta1=0.9,
+        adam_beta2=0.999,
+        weight_decay=0.0,
+        epochs=300,
+        sch_min=0.0005,
+        augmentation_warm_up_epoches=160,
+        log_freq=1,
+        precision='fp32',
+        compile=False,
+        compile_cache_dir='',
+        num_workers=0,
+        length_bucketing=False,
+        trim_padding=False,
+        trim_multiple=8,
+        eval_block_size=0,
+        ann_lists=0,
+        ann_nprobe=8,
+        phase_timing=False,
+        profile=False,
+        online_similarity_model=None,
+        log_file=os.devnull,
+        no_cuda=False,
+        cuda_condition=torch.cuda.is_available(),
+    )
+    for key, value in kwargs.items():
+        setattr(args, key, value)
+    args.dim = args.max_seq_length * args.hidden_size
+    return args
+
+
+def make_trainer(args):
+    from models import SASRecModel
+    from trainers import MoCo4SRecTrainer
+    model = SASRecModel(args=args)
+    return MoCo4SRecTrainer(model, None, None, None, args)
+
+
+def synthetic_sequence(args, min_len=3):
+    seq_len = random.randint(min_len, args.max_seq_length)
+    items = [random.randint(1, args.item_size - 2) for _ in range(seq_len)]
+    return [0] * (args.max_seq_length - seq_len) + items
+
+
+def synthetic_train_batches(args, num_batches):
+    """
+    batches shaped like the train DataLoader output: (rec_batch, cl_batches, moco_batches)
+    """
+    batches = []
+    for _ in range(num_batches):
+        input_ids = torch.tensor([synthetic_sequence(args) for _ in range(args.batch_size)], dtype=torch.long)
+        target_pos = torch.where(input_ids > 0, torch.randint_like(input_ids, 1, args.item_size - 1), 0)
+        target_neg = torch.where(input_ids > 0, torch.randint_like(input_ids, 1, args.item_size - 1), 0)
+        user_ids = torch.arange(args.batch_size, dtype=torch.long)
+        answers = torch.zeros(args.batch_size, 1, dtype=torch.long)
+        rec_batch = (user_ids, input_ids, target_pos, target_neg, answers)
+
+        def views():
+            return [torch.tensor([synthetic_sequence(args) for _ in range(args.batch_size)], dtype=torch.long)
+                    for _ in range(2)]
+        total_pairs = nCr(args.n_views, 2)
+        cl_batches = [views() for _ in range(total_pairs)]
+        moco_batches = [views() for _ in range(total_pairs)]
+        batches.append((rec_batch, cl_batches, moco_batches))
+    return batches
+
+
+def get_device(args):
+    return torch.device("cuda" if args.cuda_condition else "cpu")
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def timeit(fn, device, repeats=50, warmup=5):
+    """
+    run fn repeatedly and return the mean wall time per call in milliseconds
+    """
+    for _ in range(warmup):
+        fn()
+    synchronize(device)
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    synchronize(device)
+    return (time.perf_counter() - start) * 1000.0 / repeats
+
+
+def print_results(title, results):
+    print(f"--------------------{title}------------")
+    for name, value in results.items():
+        print(f"{name:<40} : {value:>12.4f}")
@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+"""
+Component benchmarks on synthetic data, run by `python -m benchmarks`.
+
+`with build_suite(config, device, only) as suite` gives {name: (fn, repeats)} for the
+benchmarks whose name contains `only`: every fn is one unit of work as it happens in training or evaluation
+(one batch of augmentations, one encoder step, one evaluation batch, ...). Inputs are built
+before timing starts, and only those the selected benchmarks use. Data files are
+written to a temporary directory that is removed when the with block exits.
+"""
+
+import os
+import pickle
+import random
+import tempfile
+from contextlib import contextmanager
+from functools import cached_property
+
+import numpy as np
+import torch
+
+from data_augmentation import Crop, Mask, Reorder, Insert, Substitute, Random
+from models import SASRecModel, OfflineItemSimilarity, OnlineItemSimilarity
+from modules import NCELoss
+from utils import get_user_seqs, neg_sample, get_metric, FullSortMetricAccumulator
+from benchmarks.common import make_args, make_trainer
+
+DEFAULT_CONFIG = {
+    "num_users": 5000,
+    "item_size": 12103,
+    "max_seq_length": 50,
+    "hidden_size": 64,
+    "batch_size": 256,
+    "k": 4096,
+    "similar_items": 20,
+    "seed": 0,
+}
+
+
+def synthetic_users(config):
+    rng = random.Random(config["seed"])
+    return [[rng.randint(1, config["item_size"] - 2) for _ in range(rng.randint(5, 2 * config["max_seq_length"]))]
+            for _ in range(config["num_users"])]
+
+
+def write_data_file(users, directory):
+    path = os.path.join(directory, 'Synthetic.txt')
+    with open(path, 'w') as f:
+        for user, items in enumerate(users, 1):
+            f.write(f"{user} {' '.join(str(item) for item in items)}\n")
+    return path
+
+
+def write_similarity_dict(config, directory):
+    """
+    ItemCF-style {item: {similar item: score}} pickle with string ids, like the generated ones
+    """
+    rng = random.Random(config["seed"])
+    item_size = config["item_size"]
+    similarity = {str(item): {str(rng.randint(1, item_size - 2)): rng.random()
+                              for _ in range(config["similar_items"])}
+                  for item in range(1, item_size - 1)}
+    path = os.path.join(directory, 'Synthetic_ItemCF_IUF_similarity.pkl')
+    with open(path, 'wb') as f:
+        pickle.dump(similarity, f)
+    return path
+
+
+def augmentation_batch(operator, sequences):
+    def run():
+        for sequence in sequences:
+            operator(sequence)
+    return run
+
+
+class SuiteInputs:
+    """
+    inputs shared between benchmarks, each built on first use and seeded on its own, so
+    it is the same whichever benchmarks are selected
+    """
+
+    def __init__(self, config, device, directory):
+        self.config = config
+        self.device = device
+        self.directory = directory
+
+    def seed(self):
+        torch.manual_seed(self.config["seed"])
+        random.seed(self.config["seed"])
+
+    @cached_property
+    def users(self):
+        return synthetic_users(self.config)
+
+    @cached_property
+    def data_file(self):
+        return write_data_file(self.users, self.directory)
+
+    @cached_property
+    def args(self):
+        return make_args(
+            item_size=self.config["item_size"],
+            max_seq_length=self.config["max_seq_length"],
+            hidden_size=self.config["hidden_size"],
+            batch_size=self.config["batch_size"],
+            k=self.config["k"],
+            cuda_condition=self.device.type == 'cuda',
+        )
+
+    @cached_property
+    def offline(self):
+        offline = OfflineItemSimilarity(data_file=self.data_file,
+                                        similarity_path=write_similarity_dict(self.config, self.directory),
+                                        model_name='ItemCF_IUF', dataset_name='Synthetic')
+        offline.load()
+        offline.max_score  # score range is computed on first use
+        return offline
+
+    @cached_property
+    def sequences(self):
+        # one training batch of sequences
+        max_len = self.config["max_seq_length"]
+        return [items[-max_len:-2] for items in self.users[:self.config["batch_size"]]]
+
+    @cached_property
+    def model(self):
+        self.seed()
+        return SASRecModel(self.args).to(self.device)
+
+    @cached_property
+    def input_ids(self):
+        max_len = self.config["max_seq_length"]
+        return torch.tensor([[0] * (max_len - len(sequence[-max_len:])) + sequence[-max_len:]
+                             for sequence in (items[:-2] for items in self.users[:self.config["batch_size"]])],
+                            dtype=torch.long, device=self.device)
+
+    @cached_property
+    def trainer(self):
+        self.seed()
+        return make_trainer(self.args)
+
+
+# augmentation operators, built from SuiteInputs
+AUGMENTATIONS = {
+    "crop": lambda inputs: Crop(tao=0.2),
+    "mask": lambda inputs: Mask(gamma=0.7),
+    "reorder": lambda inputs: Reorder(beta=0.2),
+    "insert": lambda inputs: Insert(inputs.offline, insert_rate=0.4, max_insert_num_per_pos=1),
+    "substitute": lambda inputs: Substitute(inputs.offline, substitute_rate=0.1),
+    "random": lambda inputs: Random(tao=0.2, gamma=0.7, beta=0.2, item_similarity_model=inputs.offline,
+                                    insert_rate=0.4, max_insert_num_per_pos=1, substitute_rate=0.1,
+                                    augment_threshold=4, augment_type_for_short='SIM'),
+}
+
+
+def bench_get_user_seqs(inputs):
+    data_file = inputs.data_file
+    return lambda: get_user_seqs(data_file)
+
+
+def bench_augmentation(name):
+    def build(inputs):
+        return augmentation_batch(AUGMENTATIONS[name](inputs), inputs.sequences)
+    return build
+
+
+def bench_offline_most_similar(inputs):
+    # one lookup per item of a batch
+    offline, items = inputs.offline, [sequence[-1] for sequence in inputs.sequences]
+    return lambda: [offline.most_similar(item, top_k=1, with_score=True) for item in items]
+
+
+def bench_online_most_similar(inputs):
+    online = OnlineItemSimilarity(item_size=inputs.config["item_size"])
+    online.update_embedding_matrix(inputs.model.item_embeddings)
+    items = [sequence[-1] for sequence in inputs.sequences]
+    return lambda: [online.most_similar(item, top_k=1, with_score=True) for item in items]
+
+
+def bench_neg_sample(inputs):
+    item_size = inputs.config["item_size"]
+    item_sets = [set(items) for items in inputs.users[:inputs.config["batch_size"]]]
+    return lambda: [neg_sample(item_set, item_size) for item_set in item_sets]
+
+
+def bench_encoder_step(inputs):
+    model, input_ids = inputs.model, inputs.input_ids
+    model.train()
+
+    def encoder_step():
+        model.zero_grad(set_to_none=True)
+        model.transformer_encoder(input_ids).sum().backward()
+    return encoder_step
+
+
+def bench_moco_step(inputs):
+    model = inputs.model
+    moco_ids = torch.cat([inputs.input_ids, inputs.input_ids.roll(1, 0)])
+    moco_criterion = torch.nn.CrossEntropyLoss()
+    model.train()
+
+    def moco_step():
+        model.zero_grad(set_to_none=True)
+        logits, labels = model.moco_trans_encoder(moco_ids)
+        moco_criterion(logits, labels).backward()
+    return moco_step
+
+
+def bench_nce_loss(inputs):
+    inputs.seed()
+    nce = NCELoss(1.0, inputs.device)
+    views = [torch.randn(inputs.config["batch_size"], inputs.args.dim, device=inputs.device, requires_grad=True)
+             for _ in range(2)]
+    return lambda: nce(*views).backward()
+
+
+def bench_full_sort_batch(inputs):
+    trainer, input_ids = inputs.trainer, inputs.input_ids
+    trainer.model.eval()
+    _, _, valid_rating_matrix, _ = get_user_seqs(inputs.data_file)
+    trainer.args.train_matrix = valid_rating_matrix
+    user_ids = torch.arange(inputs.config["batch_size"], device=inputs.device)
+
+    @torch.no_grad()
+    def full_sort_batch():
+        seq_out = trainer.model.transformer_encoder(input_ids, last_position_only=True)[:, -1, :]
+        return trainer.full_sort_topk(trainer.predict_full(seq_out), user_ids, 20)
+    return full_sort_batch
+
+
+def metric_inputs(config):
+    # answers and top-20 predictions of every user, a tenth of them hits
+    rng = np.random.default_rng(config["seed"])
+    answers = rng.integers(1, config["item_size"] - 1, size=(config["num_users"], 1))
+    predictions = rng.integers(1, config["item_size"] - 1, size=(config["num_users"], 20))
+    predictions[::10, 3] = answers[::10, 0]
+    ranks = rng.integers(0, 100, size=config["num_users"])
+    return answers, predictions, ranks
+
+
+def bench_full_sort_metrics(inputs):
+    answers, predictions, _ = metric_inputs(inputs.config)
+
+    def full_sort_metrics():
+        accumulator = FullSortMetricAccumulator([5, 10, 15, 20])
+        accumulator.update(answers, predictions)
+        return accumulator.result()
+    return full_sort_metrics
+
+
+def bench_sampled_metrics(inputs):
+    _, _, ranks = metric_inputs(inputs.config)
+    return lambda: get_metric(ranks, 10)
+
+
+# {name: (builder of the timed fn from SuiteInputs, repeats)}
+BENCHMARKS = {
+    "data/get_user_seqs": (bench_get_user_seqs, 3),
+    **{f"augment/{name}": (bench_augmentation(name), 10) for name in AUGMENTATIONS},
+    "similarity/offline_most_similar": (bench_offline_most_similar, 10),
+    "similarity/online_most_similar": (bench_online_most_similar, 5),
+    "data/neg_sample": (bench_neg_sample, 10),
+    "model/transformer_encoder_fwd_bwd": (bench_encoder_step, 10),
+    "model/moco_trans_encoder_fwd_bwd": (bench_moco_step, 10),
+    "model/nce_loss_fwd_bwd": (bench_nce_loss, 20),
+    "eval/full_sort_batch": (bench_full_sort_batch, 10),
+    "metrics/full_sort": (bench_full_sort_metrics, 10),
+    "metrics/sampled": (bench_sampled_metrics, 10),
+}
+
+
+@contextmanager
+def build_suite(config, device, only=''):
+    with tempfile.TemporaryDirectory() as directory:
+        inputs = SuiteInputs(config, device, directory)
+        suite = {}
+        for name, (build, repeats) in BENCHMARKS.items():
+            if only in name:
+                # augmentations draw from the python RNG: start every benchmark from the same state
+                inputs.seed()
+                suite[name] = (build(inputs), repeats)
+        yield suite
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""
+Offline top-N recommendations for every user of an interaction file.
+
+    python bulk_inference.py --checkpoint output/MoCo4SRec-Beauty.pt --data_file ../data/Beauty.txt \
+        --output_dir recs/ --num_shards 4 --topn 50
+
+Users (lines of the file) are sharded round-robin over --num_shards worker processes.
+Each worker streams its users in batches, encodes the whole sequence (last max_seq_length
+items) with the last-position forward, ranks every item except the user's own ones, and
+appends the results to its shard file:
+
+    bin: fixed-size int32 records [user_id, item_1 ... item_topn], missing items are 0
+    tsv: user_id<TAB>item_1,item_2,...
+
+Every --progress_every batches a worker flushes its output and atomically rewrites
+shard_<k>.progress with the number of users done and the output size. A rerun with the
+same arguments truncates each shard to its last progress point and continues from there.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import time
+
+import numpy as np
+import torch
+
+from quantization import quantize_encoder, QuantizedItemTable
+from retrieval import blocked_topk, padded_histories
+from serve import load_model
+from utils import available_cores
+
+
+def shard_path(args, shard, suffix):
+    return os.path.join(args.output_dir, f"shard_{shard:04d}.{suffix}")
+
+
+def read_progress(args, shard):
+    try:
+        with open(shard_path(args, shard, 'progress')) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {"users": 0, "bytes": 0, "done": False}
+
+
+def write_progress(args, shard, progress):
+    path = shard_path(args, shard, 'progress')
+    with open(path + '.tmp', 'w') as f:
+        json.dump(progress, f)
+    os.replace(path + '.tmp', path)
+
+
+def shard_users(data_file, shard, num_shards, skip):
+    """
+    (user id, item ids) of every num_shards-th line starting at line `shard`, after the first `skip` of them
+    """
+    with open(data_file) as f:
+        position = 0
+        for line_number, line in enumerate(f):
+            if line_number % num_shards != shard:
+                continue
+            position += 1
+            if position <= skip:
+                continue
+            user, items = line.strip().split(' ', 1)
+            yield user, [int(item) for item in items.split(' ')]
+
+
+def batches(users, batch_size):
+    batch = []
+    for user in users:
+        batch.append(user)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def format_batch(args, user_ids, items):
+    if args.format == 'bin':
+        records = np.concatenate([np.array(user_ids, dtype=np.int32)[:, None], items.astype(np.int32)], 1)
+        return records.tobytes()
+    lines = [f"{user}\t{','.join(str(item) for item in row if item > 0)}\n" for user, row in zip(user_ids, items)]
+    return ''.join(lines).encode()
+
+
+@torch.no_grad()
+def run_shard(args, shard):
+    progress = read_progress(args, shard)
+    if progress["done"]:
+        return progress
+    torch.set_num_threads(args.threads_per_worker)
+    device = torch.device("cuda" if args.cuda_condition else "cpu")
+    model = load_model(args.checkpoint, device, args.fused_ops, num_attention_heads=args.num_attention_heads,
+                       hidden_act=args.hidden_act)
+    item_size = model.args.item_size
+    item_table = model.item_embeddings.weight
+    if args.item_table != 'fp32':
+        item_table = QuantizedItemTable(item_table, args.item_table)
+    if args.quantize:
+        model = quantize_encoder(model)
+
+    output_path = shard_path(args, shard, args.format)
+    with open(output_path, 'ab') as output:
+        # drop anything written after the last progress point
+        output.truncate(progress["bytes"])
+        output.seek(progress["bytes"])
+        start = time.time()
+        users = shard_users(args.data_file, shard, args.num_shards, progress["users"])
+        for batch_number, batch in enumerate(batches(users, args.batch_size), 1):
+            user_ids = [user for user, _ in batch]
+            sequences = [[item for item in items if 0 < item < item_size - 1] for _, items in batch]
+            seq_out = model.encode_sequences(sequences).float()
+            # never recommend the user's own items, the padding id or the mask id
+            exclude = sequences if args.exclude_seen else [[] for _ in batch]
+            history = padded_histories([items + [0, item_size - 1] for items in exclude], device, item_size)
+            items, scores = blocked_topk(seq_out, item_table, args.topn, args.block_size, history)
+            items[scores == float('-inf')] = 0
+            output.write(format_batch(args, user_ids, items.cpu().numpy()))
+            progress["users"] += len(batch)
+            if batch_number % args.progress_every == 0:
+                output.flush()
+                os.fsync(output.fileno())
+                progress["bytes"] = output.tell()
+                write_progress(args, shard, progress)
+                print(f"shard {shard}: {progress['users']} users, {progress['users'] / (time.time() - start):.1f} users/s")
+        output.flush()
+        os.fsync(output.fileno())
+        progress["bytes"] = output.tell()
+    progress["done"] = True
+    write_progress(args, shard, progress)
+    return progress
+
+
+def _run_shard(job):
+    return run_shard(*job)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--checkpoint', required=True, type=str,
+                        help="state dict saved by the trainer, or a directory written by export.py")
+    parser.add_argument('--data_file', required=True, type=str, help="user item item ... per line, oldest first")
+    parser.add_argument('--output_dir', default='recommendations/', type=str)
+    parser.add_argument('--num_shards', default=4, type=int, help="output shards, one worker process each")
+    parser.add_argument('--num_workers', default=0, type=int, help="parallel worker processes, 0: num_shards")
+    parser.add_argument('--topn', default=50, type=int)
+    parser.add_argument('--format', default='bin', type=str, choices=['bin', 'tsv'])
+    parser.add_argument('--include_seen', dest='exclude_seen', action='store_false',
+                        help="also recommend items already in the user's sequence")
+    parser.add_argument('--batch_size', default=256, type=int)
+    parser.add_argument('--block_size', default=65536, type=int, help="items scored at a time")
+    parser.add_argument('--progress_every', default=20, type=int, help="batches between progress checkpoints")
+    # only needed for checkpoints saved without <checkpoint>.args.json, must match it otherwise
+    parser.add_argument('--num_attention_heads', default=None, type=int)
+    parser.add_argument('--hidden_act', default=None, type=str)
+    parser.add_argument('--fused_ops', action='store_true')
+    parser.add_argument('--quantize', action='store_true', help="dynamic int8 Linear layers in the encoder (CPU)")
+    parser.add_argument('--item_table', default='fp32', type=str, choices=['fp32', 'fp16', 'int8'],
+                        help="precision of the item table, int8 uses per-row scales")
+    parser.add_argument("--no_cuda", action="store_true")
+    args = parser.parse_args()
+
+    # dynamic int8 Linear kernels only run on the CPU: the model, item table and histories stay there
+    args.cuda_condition = torch.cuda.is_available() and not args.no_cuda and not args.quantize
+    num_workers = args.num_workers or args.num_shards
+    args.threads_per_worker = max(1, available_cores() // num_workers)
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    manifest = {"topn": args.topn, "format": args.format, "num_shards": args.num_shards,
+                "exclude_seen": args.exclude_seen, "data_file": args.data_file, "checkpoint": args.checkpoint}
+    manifest_path = os.path.join(args.output_dir, 'manifest.json')
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            previous = json.load(f)
+        if previous != manifest:
+            raise ValueError(f"{args.output_dir} holds a run with different arguments: {previous}")
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f)
+
+    start = time.time()
+    jobs = [(args, shard) for shard in range(args.num_shards)]
+    if num_workers == 1:
+        results = [_run_shard(job) for job in jobs]
+    else:
+        with multiprocessing.get_context('spawn').Pool(num_workers) as pool:
+            results = pool.map(_run_shard, jobs)
+    num_users = sum(progress["users"] for progress in results)
+    print(f"{num_users} users in {time.time() - start:.1f}s, output in {args.output_dir}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,11 @@
 import random
 import torch
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, Sampler, DataLoader, RandomSampler, SequentialSampler
+from torch.utils.data.dataloader import default_collate
 
 from data_augmentation import Crop, Mask, Reorder, Substitute, Insert, Random, CombinatorialEnumerate
-from utils import neg_sample, nCr
+from utils import neg_sample, nCr, dataloader_worker_init
+from profiling import profile_range
 import copy
 
 
@@ -15,6 +17,15 @@ class RecWithContrastiveLearningDataset(Dataset):
         self.test_neg_items = test_neg_items
         self.data_type = data_type
         self.max_len = args.max_seq_length
+        # number of augmentations for each sequences, current support two
+        self.n_views = self.args.n_views
+        self.base_transform = None
+        if self.data_type == 'train':
+            # only the train set is augmented
+            self._build_augmentations(similarity_model_type)
+
+    def _build_augmentations(self, similarity_model_type):
+        args = self.args
         # currently apply one transform, will extend to multiples
         # it takes one sequence of items as input, and apply augmentation operation to get another sequence
         if similarity_model_type == 'offline':
@@ -51,8 +62,6 @@ class RecWithContrastiveLearningDataset(Dataset):
             raise ValueError(f"augmentation type: '{self.args.base_augment_type}' is invalided")
         print(f"Creating Contrastive Learning Dataset using '{self.args.base_augment_type}' data augmentation")
         self.base_transform = self.augmentations[self.args.base_augment_type]
-        # number of augmentations for each sequences, current support two
-        self.n_views = self.args.n_views
 
     def _one_pair_data_augmentation(self, input_ids):
         '''
@@ -60,7 +69,8 @@ class RecWithContrastiveLearningDataset(Dataset):
         '''
         augmented_seqs = []
         for i in range(2):
-            augmented_input_ids = self.base_transform(input_ids)
+            with profile_range('augmentation'):
+                augmented_input_ids = self.base_transform(input_ids)
             pad_len = self.max_len - len(augmented_input_ids)
             augmented_input_ids = [0] * pad_len + augmented_input_ids
 
@@ -96,7 +106,7 @@ class RecWithContrastiveLearningDataset(Dataset):
         assert len(target_neg) == self.max_len
 
         if self.test_neg_items is not None:
-            test_samples = self.test_neg_items[index]
+            test_samples = self.test_neg_items[user_id]
 
             cur_rec_tensors = (
                 torch.tensor(user_id, dtype=torch.long),  # user_id for testing
@@ -182,6 +192,96 @@ class RecWithContrastiveLearningDataset(Dataset):
         """
         return len(self.user_seq)
 
+    def seq_lengths(self):
+        """
+        unpadded length of each input sequence, used for length bucketing
+        """
+        num_held_out = {'train': 3, 'valid': 2, 'test': 1}[self.data_type]
+        return [min(max(len(items) - num_held_out, 0), self.max_len) for items in self.user_seq]
+
+
+class LengthBucketBatchSampler(Sampler):
+    """
+    Batches of users with similar sequence lengths, so trimmed batches carry little padding.
+    Indices are shuffled, cut into chunks of `bucket_batches` batches, and each chunk is
+    sorted by length before being split into batches; the batch order is shuffled again.
+    """
+
+    def __init__(self, seq_lengths, batch_size, shuffle=True, bucket_batches=50):
+        self.seq_lengths = seq_lengths
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.bucket_size = batch_size * bucket_batches
+
+    def __iter__(self):
+        indices = list(range(len(self.seq_lengths)))
+        if self.shuffle:
+            random.shuffle(indices)
+            buckets = [indices[i:i + self.bucket_size] for i in range(0, len(indices), self.bucket_size)]
+        else:
+            buckets = [indices]
+        batches = []
+        for bucket in buckets:
+            bucket.sort(key=lambda index: self.seq_lengths[index])
+            batches += [bucket[i:i + self.batch_size] for i in range(0, len(bucket), self.batch_size)]
+        if self.shuffle:
+            random.shuffle(batches)
+        return iter(batches)
+
+    def __len__(self):
+        return (len(self.seq_lengths) + self.batch_size - 1) // self.batch_size
+
+
+class TrimPaddingCollator(object):
+    """
+    Collate a batch, then drop the leading columns that are padding for every sequence in it.
+    The kept width is rounded up to a multiple of `multiple` to bound the number of shapes.
+    Augmented pairs are trimmed to a common width since they are encoded together.
+    """
+
+    def __init__(self, multiple=1):
+        self.multiple = multiple
+
+    def _width(self, *sequences):
+        is_item = torch.stack([(sequence > 0).any(0) for sequence in sequences]).any(0)
+        max_len = is_item.size(0)
+        width = max_len - int(is_item.int().argmax()) if is_item.any() else 1
+        return min(max_len, -(-width // self.multiple) * self.multiple)
+
+    def _trim_rec_batch(self, rec_batch):
+        # input_ids, target_pos and target_neg share the same left padding
+        width = self._width(rec_batch[1])
+        return [tensor[:, -width:].contiguous() if i in (1, 2, 3) else tensor
+                for i, tensor in enumerate(rec_batch)]
+
+    def _trim_pairs(self, pairs):
+        trimmed_pairs = []
+        for pair in pairs:
+            width = self._width(*pair)
+            trimmed_pairs.append([view[:, -width:].contiguous() for view in pair])
+        return trimmed_pairs
+
+    def __call__(self, batch):
+        batch = default_collate(batch)
+        if isinstance(batch[0], torch.Tensor):
+            return self._trim_rec_batch(batch)
+        rec_batch, cl_batches, moco_batches = batch
+        return self._trim_rec_batch(rec_batch), self._trim_pairs(cl_batches), self._trim_pairs(moco_batches)
+
+
+def build_dataloader(args, dataset, shuffle):
+    """
+    DataLoader following the batching options: length bucketing and per-batch padding trimming
+    """
+    collate_fn = TrimPaddingCollator(args.trim_multiple) if args.trim_padding else None
+    if args.length_bucketing:
+        batch_sampler = LengthBucketBatchSampler(dataset.seq_lengths(), args.batch_size, shuffle=shuffle)
+        return DataLoader(dataset, batch_sampler=batch_sampler, collate_fn=collate_fn,
+                          num_workers=args.num_workers, worker_init_fn=dataloader_worker_init)
+    sampler = RandomSampler(dataset) if shuffle else SequentialSampler(dataset)
+    return DataLoader(dataset, sampler=sampler, batch_size=args.batch_size, collate_fn=collate_fn,
+                      num_workers=args.num_workers, worker_init_fn=dataloader_worker_init)
+
 
 class SASRecDataset(Dataset):
 
@@ -214,7 +314,7 @@ class SASRecDataset(Dataset):
         assert len(target_neg) == self.max_len
 
         if self.test_neg_items is not None:
-            test_samples = self.test_neg_items[index]
+            test_samples = self.test_neg_items[user_id]
 
             cur_rec_tensors = (
                 torch.tensor(user_id, dtype=torch.long),  # user_id for testing
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""
+Inference artifact: only the query path of a trained SASRecModel (item and position
+embeddings, the input LayerNorm and item_encoder), one .npy file per tensor plus a
+manifest.json with the config. The key encoder, the MoCo queue and the projection head
+of the training checkpoint are left out.
+
+    python export.py --checkpoint output/MoCo4SRec-Beauty.pt --output_dir export/MoCo4SRec-Beauty
+
+The number of attention heads, the activation and the position anchor cannot be read from
+the weights: they come from <checkpoint>.args.json, the training args main.py saves next
+to the checkpoint. Checkpoints saved without it need them on the command line.
+
+load_inference_model memory-maps the .npy files and builds the model without allocating
+or initialising any weights, so startup cost does not grow with the item table.
+"""
+
+import argparse
+import json
+import os
+import re
+
+import numpy as np
+import torch
+
+from models import SASRecModel
+
+INFERENCE_PREFIXES = ('item_embeddings.', 'position_embeddings.', 'LayerNorm.', 'item_encoder.')
+# read from the tensor shapes, and checked against the saved training args
+SIZE_ARGS = ('item_size', 'hidden_size', 'max_seq_length', 'num_hidden_layers')
+# not recoverable from the weights: taken from the training args saved next to the checkpoint
+ARCHITECTURE_ARGS = ('num_attention_heads', 'hidden_act', 'position_anchor')
+
+
+def training_args_path(checkpoint_path):
+    return checkpoint_path + '.args.json'
+
+
+def save_training_args(args, checkpoint_path):
+    """
+    the JSON-serialisable training args next to the checkpoint, for the inference loaders
+    """
+    values = {name: value for name, value in vars(args).items()
+              if isinstance(value, (str, int, float, bool, type(None)))}
+    with open(training_args_path(checkpoint_path), 'w') as f:
+        json.dump(values, f, indent=2, sort_keys=True)
+
+
+def load_training_args(checkpoint_path):
+    """
+    the training args saved with a checkpoint, None for checkpoints saved without them
+    """
+    path = training_args_path(checkpoint_path)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def check_given_args(config, given, source):
+    """
+    ValueError if a value given for a model setting (None: not given) differs from the model's
+    """
+    for name, value in given.items():
+        if value is not None and name in config and config[name] != value:
+            raise ValueError(f"{source} was trained with {name} {config[name]!r}, not {value!r}")
+
+
+def inference_config(state_dict, training_args=None, source='checkpoint', **given):
+    """
+    model config: sizes from the checkpoint's tensor shapes, the number of heads, activation and
+    position anchor from its saved training args. values given (e.g. --num_attention_heads,
+    None: not given) must match them; a checkpoint saved without training args needs the
+    heads and activation given, and is end-anchored unless told otherwise
+    """
+    item_size, hidden_size = state_dict['item_embeddings.weight'].shape
+    layer_ids = {int(match.group(1)) for match in
+                 (re.match(r'item_encoder\.layer\.(\d+)\.', key) for key in state_dict) if match}
+    config = {"item_size": int(item_size), "hidden_size": int(hidden_size),
+              "max_seq_length": int(state_dict['position_embeddings.weight'].shape[0]),
+              "num_hidden_layers": len(layer_ids)}
+    if training_args is not None:
+        for name in SIZE_ARGS:
+            if name in training_args and training_args[name] != config[name]:
+                raise ValueError(f"the training args of {source} have {name} {training_args[name]}, "
+                                 f"its weights {config[name]}: they belong to another checkpoint")
+        config.update({name: training_args[name] for name in ARCHITECTURE_ARGS if name in training_args})
+        check_given_args(config, given, source)
+    for name in ARCHITECTURE_ARGS:
+        if name not in config:
+            config[name] = given.get(name)
+    if config["position_anchor"] is None:
+        config["position_anchor"] = 'end'  # saved before the option existed
+    missing = [name for name in ARCHITECTURE_ARGS if config[name] is None]
+    if missing:
+        raise ValueError(f"{source} was saved without its training args, pass "
+                         + " and ".join(f"--{name}" for name in missing))
+    return config
+
+
+def inference_args(config, fused_ops=False):
+    # manifests written before position_anchor existed are end-anchored
+    config = dict({"position_anchor": 'end'}, **config)
+    return argparse.Namespace(
+        attention_probs_dropout_prob=0.0, hidden_dropout_prob=0.0, initializer_range=0.02,
+        fused_ops=fused_ops, gradient_checkpointing=False, **config)
+
+
+def build_inference_model(config, state_dict, device, fused_ops=False):
+    """
+    SASRecModel(inference_only=True) whose parameters are the given tensors: the modules are
+    created on the meta device and the tensors assigned, not copied
+    """
+    with torch.device('meta'):
+        model = SASRecModel(inference_args(config, fused_ops), inference_only=True)
+    state_dict = {name: tensor for name, tensor in state_dict.items() if name.startswith(INFERENCE_PREFIXES)}
+    model.load_state_dict(state_dict, assign=True)
+    model.requires_grad_(False)
+    return model.to(device).eval()
+
+
+def export_inference(state_dict, output_dir, training_args=None, **given):
+    config = inference_config(state_dict, training_args, **given)
+    os.makedirs(output_dir, exist_ok=True)
+    tensors = {}
+    for name, tensor in state_dict.items():
+        if not name.startswith(INFERENCE_PREFIXES):
+            continue
+        file_name = name + '.npy'
+        array = tensor.detach().cpu().numpy()
+        np.save(os.path.join(output_dir, file_name), array)
+        tensors[name] = {"file": file_name, "shape": list(array.shape), "dtype": str(array.dtype)}
+    manifest = {"config": config, "tensors": tensors}
+    with open(os.path.join(output_dir, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def load_inference_model(export_dir, device='cpu', fused_ops=False, mmap=True, **given):
+    with open(os.path.join(export_dir, 'manifest.json')) as f:
+        manifest = json.load(f)
+    check_given_args(vars(inference_args(manifest["config"])), given, export_dir)
+    # copy-on-write maps: pages are read on first use and the files are never modified
+    state_dict = {name: torch.from_numpy(np.load(os.path.join(export_dir, entry["file"]),
+                                                 mmap_mode='c' if mmap else None))
+                  for name, entry in manifest["tensors"].items()}
+    return build_inference_model(manifest["config"], state_dict, torch.device(device), fused_ops)
+
+
+def load_checkpoint_for_inference(checkpoint_path, device='cpu', fused_ops=False, **given):
+    state_dict = torch.load(checkpoint_path, map_location='cpu', mmap=True)
+    config = inference_config(state_dict, load_training_args(checkpoint_path), checkpoint_path, **given)
+    return build_inference_model(config, state_dict, torch.device(device), fused_ops)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--checkpoint', required=True, type=str, help="state dict saved by the trainer")
+    parser.add_argument('--output_dir', required=True, type=str)
+    # only needed for checkpoints saved without <checkpoint>.args.json, must match it otherwise
+    parser.add_argument('--num_attention_heads', default=None, type=int)
+    parser.add_argument('--hidden_act', default=None, type=str)
+    parser.add_argument('--position_anchor', default=None, type=str, choices=['end', 'start'])
+    args = parser.parse_args()
+
+    state_dict = torch.load(args.checkpoint, map_location='cpu')
+    manifest = export_inference(state_dict, args.output_dir, load_training_args(args.checkpoint),
+                                num_attention_heads=args.num_attention_heads, hidden_act=args.hidden_act,
+                                position_anchor=args.position_anchor)
+    nbytes = sum(os.path.getsize(os.path.join(args.output_dir, entry["file"])) for entry in manifest["tensors"].values())
+    print(f"exported {len(manifest['tensors'])} tensors ({nbytes / 2 ** 20:.1f} MB of "
+          f"{os.path.getsize(args.checkpoint) / 2 ** 20:.1f} MB) to {args.output_dir}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,18 +1,23 @@
 # -*- coding: utf-8 -*-
 
+import time
+import_start = time.perf_counter()
+
 import os
 import numpy as np
 import random
 import torch
 import argparse
 
-from torch.utils.data import DataLoader, RandomSampler, SequentialSampler
-
-from datasets import RecWithContrastiveLearningDataset
+from datasets import RecWithContrastiveLearningDataset, build_dataloader
 
 from trainers import MoCo4SRecTrainer
+from export import ARCHITECTURE_ARGS, check_given_args, load_training_args, save_training_args
 from models import SASRecModel, OfflineItemSimilarity, OnlineItemSimilarity
-from utils import EarlyStopping, get_user_seqs, get_item2attribute_json, check_path, set_seed
+from memory import estimate_components, measure_components, show_memory_report, mb, rss_bytes, peak_rss_bytes, \
+    reset_peak_rss
+from utils import EarlyStopping, get_user_seqs, get_item2attribute_json, check_path, set_seed, \
+    configure_cpu_threads, get_sample_negatives
 
 import itertools
 
@@ -23,7 +28,21 @@ def show_args_info(args):
         print(f"{arg:<30} : {getattr(args, arg):>35}")
 
 
+def show_startup_times(startup_times):
+    print(f"--------------------Startup Time (s):------------")
+    for phase, seconds in startup_times.items():
+        print(f"{phase:<30} : {seconds:>35.3f}")
+
+
 def main():
+    startup_times = {'imports': time.perf_counter() - import_start}
+    runtime_rss = rss_bytes()
+    phase_start = time.perf_counter()
+
+    def end_phase(phase):
+        nonlocal phase_start
+        startup_times[phase] = time.perf_counter() - phase_start
+        phase_start = time.perf_counter()
 
     parser = argparse.ArgumentParser()
     # system args
@@ -34,6 +53,18 @@ def main():
     parser.add_argument('--do_eval', action='store_true')
     parser.add_argument('--model_idx', default=0, type=int, help="model idenfier 10, 20, 30...")
     parser.add_argument("--gpu_id", type=str, default="0", help="gpu_id")
+    parser.add_argument('--sample_eval', action='store_true',
+                        help="rank the answer among sampled negatives instead of the full item set")
+    parser.add_argument('--num_test_negatives', default=99, type=int, help="negatives per user for --sample_eval")
+    parser.add_argument('--eval_block_size', default=0, type=int,
+                        help="exact full-sort evaluation over blocks of this many items, 0: one dense score matrix")
+    parser.add_argument('--ann_lists', default=0, type=int,
+                        help="full-sort evaluation through an IVF index with this many lists, 0: exact scoring")
+    parser.add_argument('--ann_nprobe', default=8, type=int,
+                        help="lists scored per user with --ann_lists, more is slower and closer to exact")
+    parser.add_argument('--sample_file', default='', type=str,
+                        help="negatives for --sample_eval (.npy or text), generated if a .npy is missing. \
+                        default: data_dir/data_name_sample.npy")
 
     # data augmentation args
     parser.add_argument('--noise_ratio', default=0.0, type=float,
@@ -86,12 +117,53 @@ def main():
     parser.add_argument("--hidden_dropout_prob", type=float, default=0.5, help="hidden dropout p")
     parser.add_argument("--initializer_range", type=float, default=0.02)
     parser.add_argument('--max_seq_length', default=50, type=int)
+    parser.add_argument('--position_anchor', default='end', type=str, choices=['end', 'start'],
+                        help="end: the last item takes the last position (original SASRec); start: positions "
+                             "count from the first item, which allows exact incremental inference")
+    parser.add_argument('--gradient_checkpointing', action='store_true',
+                        help="recompute encoder layers in backward to save activation memory on long sequences")
+    parser.add_argument('--fused_ops', action='store_true',
+                        help="use native layer_norm/gelu kernels, checkpoints are compatible either way")
 
     # train args
     parser.add_argument("--lr", type=float, default=0.001, help="learning rate of adam")
     parser.add_argument("--batch_size", type=int, default=256, help="number of batch_size")
     parser.add_argument("--epochs", type=int, default=300, help="number of epochs")
     parser.add_argument("--no_cuda", action="store_true")
+    parser.add_argument("--precision", default='fp32', type=str, choices=['fp32', 'bf16'],
+                        help="bf16 runs the encoder forwards under autocast, losses and optimizer stay in fp32")
+    parser.add_argument("--compile", action="store_true",
+                        help="torch.compile the encoder and losses, falls back to eager mode on failure")
+    parser.add_argument("--compile_cache_dir", default='', type=str,
+                        help="where compiled artifacts are cached between runs, default: output_dir/compile_cache")
+    parser.add_argument("--num_threads", type=int, default=0,
+                        help="intra-op CPU threads, 0 means all available cores not used by dataloader workers "
+                             "on CPU runs and the torch default on GPU runs")
+    parser.add_argument("--num_interop_threads", type=int, default=0,
+                        help="inter-op CPU threads, 0 keeps the torch default")
+    parser.add_argument("--memory_report", action="store_true",
+                        help="print the bytes of each model, optimizer and data component at startup "
+                             "and log the peak RSS of every epoch")
+    parser.add_argument("--dry_run_memory", action="store_true",
+                        help="estimate the memory of this configuration from the arguments and data file, then exit")
+    parser.add_argument("--profile", action="store_true",
+                        help="torch.profiler traces of a window of training steps and the first evaluation pass, "
+                             "written to output_dir/profile")
+    parser.add_argument("--profile_wait", type=int, default=5, help="training steps skipped before the window")
+    parser.add_argument("--profile_steps", type=int, default=5, help="training steps in the profiled window")
+    parser.add_argument("--profile_shapes", action="store_true", help="record input shapes of the profiled ops")
+    parser.add_argument("--profile_memory", action="store_true", help="record tensor allocations in the profile")
+    parser.add_argument("--profile_row_limit", type=int, default=30, help="rows of the top-ops table")
+    parser.add_argument("--phase_timing", action="store_true",
+                        help="time data loading, each loss, backward, optimizer step, EMA and queue update "
+                             "per training step and log per-epoch statistics")
+    parser.add_argument("--num_workers", type=int, default=0, help="number of dataloader workers")
+    parser.add_argument("--length_bucketing", action="store_true",
+                        help="batch users with similar sequence lengths together")
+    parser.add_argument("--trim_padding", action="store_true",
+                        help="drop leading columns that are padding for the whole batch")
+    parser.add_argument("--trim_multiple", type=int, default=8,
+                        help="round trimmed batch width up to a multiple of this (bounds recompiles with --compile)")
     parser.add_argument("--log_freq", type=int, default=1, help="per epoch print res")
     parser.add_argument("--seed", default=1, type=int)
     parser.add_argument("--cl_weight", type=float, default=0.1,
@@ -140,27 +212,18 @@ def main():
 
     os.environ["CUDA_VISIBLE_DEVICES"] = args.gpu_id
     args.cuda_condition = torch.cuda.is_available() and not args.no_cuda
-    print("Using Cuda:", torch.cuda.is_available())
+    print("Using Cuda:", args.cuda_condition)
+    configure_cpu_threads(args)
     args.data_file = args.data_dir + args.data_name + '.txt'
+    if not args.compile_cache_dir:
+        args.compile_cache_dir = os.path.join(args.output_dir, 'compile_cache')
 
-    user_seq, max_item, valid_rating_matrix, test_rating_matrix = \
-        get_user_seqs(args.data_file)
-
-    args.item_size = max_item + 2
-    args.mask_id = max_item + 1
+    end_phase('setup')
 
     # save model args
     args_str = f'{args.model_name}-{args.data_name}'
     args.log_file = os.path.join(args.output_dir, args.tune_dir, args_str + '.txt')
 
-    show_args_info(args)
-
-    with open(args.log_file, 'a') as f:
-        f.write(str(args) + '\n')
-
-    # set item score in train set to `0` in validation
-    args.train_matrix = valid_rating_matrix
-
     # save model
     checkpoint = args_str + '.pt'
     args.checkpoint_path = os.path.join(args.output_dir, args.tune_dir, checkpoint)
@@ -169,49 +232,109 @@ def main():
     args.similarity_model_path = os.path.join(args.data_dir,
                                               args.data_name + '_' + args.similarity_model_name + '_similarity.pkl')
 
-    offline_similarity_model = OfflineItemSimilarity(data_file=args.data_file,
-                                                     similarity_path=args.similarity_model_path,
-                                                     model_name=args.similarity_model_name,
-                                                     dataset_name=args.data_name)
-    args.offline_similarity_model = offline_similarity_model
+    if args.dry_run_memory:
+        show_memory_report(args, estimate_components(args, runtime_rss), f'estimated memory of {args_str}')
+        return
 
-    # -----------   online based on shared item embedding for item similarity --------- #
-    online_similarity_model = OnlineItemSimilarity(item_size=args.item_size)
-    args.online_similarity_model = online_similarity_model
+    user_seq, max_item, valid_rating_matrix, test_rating_matrix = \
+        get_user_seqs(args.data_file)
+    end_phase('read data')
 
-    # training data for node classification
-    train_dataset = RecWithContrastiveLearningDataset(args,
-                                                      user_seq[:int(len(user_seq) * args.training_data_ratio)],
-                                                      data_type='train')
-    train_sampler = RandomSampler(train_dataset)
-    train_dataloader = DataLoader(train_dataset, sampler=train_sampler, batch_size=args.batch_size)
+    args.item_size = max_item + 2
+    args.mask_id = max_item + 1
 
-    eval_dataset = RecWithContrastiveLearningDataset(args, user_seq, data_type='valid')
-    eval_sampler = SequentialSampler(eval_dataset)
-    eval_dataloader = DataLoader(eval_dataset, sampler=eval_sampler, batch_size=args.batch_size)
+    show_args_info(args)
 
-    test_dataset = RecWithContrastiveLearningDataset(args, user_seq, data_type='test')
-    test_sampler = SequentialSampler(test_dataset)
-    test_dataloader = DataLoader(test_dataset, sampler=test_sampler, batch_size=args.batch_size)
+    with open(args.log_file, 'a') as f:
+        f.write(str(args) + '\n')
 
-    model = SASRecModel(args=args)
+    # set item score in train set to `0` in validation
+    args.train_matrix = valid_rating_matrix
+
+    test_neg_items = None
+    if args.sample_eval:
+        if not args.sample_file:
+            args.sample_file = os.path.join(args.data_dir, args.data_name + '_sample.npy')
+        test_neg_items = get_sample_negatives(args.sample_file, user_seq, args.item_size,
+                                              args.num_test_negatives, args.seed)
+    full_sort = not args.sample_eval
+
+    # evaluation only needs the test set and the query encoder: no similarity models,
+    # augmentations, key encoder or queue
+    train_dataloader, eval_dataloader = None, None
+    args.offline_similarity_model, args.online_similarity_model = None, None
+    if not args.do_eval:
+        offline_similarity_model = OfflineItemSimilarity(data_file=args.data_file,
+                                                         similarity_path=args.similarity_model_path,
+                                                         model_name=args.similarity_model_name,
+                                                         dataset_name=args.data_name)
+        # read before DataLoader workers fork so they share it, the hybrid augmentations used
+        # after warm-up also need the score range, which each worker would otherwise rescan
+        offline_similarity_model.load(with_score=args.augmentation_warm_up_epoches < args.epochs - 1)
+        args.offline_similarity_model = offline_similarity_model
+
+        # -----------   online based on shared item embedding for item similarity --------- #
+        online_similarity_model = OnlineItemSimilarity(item_size=args.item_size)
+        args.online_similarity_model = online_similarity_model
+        end_phase('similarity model')
+
+        # training data for node classification
+        train_dataset = RecWithContrastiveLearningDataset(args,
+                                                          user_seq[:int(len(user_seq) * args.training_data_ratio)],
+                                                          data_type='train')
+        train_dataloader = build_dataloader(args, train_dataset, shuffle=True)
+
+        eval_dataset = RecWithContrastiveLearningDataset(args, user_seq, test_neg_items=test_neg_items,
+                                                         data_type='valid')
+        eval_dataloader = build_dataloader(args, eval_dataset, shuffle=False)
+
+    test_dataset = RecWithContrastiveLearningDataset(args, user_seq, test_neg_items=test_neg_items,
+                                                     data_type='test')
+    test_dataloader = build_dataloader(args, test_dataset, shuffle=False)
+    end_phase('datasets')
+
+    model = SASRecModel(args=args, inference_only=args.do_eval)
 
     trainer = MoCo4SRecTrainer(model, train_dataloader, eval_dataloader,
                                test_dataloader, args)
+    end_phase('model')
+
+    if args.memory_report:
+        components = measure_components(args, trainer, user_seq, [valid_rating_matrix, test_rating_matrix],
+                                        runtime_rss)
+        show_memory_report(args, components, 'memory at startup')
+        print(f"process RSS: {mb(rss_bytes()):.1f} MB")
 
     if args.do_eval:
         trainer.args.train_matrix = test_rating_matrix
+        training_args = load_training_args(args.checkpoint_path)
+        if training_args is not None:
+            # wrong heads, activation or position anchor would load cleanly and score wrongly
+            check_given_args(training_args, {name: getattr(args, name) for name in ARCHITECTURE_ARGS},
+                             args.checkpoint_path)
         trainer.load(args.checkpoint_path)
         print(f'Load model from {args.checkpoint_path} for test!')
-        scores, result_info = trainer.test(0, full_sort=True)
+        end_phase('load checkpoint')
+        show_startup_times(startup_times)
+        scores, result_info = trainer.test(0, full_sort=full_sort)
 
     else:
+        show_startup_times(startup_times)
         print(f'Train {args.model_name}')
         early_stopping = EarlyStopping(args.checkpoint_path, patience=40, verbose=True)
+        # read by export.py, serve.py and bulk_inference.py for what the weights do not tell
+        save_training_args(args, args.checkpoint_path)
         for epoch in range(args.epochs):
+            if args.memory_report:
+                reset_peak_rss()
             trainer.train(epoch)
             # evaluate on NDCG@20
-            scores, _ = trainer.valid(epoch, full_sort=True)
+            scores, _ = trainer.valid(epoch, full_sort=full_sort)
+            if args.memory_report:
+                peak_rss = {"epoch": epoch, "peak_rss_mb": round(mb(peak_rss_bytes()), 1)}
+                print(peak_rss)
+                with open(args.log_file, 'a') as f:
+                    f.write(str(peak_rss) + '\n')
             early_stopping(np.array(scores[-1:]), trainer.model)
             if early_stopping.early_stop:
                 print("Early stopping")
@@ -219,8 +342,8 @@ def main():
         trainer.args.train_matrix = test_rating_matrix
         print('---------------Change to test_rating_matrix!-------------------')
         # load the best model
-        trainer.model.load_state_dict(torch.load(args.checkpoint_path))
-        scores, result_info = trainer.test(0, full_sort=True)
+        trainer.load(args.checkpoint_path)
+        scores, result_info = trainer.test(0, full_sort=full_sort)
 
     print(args_str)
     print(result_info)
@@ -229,4 +352,5 @@ def main():
         f.write(result_info + '\n')
 
 
-main()
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+"""
+Memory accounting: bytes per component of a training run, measured on the live objects
+(--memory_report) or estimated from the arguments and the data file without building
+anything (--dry_run_memory), and the peak RSS of every training epoch.
+
+    python main.py --data_name Beauty --k 65536 --batch_size 512 --dry_run_memory
+
+Activation sizes come from a fit of the bytes autograd keeps for backward in one
+transformer_encoder forward (fp32, dropout on):
+
+    per forward = 4 * (layers * (30 * B*L*H + 3 * B*heads*L*L) + 4 * B*L*H)
+
+within about 2% for B in 64..128, L in 50..100, H in 64..128, 2..4 layers and heads.
+A step peaks at about STEP_PEAK_FACTOR times that, and the interpreter with torch and the
+other libraries loaded is taken from the RSS at startup.
+Python containers are costed per interaction from the measured sizes of the loaded
+structures (ItemCF/ItemCF_IUF dicts: about 3.8 bytes in memory per byte of pickle).
+"""
+
+import os
+import resource
+import sys
+
+import torch
+
+from utils import nCr
+
+FLOAT_BYTES = 4
+ACTIVATION_PER_LAYER = 30  # floats per B*L*H in each encoder layer
+ATTENTION_PER_LAYER = 3  # floats per B*heads*L*L in each encoder layer
+ACTIVATION_OUTSIDE_LAYERS = 4  # floats per B*L*H for the embeddings and input LayerNorm
+USER_SEQ_BYTES_PER_INTERACTION = 42
+TRAIN_DATA_BYTES_PER_INTERACTION = 170  # OfflineItemSimilarity.train_data, only built to generate a dict
+SIMILARITY_BYTES_PER_ENTRY = 54
+SIMILARITY_BYTES_PER_PICKLE_BYTE = 3.8
+CONTRASTIVE_PROJECTION_DIM = 512  # Trainer.projection
+# peak RSS growth of a training step over the saved activations: gradients of the activations
+# in backward and allocator slack (1.8-2.0 on CPU for batch sizes 32..128)
+STEP_PEAK_FACTOR = 1.8
+
+
+def mb(nbytes):
+    return nbytes / 2 ** 20
+
+
+def _proc_status(field):
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def rss_bytes():
+    return _proc_status('VmRSS') or 0
+
+
+def peak_rss_bytes():
+    """
+    peak resident set size of this process since start or the last reset_peak_rss()
+    """
+    peak = _proc_status('VmHWM')
+    if peak is None:
+        # kilobytes on Linux, bytes on macOS; no reset
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        peak *= 1 if sys.platform == 'darwin' else 1024
+    return peak
+
+
+def reset_peak_rss():
+    """
+    restart the peak RSS at the current RSS (Linux), returns False where that is not possible
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def tensors_nbytes(tensors):
+    return sum(tensor.numel() * tensor.element_size() for tensor in tensors)
+
+
+def module_nbytes(module):
+    return tensors_nbytes(list(module.parameters()) + list(module.buffers()))
+
+
+def csr_nbytes(matrix):
+    return matrix.data.nbytes + matrix.indices.nbytes + matrix.indptr.nbytes
+
+
+def deep_sizeof(obj):
+    """
+    bytes of a structure of dicts, lists, tuples and sets and the objects in it, each object counted once
+    """
+    seen = set()
+    stack = [obj]
+    nbytes = 0
+    while stack:
+        item = stack.pop()
+        if id(item) in seen:
+            continue
+        seen.add(id(item))
+        nbytes += sys.getsizeof(item)
+        if isinstance(item, dict):
+            stack.extend(item.keys())
+            stack.extend(item.values())
+        elif isinstance(item, (list, tuple, set, frozenset)):
+            stack.extend(item)
+    return nbytes
+
+
+def dict_of_dicts_sizeof(dict_data, sample=1000):
+    """
+    deep size of {key: {key: value}}, extrapolated per entry from the first `sample` inner dicts
+    """
+    if len(dict_data) <= sample:
+        return deep_sizeof(dict_data)
+    keys = list(dict_data.keys())[:sample]
+    sample_entries = sum(len(dict_data[key]) for key in keys) or 1
+    sample_bytes = deep_sizeof([dict_data[key] for key in keys]) - sys.getsizeof(keys)
+    entries = sum(len(inner) for inner in dict_data.values())
+    return sys.getsizeof(dict_data) + sample_bytes / sample_entries * entries
+
+
+def trainable_parameters(model, args):
+    """
+    parameters that receive gradients (and Adam states): the key encoder is updated by EMA
+    and the projection head is only used with --projection_head
+    """
+    skip = set()
+    if hasattr(model, 'projection') and not args.projection_head:
+        skip = {id(param) for param in model.projection.parameters()}
+    return [param for param in model.parameters() if param.requires_grad and id(param) not in skip]
+
+
+def encoder_activation_bytes(args, batch_size):
+    """
+    bytes saved for backward by one transformer_encoder forward over batch_size sequences
+    """
+    tokens = batch_size * args.max_seq_length * args.hidden_size
+    attention = batch_size * args.num_attention_heads * args.max_seq_length ** 2
+    per_layer = ACTIVATION_PER_LAYER * tokens + ATTENTION_PER_LAYER * attention
+    if args.gradient_checkpointing:
+        # layer inputs are kept, one layer at a time is recomputed in backward
+        layers = args.num_hidden_layers * tokens + per_layer
+    else:
+        layers = args.num_hidden_layers * per_layer
+    return FLOAT_BYTES * (layers + ACTIVATION_OUTSIDE_LAYERS * tokens)
+
+
+def training_step_activation_bytes(args):
+    """
+    bytes kept for backward in one training step: the rec forward, two CL forwards and one
+    MoCo query forward per augmentation pair, the MoCo logits (which keep a copy of the
+    queue for backward) and the NCE similarity matrices
+    """
+    batch_size = args.batch_size
+    pairs = nCr(args.n_views, 2)
+    nbytes = (1 + 3 * pairs) * encoder_activation_bytes(args, batch_size)
+    moco = FLOAT_BYTES * (args.dim * args.k + 6 * batch_size * args.dim + 4 * batch_size * args.k)
+    nce = FLOAT_BYTES * 4 * (2 * batch_size) ** 2
+    rec = FLOAT_BYTES * 4 * batch_size * args.max_seq_length * args.hidden_size
+    return nbytes + pairs * (moco + nce) + rec
+
+
+def eval_step_bytes(args):
+    """
+    score buffer of one full-sort evaluation batch
+    """
+    if args.ann_lists > 0:
+        return 0
+    columns = min(args.eval_block_size, args.item_size) if args.eval_block_size > 0 else args.item_size
+    return FLOAT_BYTES * args.batch_size * columns
+
+
+def model_components(model, args, trainer_projection_bytes, runtime_bytes):
+    components = {
+        "interpreter and libraries": runtime_bytes,
+        "item embeddings": module_nbytes(model.item_embeddings),
+        "query encoder": module_nbytes(model.item_encoder) + module_nbytes(model.position_embeddings)
+                         + module_nbytes(model.LayerNorm),
+    }
+    if not model.inference_only:
+        trainable = tensors_nbytes(trainable_parameters(model, args))
+        components.update({
+            "key encoder": module_nbytes(model.encoder_k),
+            "moco queue": tensors_nbytes([model.queue, model.queue_ptr]),
+            "projection head (model)": module_nbytes(model.projection),
+            "projection head (trainer)": trainer_projection_bytes,
+            "gradients": trainable,
+            "adam states": 2 * trainable,
+        })
+    return components
+
+
+def measure_components(args, trainer, user_seq, rating_matrices, runtime_bytes):
+    """
+    bytes per component of the live objects of a run
+    """
+    components = model_components(trainer.model, args, module_nbytes(trainer.projection), runtime_bytes)
+    components["user sequences"] = deep_sizeof(user_seq)
+    components["rating matrices"] = sum(csr_nbytes(matrix) for matrix in rating_matrices)
+    offline = args.offline_similarity_model
+    if offline is not None:
+        if offline._similarity_model is not None:
+            components["similarity dict"] = dict_of_dicts_sizeof(offline._similarity_model)
+        if offline._train_data is not None:
+            components["similarity train data"] = deep_sizeof(offline._train_data)
+    if not trainer.model.inference_only:
+        components["activations / step (est.)"] = training_step_activation_bytes(args)
+    components["eval scores / batch"] = eval_step_bytes(args)
+    return components
+
+
+def scan_data_file(data_file):
+    """
+    (users, interactions, largest item id, sum over users of n * (n - 1)) of an interaction file
+    """
+    num_users, num_interactions, max_item, pairs = 0, 0, 0, 0
+    with open(data_file) as f:
+        for line in f:
+            items = line.split()[1:]
+            num_users += 1
+            num_interactions += len(items)
+            max_item = max(max_item, max(int(item) for item in items))
+            pairs += len(items) * (len(items) - 1)
+    return num_users, num_interactions, max_item, pairs
+
+
+def estimate_components(args, runtime_bytes):
+    """
+    bytes per component of a run with these arguments, from the data file and the similarity
+    pickle sizes only; the model is built on the meta device, nothing is allocated
+    """
+    from models import SASRecModel
+
+    num_users, num_interactions, max_item, pairs = scan_data_file(args.data_file)
+    args.item_size = max_item + 2
+    inference_only = args.do_eval
+    with torch.device('meta'):
+        model = SASRecModel(args, inference_only=inference_only)
+    trainer_projection = FLOAT_BYTES * (args.max_seq_length * args.hidden_size * CONTRASTIVE_PROJECTION_DIM
+                                        + 4 * CONTRASTIVE_PROJECTION_DIM
+                                        + CONTRASTIVE_PROJECTION_DIM * args.hidden_size + args.hidden_size)
+    components = model_components(model, args, trainer_projection, runtime_bytes)
+
+    components["user sequences"] = USER_SEQ_BYTES_PER_INTERACTION * num_interactions
+    # valid and test matrices: int64 values and int32 column indices per interaction, int32 row pointers
+    valid_nnz, test_nnz = num_interactions - 2 * num_users, num_interactions - num_users
+    components["rating matrices"] = 12 * (valid_nnz + test_nnz) + 2 * 4 * (num_users + 1)
+    if not inference_only:
+        if os.path.exists(args.similarity_model_path):
+            components["similarity dict"] = SIMILARITY_BYTES_PER_PICKLE_BYTE * \
+                                             os.path.getsize(args.similarity_model_path)
+        else:
+            # generated at startup: co-rated pairs counted per user, at most item_size^2
+            entries = min(pairs, args.item_size ** 2)
+            components["similarity dict"] = 2 * SIMILARITY_BYTES_PER_ENTRY * entries
+            components["similarity train data"] = TRAIN_DATA_BYTES_PER_INTERACTION * num_interactions
+        components["activations / step (est.)"] = training_step_activation_bytes(args)
+    components["eval scores / batch"] = eval_step_bytes(args)
+    return components
+
+
+def show_memory_report(args, components, title):
+    """
+    print the components, the estimated peak (everything resident plus the larger of one
+    training step and one evaluation batch) and append them to the log file
+    """
+    transient = ("activations / step (est.)", "eval scores / batch")
+    resident = sum(nbytes for name, nbytes in components.items() if name not in transient)
+    peak = resident + max(STEP_PEAK_FACTOR * components.get("activations / step (est.)", 0),
+                          components["eval scores / batch"])
+    python_objects = sum(components.get(name, 0) for name in
+                         ("user sequences", "similarity dict", "similarity train data"))
+    print(f"{title}:")
+    for name, nbytes in components.items():
+        print(f"  {name:<28} {mb(nbytes):12.1f} MB")
+    print(f"  {'resident':<28} {mb(resident):12.1f} MB")
+    print(f"  {'estimated peak':<28} {mb(peak):12.1f} MB")
+    if args.num_workers > 0:
+        # forked workers share the parent's pages until reference counting touches them
+        print(f"  up to {mb(python_objects):.1f} MB more per DataLoader worker (python objects copied on write)")
+    with open(args.log_file, 'a') as f:
+        f.write(str({"memory": title, "components_mb": {name: round(mb(nbytes), 2)
+                                                        for name, nbytes in components.items()},
+                     "estimated_peak_mb": round(mb(peak), 2)}) + '\n')
+    return peak
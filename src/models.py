@@ -8,23 +8,46 @@ import copy
 
 import torch
 import torch.nn as nn
-import gensim
 
 from modules import Encoder, LayerNorm
+from utils import PhaseTimer
+
+
+class IncrementalState:
+    """
+    one user's window of item ids, the keys and values of every encoder layer over it
+    ([1 heads len(items) head_size] each) and its last-position output [hidden_size]
+    """
+
+    def __init__(self, items, keys, values, output):
+        self.items = items
+        self.keys = keys
+        self.values = values
+        self.output = output
 
 
 class SASRecModel(nn.Module):
-    def __init__(self, args):
+    def __init__(self, args, inference_only=False):
         super(SASRecModel, self).__init__()
-        self.item_embeddings = nn.Embedding(args.item_size, args.hidden_size, padding_idx=0)
-        self.position_embeddings = nn.Embedding(args.max_seq_length, args.hidden_size)
+        # inference-only weights come from a checkpoint: the embeddings are left uninitialised
+        item_weight = torch.empty(args.item_size, args.hidden_size) if inference_only else None
+        position_weight = torch.empty(args.max_seq_length, args.hidden_size) if inference_only else None
+        self.item_embeddings = nn.Embedding(args.item_size, args.hidden_size, padding_idx=0, _weight=item_weight)
+        self.position_embeddings = nn.Embedding(args.max_seq_length, args.hidden_size, _weight=position_weight)
         self.item_encoder = Encoder(args)
         # self.moco_encoder = MoCo(args)
-        self.LayerNorm = LayerNorm(args.hidden_size, eps=1e-12)
+        self.LayerNorm = LayerNorm(args.hidden_size, eps=1e-12, fused=args.fused_ops)
         self.dropout = nn.Dropout(args.hidden_dropout_prob)
         self.args = args
 
         self.criterion = nn.BCELoss(reduction='none')
+        # replaced by the trainer's timer when --phase_timing is set
+        self.phase_timer = PhaseTimer()
+        self.inference_only = inference_only
+        if inference_only:
+            # query path only, weights come from a checkpoint: no initialisation,
+            # projection head, key encoder or queue
+            return
         self.apply(self.init_weights)
 
         # projection head for contrastive learn task
@@ -58,9 +81,17 @@ class SASRecModel(nn.Module):
     # Positional Embedding
     def add_position_embedding(self, sequence, shuffle=False, usenoise=False):
 
-        seq_length = sequence.size(1)
-        position_ids = torch.arange(seq_length, dtype=torch.long, device=sequence.device)
-        position_ids = position_ids.unsqueeze(0).expand_as(sequence)
+        if self.args.position_anchor == 'start':
+            # positions count from the first item, so an item keeps its position while later
+            # items are appended (exact incremental inference, see append_items)
+            position_ids = ((sequence > 0).long().cumsum(1) - 1).clamp(min=0)
+        else:
+            # sequences are left padded: the last item always takes the last position,
+            # also for batches trimmed to fewer than max_seq_length columns
+            seq_length = sequence.size(1)
+            position_ids = torch.arange(self.args.max_seq_length - seq_length, self.args.max_seq_length,
+                                        dtype=torch.long, device=sequence.device)
+            position_ids = position_ids.unsqueeze(0).expand_as(sequence)
         # add token shuffle
         if shuffle:
             position_ids = position_ids[:, torch.randperm(position_ids.size()[1])]
@@ -117,19 +148,20 @@ class SASRecModel(nn.Module):
         return cutoff_embeddings
 
     # model same as SASRec
-    def transformer_encoder(self, input_ids, cutoff=False, shuffle=False, noise=False):
+    def transformer_encoder(self, input_ids, cutoff=False, shuffle=False, noise=False, last_position_only=False):
+        """
+        last_position_only: for inference, the last layer only computes the final position
+        and the output is [batch 1 hidden_size]
+        """
 
         attention_mask = (input_ids > 0).long()
         extended_attention_mask = attention_mask.unsqueeze(1).unsqueeze(2)  # torch.int64
         max_len = attention_mask.size(-1)
         attn_shape = (1, max_len, max_len)
-        subsequent_mask = torch.triu(torch.ones(attn_shape), diagonal=1)  # torch.uint8
+        subsequent_mask = torch.triu(torch.ones(attn_shape, device=input_ids.device), diagonal=1)  # torch.uint8
         subsequent_mask = (subsequent_mask == 0).unsqueeze(1)
         subsequent_mask = subsequent_mask.long()
 
-        if self.args.cuda_condition:
-            subsequent_mask = subsequent_mask.cuda()
-
         extended_attention_mask = extended_attention_mask * subsequent_mask
         extended_attention_mask = extended_attention_mask.to(dtype=next(self.parameters()).dtype)  # fp16 compatibility
         extended_attention_mask = (1.0 - extended_attention_mask) * -10000.0
@@ -141,18 +173,108 @@ class SASRecModel(nn.Module):
 
         item_encoded_layers = self.item_encoder(sequence_emb,
                                                 extended_attention_mask,
-                                                output_all_encoded_layers=True)
+                                                output_all_encoded_layers=False,
+                                                last_position_only=last_position_only)
 
         sequence_output = item_encoded_layers[-1]
         return sequence_output
 
+    @torch.no_grad()
+    def encode_sequences(self, sequences):
+        """
+        inference: last-position representations [batch hidden_size] of a list of item id
+        sequences, left padded to the longest one (at most max_seq_length items are kept)
+        """
+        sequences = [list(items)[-self.args.max_seq_length:] for items in sequences]
+        max_len = max(max(len(items) for items in sequences), 1)
+        input_ids = torch.tensor([[0] * (max_len - len(items)) + items for items in sequences],
+                                 dtype=torch.long, device=self.item_embeddings.weight.device)
+        sequence_output = self.transformer_encoder(input_ids, last_position_only=True)
+        return sequence_output[:, -1, :]
+
+    @torch.no_grad()
+    def start_incremental(self, items):
+        """
+        incremental inference for one user: encode the last max_seq_length of its item ids
+        and return the IncrementalState that append_items extends. needs a model trained
+        with --position_anchor start
+        """
+        if self.args.position_anchor != 'start':
+            raise ValueError("incremental inference needs a model trained with --position_anchor start: "
+                             "with end-anchored positions every append moves all earlier items")
+        num_layers = len(self.item_encoder.layer)
+        state = IncrementalState([], [None] * num_layers, [None] * num_layers, None)
+        return self._extend_state(state, list(items)[-self.args.max_seq_length:])
+
+    @torch.no_grad()
+    def append_items(self, state, items):
+        """
+        a new IncrementalState with items appended: only the new positions are computed, each
+        layer's attention reuses the cached keys and values. a window that would grow past
+        max_seq_length drops its oldest items, which moves every position, so it is encoded
+        again from scratch
+        """
+        items = list(items)
+        if len(state.items) + len(items) > self.args.max_seq_length:
+            return self.start_incremental(state.items + items)
+        return self._extend_state(state, items)
+
+    def _extend_state(self, state, items):
+        if not items:
+            return state
+        device = self.item_embeddings.weight.device
+        start = len(state.items)
+        input_ids = torch.tensor([items], dtype=torch.long, device=device)
+        position_ids = torch.arange(start, start + len(items), dtype=torch.long, device=device).unsqueeze(0)
+        hidden_states = self.LayerNorm(self.item_embeddings(input_ids) + self.position_embeddings(position_ids))
+        hidden_states = self.dropout(hidden_states)
+        keys, values = [], []
+        for layer, past_key, past_value in zip(self.item_encoder.layer, state.keys, state.values):
+            hidden_states, key, value = layer.forward_incremental(hidden_states, past_key, past_value)
+            keys.append(key)
+            values.append(value)
+        return IncrementalState(state.items + items, keys, values, hidden_states[0, -1])
+
+    def score_candidates(self, seq_out, candidate_ids, candidate_mask=None):
+        """
+        seq_out: [batch hidden_size] last-position representations, candidate_ids: [batch num_candidates]
+        returns [batch num_candidates] scores, -inf where candidate_mask is False (padding)
+        """
+        candidate_emb = self.item_embeddings(candidate_ids)
+        scores = torch.bmm(candidate_emb, seq_out.unsqueeze(-1)).squeeze(-1)
+        if candidate_mask is not None:
+            scores = scores.masked_fill(~candidate_mask, float('-inf'))
+        return scores
+
+    def pad_sequence_output(self, sequence_output, input_ids):
+        """
+        left pad a (trimmed) [batch seq_len hidden_size] output back to max_seq_length, so
+        flattened sequence representations keep a fixed size. with --trim_padding or
+        --length_bucketing the outputs at padding positions (input_ids == 0) are zeroed
+        first, so a representation does not depend on the width of its batch; the default
+        path keeps them, as the original objective does
+        """
+        if self.args.trim_padding or self.args.length_bucketing:
+            sequence_output = sequence_output.masked_fill((input_ids == 0).unsqueeze(-1), 0.0)
+        pad_len = self.args.max_seq_length - sequence_output.size(1)
+        if pad_len == 0:
+            return sequence_output
+        return nn.functional.pad(sequence_output, (0, 0, pad_len, 0))
+
     @torch.no_grad()
     def _momentum_update_key_encoder(self):
         """
-        Momentum update of the key encoder
+        Momentum update of the key encoder, applied in place to all parameters at once.
+        Called once per optimizer step by the trainer.
         """
-        for param_q, param_k in zip(self.item_encoder.parameters(), self.encoder_k.parameters()):
-            param_k.data = param_k.data * self.m + param_q.data * (1. - self.m)
+        params_q = list(self.item_encoder.parameters())
+        params_k = list(self.encoder_k.parameters())
+        if hasattr(torch, '_foreach_mul_'):
+            torch._foreach_mul_(params_k, self.m)
+            torch._foreach_add_(params_k, params_q, alpha=1. - self.m)
+        else:
+            for param_q, param_k in zip(params_q, params_k):
+                param_k.mul_(self.m).add_(param_q, alpha=1. - self.m)
 
     @torch.no_grad()
     def _dequeue_and_enqueue(self, keys):
@@ -190,7 +312,7 @@ class SASRecModel(nn.Module):
         Batch shuffle, for making use of BatchNorm.
         """
         # random shuffle index
-        idx_shuffle = torch.randperm(x.shape[0]).cuda()
+        idx_shuffle = torch.randperm(x.shape[0], device=x.device)
 
         # index for restoring
         idx_unshuffle = torch.argsort(idx_shuffle)
@@ -213,29 +335,25 @@ class SASRecModel(nn.Module):
         extended_attention_mask = attention_mask.unsqueeze(1).unsqueeze(2)  # torch.int64
         max_len = attention_mask.size(-1)
         attn_shape = (1, max_len, max_len)
-        subsequent_mask = torch.triu(torch.ones(attn_shape), diagonal=1)  # torch.uint8
+        subsequent_mask = torch.triu(torch.ones(attn_shape, device=input_ids.device), diagonal=1)  # torch.uint8
         subsequent_mask = (subsequent_mask == 0).unsqueeze(1)
         subsequent_mask = subsequent_mask.long()
 
-        if self.args.cuda_condition:
-            subsequent_mask = subsequent_mask.cuda()
-
         extended_attention_mask = extended_attention_mask * subsequent_mask
         extended_attention_mask = extended_attention_mask.to(dtype=next(self.parameters()).dtype)  # fp16 compatibility
         extended_attention_mask = (1.0 - extended_attention_mask) * -10000.0
 
-        sequence_emb = self.add_position_embedding(input_ids,  shuffle=shuffle, noise=noise)
+        sequence_emb = self.add_position_embedding(input_ids, shuffle=shuffle, usenoise=noise)
         
         if cutoff:
             sequence_emb = self.cutoff_embeddings(sequence_emb, attention_mask, self.args.direction, self.args.cutoff_rate)
 
         size = len(sequence_emb) // 2
-        sequence_emb = sequence_emb.cuda()
 
         # q
         q = self.item_encoder(sequence_emb[:size], extended_attention_mask[:size],
-                              output_all_encoded_layers=True)  # queries: NxC
-        q = q[-1]
+                              output_all_encoded_layers=False)  # queries: NxC
+        q = self.pad_sequence_output(q[-1], input_ids[:size])
         q = q.view(sequence_emb[:size].shape[0], -1)
         q = nn.functional.normalize(q, dim=1)
         if self.args.projection_head:
@@ -244,14 +362,14 @@ class SASRecModel(nn.Module):
         # k
         # compute key features
         with torch.no_grad():  # no gradient to keys
-            self._momentum_update_key_encoder()  # update the key encoder
+            # the key encoder is updated by the trainer after each optimizer step
 
             # shuffle for making use of BN
             # im_k, idx_unshuffle = self._batch_shuffle_ddp(im_k)
 
             k = self.encoder_k(sequence_emb[size:], extended_attention_mask[size:],
-                               output_all_encoded_layers=True)  # keys: NxC
-            k = k[-1]
+                               output_all_encoded_layers=False)  # keys: NxC
+            k = self.pad_sequence_output(k[-1], input_ids[size:])
             k = k.view(sequence_emb[size:].shape[0], -1)
             k = nn.functional.normalize(k, dim=1)
             if self.args.projection_head:
@@ -270,17 +388,18 @@ class SASRecModel(nn.Module):
 
         l_neg = l_neg * weights
 
-        # logits: Nx(1+K)
-        logits = torch.cat([l_pos, l_neg], dim=1)
+        # logits: Nx(1+K), in fp32 for the log-softmax under mixed precision
+        logits = torch.cat([l_pos, l_neg], dim=1).float()
 
         # apply temperature
         logits /= self.T
 
         # labels: positive key indicators
-        labels = torch.zeros(logits.shape[0], dtype=torch.long).cuda()
+        labels = torch.zeros(logits.shape[0], dtype=torch.long, device=logits.device)
 
         # dequeue and enqueue
-        self._dequeue_and_enqueue(k)
+        with self.phase_timer.phase('queue update'):
+            self._dequeue_and_enqueue(k)
 
         return logits, labels
 
@@ -311,10 +430,15 @@ class OnlineItemSimilarity:
 
     def update_embedding_matrix(self, item_embeddings):
         self.item_embeddings = copy.deepcopy(item_embeddings)
+        # follow the device of the (trained) embeddings, which may differ when --no_cuda is set
+        self.device = self.item_embeddings.weight.device
+        self.total_item_list = self.total_item_list.to(self.device)
         self.base_embedding_matrix = self.item_embeddings(self.total_item_list)
 
     def get_maximum_minimum_sim_scores(self):
         max_score, min_score = -1, 100
+        if self.item_embeddings is None:
+            return max_score, min_score
         for item_idx in range(1, self.item_size):
             try:
                 item_vector = self.item_embeddings(item_idx).view(-1, 1)
@@ -347,15 +471,62 @@ class OnlineItemSimilarity:
 
 
 class OfflineItemSimilarity:
+    """
+    the train data, the similarity dict and its score range are loaded on first use,
+    call load() to read the similarity dict up front (e.g. before DataLoader workers fork),
+    with_score=True also scans it for the score range that scored lookups normalise by
+    """
     def __init__(self, data_file=None, similarity_path=None, model_name='ItemCF',
                  dataset_name='Sports_and_Outdoors'):
         self.dataset_name = dataset_name
+        self.data_file = data_file
         self.similarity_path = similarity_path
-        # train_data_list used for item2vec, train_data_dict used for itemCF and itemCF-IUF
-        self.train_data_list, self.train_item_list, self.train_data_dict = self._load_train_data(data_file)
         self.model_name = model_name
-        self.similarity_model = self.load_similarity_model(self.similarity_path)
-        self.max_score, self.min_score = self.get_maximum_minimum_sim_scores()
+        self._train_data = None
+        self._similarity_model = None
+        self._score_range = None
+
+    def load(self, with_score=False):
+        if with_score and self._score_range is None:
+            self._score_range = self.get_maximum_minimum_sim_scores()
+        return self.similarity_model
+
+    @property
+    def train_data(self):
+        if self._train_data is None:
+            self._train_data = self._load_train_data(self.data_file)
+        return self._train_data
+
+    # train_data_list used for item2vec, train_data_dict used for itemCF and itemCF-IUF
+    @property
+    def train_data_list(self):
+        return self.train_data[0]
+
+    @property
+    def train_item_list(self):
+        return self.train_data[1]
+
+    @property
+    def train_data_dict(self):
+        return self.train_data[2]
+
+    @property
+    def similarity_model(self):
+        if self._similarity_model is None:
+            self._similarity_model = self.load_similarity_model(self.similarity_path)
+        return self._similarity_model
+
+    @property
+    def max_score(self):
+        if self._score_range is None:
+            self._score_range = self.get_maximum_minimum_sim_scores()
+        return self._score_range[0]
+
+    @property
+    def min_score(self):
+        if self._score_range is None:
+            self._score_range = self.get_maximum_minimum_sim_scores()
+        return self._score_range[1]
 
     def get_maximum_minimum_sim_scores(self):
         max_score, min_score = -1, 100
@@ -445,6 +616,8 @@ class OfflineItemSimilarity:
         elif self.model_name == 'Item2Vec':
             # details here: https://github.com/RaRe-Technologies/gensim/blob/develop/gensim/models/word2vec.py
             print("Step 1: train item2vec model")
+            # only needed to generate an Item2Vec similarity dict
+            import gensim
             item2vec_model = gensim.models.Word2Vec(sentences=self.train_data_list,
                                                     vector_size=20, window=5, min_count=0,
                                                     epochs=100)
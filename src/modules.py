@@ -7,6 +7,7 @@ import math
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 
 
 class NCELoss(nn.Module):
@@ -33,7 +34,8 @@ class NCELoss(nn.Module):
         raw_scores2 = torch.cat([sim22, sim12.transpose(-1, -2)], dim=-1)
         logits = torch.cat([raw_scores1, raw_scores2], dim=-2)
         labels = torch.arange(2 * d, dtype=torch.long, device=logits.device)
-        nce_loss = self.criterion(logits, labels)
+        # log-softmax in fp32 under mixed precision
+        nce_loss = self.criterion(logits.float(), labels)
         return nce_loss
 
     # # nce loss implemented by: https://github.com/sthalles/SimCLR/blob/master/simclr.py
@@ -124,18 +126,26 @@ def swish(x):
 
 
 ACT2FN = {"gelu": gelu, "relu": F.relu, "swish": swish}
+# native kernels with the same semantics, used with --fused_ops
+FUSED_ACT2FN = {"gelu": F.gelu, "relu": F.relu, "swish": F.silu}
 
 
 class LayerNorm(nn.Module):
-    def __init__(self, hidden_size, eps=1e-12):
+    def __init__(self, hidden_size, eps=1e-12, fused=False):
         """Construct a layernorm module in the TF style (epsilon inside the square root).
+        fused=True runs the native layer_norm kernel, which has the same semantics and parameters.
         """
         super(LayerNorm, self).__init__()
         self.weight = nn.Parameter(torch.ones(hidden_size))
         self.bias = nn.Parameter(torch.zeros(hidden_size))
         self.variance_epsilon = eps
+        self.fused = fused
 
     def forward(self, x):
+        # statistics in fp32 under mixed precision
+        x = x.float()
+        if self.fused:
+            return F.layer_norm(x, self.weight.shape, self.weight, self.bias, self.variance_epsilon)
         u = x.mean(-1, keepdim=True)
         s = (x - u).pow(2).mean(-1, keepdim=True)
         x = (x - u) / torch.sqrt(s + self.variance_epsilon)
@@ -152,7 +162,7 @@ class Embeddings(nn.Module):
         self.item_embeddings = nn.Embedding(args.item_size, args.hidden_size, padding_idx=0)  # 不要乱用padding_idx
         self.position_embeddings = nn.Embedding(args.max_seq_length, args.hidden_size)
 
-        self.LayerNorm = LayerNorm(args.hidden_size, eps=1e-12)
+        self.LayerNorm = LayerNorm(args.hidden_size, eps=1e-12, fused=args.fused_ops)
         self.dropout = nn.Dropout(args.hidden_dropout_prob)
 
         self.args = args
@@ -189,7 +199,7 @@ class SelfAttention(nn.Module):
 
         # 做完self-attention 做一个前馈全连接 LayerNorm 输出
         self.dense = nn.Linear(args.hidden_size, args.hidden_size)
-        self.LayerNorm = LayerNorm(args.hidden_size, eps=1e-12)
+        self.LayerNorm = LayerNorm(args.hidden_size, eps=1e-12, fused=args.fused_ops)
         self.out_dropout = nn.Dropout(args.hidden_dropout_prob)
 
     def transpose_for_scores(self, x):
@@ -197,8 +207,13 @@ class SelfAttention(nn.Module):
         x = x.view(*new_x_shape)
         return x.permute(0, 2, 1, 3)
 
-    def forward(self, input_tensor, attention_mask):
-        mixed_query_layer = self.query(input_tensor)
+    def forward(self, input_tensor, attention_mask, last_position_only=False):
+        # last_position_only: queries (and the output) only for the final position,
+        # keys and values still cover the whole sequence
+        query_tensor = input_tensor[:, -1:, :] if last_position_only else input_tensor
+        if last_position_only:
+            attention_mask = attention_mask[:, :, -1:, :]
+        mixed_query_layer = self.query(query_tensor)
         mixed_key_layer = self.key(input_tensor)
         mixed_value_layer = self.value(input_tensor)
 
@@ -227,22 +242,54 @@ class SelfAttention(nn.Module):
         context_layer = context_layer.view(*new_context_layer_shape)
         hidden_states = self.dense(context_layer)
         hidden_states = self.out_dropout(hidden_states)
-        hidden_states = self.LayerNorm(hidden_states + input_tensor)
+        hidden_states = self.LayerNorm(hidden_states + query_tensor)
 
         return hidden_states
 
+    def forward_incremental(self, input_tensor, past_key=None, past_value=None):
+        """
+        inference over new positions appended after cached ones: input_tensor is
+        [batch new hidden_size], past_key / past_value [batch heads cached head_size] or None.
+        the new positions attend causally to the cached ones and to each other; returns
+        (output, keys, values) with the keys and values of all positions
+        """
+        query_layer = self.transpose_for_scores(self.query(input_tensor))
+        key_layer = self.transpose_for_scores(self.key(input_tensor))
+        value_layer = self.transpose_for_scores(self.value(input_tensor))
+        if past_key is not None:
+            key_layer = torch.cat([past_key, key_layer], 2)
+            value_layer = torch.cat([past_value, value_layer], 2)
+
+        attention_scores = torch.matmul(query_layer, key_layer.transpose(-1, -2))
+        attention_scores = attention_scores / math.sqrt(self.attention_head_size)
+        # the same additive mask as the full forward: new position i sees cached + i + 1 keys
+        num_new, num_keys = input_tensor.size(1), key_layer.size(2)
+        causal = torch.ones(num_new, num_keys, device=input_tensor.device).tril(diagonal=num_keys - num_new)
+        attention_scores = attention_scores + (1.0 - causal.to(attention_scores.dtype)) * -10000.0
+
+        attention_probs = nn.Softmax(dim=-1)(attention_scores)
+        attention_probs = self.attn_dropout(attention_probs)
+        context_layer = torch.matmul(attention_probs, value_layer)
+        context_layer = context_layer.permute(0, 2, 1, 3).contiguous()
+        context_layer = context_layer.view(*context_layer.size()[:-2], self.all_head_size)
+        hidden_states = self.dense(context_layer)
+        hidden_states = self.out_dropout(hidden_states)
+        hidden_states = self.LayerNorm(hidden_states + input_tensor)
+        return hidden_states, key_layer, value_layer
+
 
 class Intermediate(nn.Module):
     def __init__(self, args):
         super(Intermediate, self).__init__()
         self.dense_1 = nn.Linear(args.hidden_size, args.hidden_size * 4)
         if isinstance(args.hidden_act, str):
-            self.intermediate_act_fn = ACT2FN[args.hidden_act]
+            act2fn = FUSED_ACT2FN if args.fused_ops else ACT2FN
+            self.intermediate_act_fn = act2fn[args.hidden_act]
         else:
             self.intermediate_act_fn = args.hidden_act
 
         self.dense_2 = nn.Linear(args.hidden_size * 4, args.hidden_size)
-        self.LayerNorm = LayerNorm(args.hidden_size, eps=1e-12)
+        self.LayerNorm = LayerNorm(args.hidden_size, eps=1e-12, fused=args.fused_ops)
         self.dropout = nn.Dropout(args.hidden_dropout_prob)
 
     def forward(self, input_tensor):
@@ -263,11 +310,15 @@ class Layer(nn.Module):
         self.attention = SelfAttention(args)
         self.intermediate = Intermediate(args)
 
-    def forward(self, hidden_states, attention_mask):
-        attention_output = self.attention(hidden_states, attention_mask)
+    def forward(self, hidden_states, attention_mask, last_position_only=False):
+        attention_output = self.attention(hidden_states, attention_mask, last_position_only)
         intermediate_output = self.intermediate(attention_output)
         return intermediate_output
 
+    def forward_incremental(self, hidden_states, past_key=None, past_value=None):
+        attention_output, key, value = self.attention.forward_incremental(hidden_states, past_key, past_value)
+        return self.intermediate(attention_output), key, value
+
 
 class Encoder(nn.Module):
     def __init__(self, args):
@@ -275,11 +326,22 @@ class Encoder(nn.Module):
         layer = Layer(args)
         self.layer = nn.ModuleList([copy.deepcopy(layer)
                                     for _ in range(args.num_hidden_layers)])
+        # recompute each layer in backward instead of keeping its activations
+        self.gradient_checkpointing = args.gradient_checkpointing
 
-    def forward(self, hidden_states, attention_mask, output_all_encoded_layers=True):
+    def forward(self, hidden_states, attention_mask, output_all_encoded_layers=True, last_position_only=False):
+        """
+        last_position_only: the last layer only computes the final position, whose output
+        is all that inference uses; its output is [batch 1 hidden_size]
+        """
         all_encoder_layers = []
-        for layer_module in self.layer:
-            hidden_states = layer_module(hidden_states, attention_mask)
+        num_layers = len(self.layer)
+        for i, layer_module in enumerate(self.layer):
+            if self.gradient_checkpointing and self.training and torch.is_grad_enabled():
+                hidden_states = checkpoint(layer_module, hidden_states, attention_mask, use_reentrant=False)
+            else:
+                hidden_states = layer_module(hidden_states, attention_mask,
+                                             last_position_only and i == num_layers - 1)
             if output_all_encoded_layers:
                 all_encoder_layers.append(hidden_states)
         if not output_all_encoded_layers:
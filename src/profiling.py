@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""
+torch.profiler around a window of training steps and one evaluation pass (--profile).
+
+    python main.py --data_name Beauty --profile --profile_wait 5 --profile_steps 10
+
+Traces go to output_dir/profile/: one <name>.<timestamp>.pt.trace.json per profiled
+window, which opens in chrome://tracing / Perfetto and in TensorBoard
+(tensorboard --logdir output_dir/profile), plus <name>_top_ops.txt with the operators
+sorted by self time. The rec, CL and MoCo losses and the dataset augmentations show up
+as the record_function ranges 'rec', 'cl', 'moco' and 'augmentation' (augmentations
+only with --num_workers 0, worker processes are not profiled).
+"""
+
+import os
+from contextlib import nullcontext
+
+import torch
+from torch.profiler import ProfilerActivity, profile, record_function, schedule, tensorboard_trace_handler
+
+_NO_RANGE = nullcontext()
+
+
+def profile_range(name):
+    """
+    record_function(name) while a profiler is running; otherwise a no-op, which is cheaper
+    than an idle record_function on the per-sequence augmentation path
+    """
+    return record_function(name) if torch.autograd._profiler_enabled() else _NO_RANGE
+
+
+def profile_dir(args):
+    return os.path.join(args.output_dir, 'profile')
+
+
+def trace_handler(args, name, device):
+    """
+    on_trace_ready callback: Chrome/TensorBoard trace and the top-ops table
+    """
+    directory = profile_dir(args)
+    export_trace = tensorboard_trace_handler(directory, worker_name=name)
+    sort_by = 'self_device_time_total' if device.type == 'cuda' else 'self_cpu_time_total'
+
+    def handler(prof):
+        export_trace(prof)
+        table = prof.key_averages().table(sort_by=sort_by, row_limit=args.profile_row_limit)
+        with open(os.path.join(directory, f'{name}_top_ops.txt'), 'w') as f:
+            f.write(table)
+        print(f"{name} profile written to {directory}")
+        print(table)
+    return handler
+
+
+def build_profiler(args, name, device, steps=True):
+    """
+    profiler that records steps [profile_wait + 1, profile_wait + 1 + profile_steps) of the
+    loop it is stepped in (one warm-up step before the window), or everything between
+    start and stop when steps=False
+    """
+    os.makedirs(profile_dir(args), exist_ok=True)
+    activities = [ProfilerActivity.CPU]
+    if device.type == 'cuda':
+        activities.append(ProfilerActivity.CUDA)
+    window = schedule(wait=args.profile_wait, warmup=1, active=args.profile_steps, repeat=1) if steps else None
+    return profile(activities=activities, schedule=window, on_trace_ready=trace_handler(args, name, device),
+                   record_shapes=args.profile_shapes, profile_memory=args.profile_memory)
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""
+Reduced precision CPU inference: dynamic int8 Linear layers in the query encoder and an
+int8 (per-row scales) or fp16 copy of the item embedding table for full-catalog scoring.
+"""
+
+import copy
+
+import torch
+import torch.nn as nn
+
+
+def quantize_encoder(model):
+    """
+    copy of the model whose item_encoder Linear layers run as dynamic int8 (weights stored in
+    int8, activations quantized per batch). CPU only; embeddings and LayerNorm stay fp32.
+    """
+    model = copy.deepcopy(model).cpu().eval()
+    model.item_encoder = torch.ao.quantization.quantize_dynamic(model.item_encoder, {nn.Linear}, dtype=torch.qint8)
+    return model
+
+
+class QuantizedItemTable:
+    """
+    Item embedding table stored as int8 with one fp32 scale per row (symmetric, the row's
+    largest magnitude maps to 127) or as fp16. Slicing returns dequantized fp32 rows, so it
+    can replace the float table in retrieval.blocked_topk, which only dequantizes one
+    block at a time.
+    """
+
+    def __init__(self, weight, dtype='int8'):
+        weight = weight.detach().float()
+        self.dtype = dtype
+        if dtype == 'int8':
+            self.scales = weight.abs().amax(dim=1, keepdim=True).clamp(min=1e-12) / 127.0
+            self.values = torch.round(weight / self.scales).to(torch.int8)
+        elif dtype == 'fp16':
+            self.scales = None
+            self.values = weight.half()
+        else:
+            raise ValueError(f"dtype should be int8 or fp16, but got {dtype}")
+
+    def __getitem__(self, index):
+        values = self.values[index].float()
+        if self.scales is not None:
+            values = values * self.scales[index]
+        return values
+
+    def size(self, dim=None):
+        return self.values.size() if dim is None else self.values.size(dim)
+
+    @property
+    def nbytes(self):
+        nbytes = self.values.numel() * self.values.element_size()
+        if self.scales is not None:
+            nbytes += self.scales.numel() * self.scales.element_size()
+        return nbytes
+
+
+def model_nbytes(module):
+    """
+    bytes of the parameters and buffers of module, including packed int8 Linear weights
+    """
+    nbytes = sum(tensor.numel() * tensor.element_size()
+                 for tensor in list(module.parameters()) + list(module.buffers()))
+    for submodule in module.modules():
+        if isinstance(submodule, torch.ao.nn.quantized.dynamic.Linear):
+            weight, bias = submodule._weight_bias()
+            nbytes += weight.numel() * weight.element_size()
+            if bias is not None:
+                nbytes += bias.numel() * bias.element_size()
+    return nbytes
@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+"""
+Top-N retrieval over the item embedding table for evaluation and serving.
+"""
+
+import numpy as np
+import torch
+
+
+def padded_histories(histories, device, pad_value):
+    """
+    [batch max_history] sorted item ids of each row's history, right padded with pad_value
+    (larger than every item id, so each row stays sorted)
+    """
+    width = max(max((len(items) for items in histories), default=0), 1)
+    padded = torch.full((len(histories), width), pad_value, dtype=torch.long)
+    for row, items in enumerate(histories):
+        if len(items):
+            padded[row, :len(items)] = torch.as_tensor(np.sort(np.asarray(items)), dtype=torch.long)
+    return padded.to(device)
+
+
+def pack_candidates(candidates, device):
+    """
+    ragged candidate id lists -> [batch max_candidates] ids right padded with 0, and the
+    [batch max_candidates] mask of real candidates
+    """
+    width = max(max((len(items) for items in candidates), default=0), 1)
+    candidate_ids = torch.zeros(len(candidates), width, dtype=torch.long)
+    for row, items in enumerate(candidates):
+        if len(items):
+            candidate_ids[row, :len(items)] = torch.as_tensor(items, dtype=torch.long)
+    lengths = torch.tensor([len(items) for items in candidates])
+    candidate_mask = torch.arange(width).unsqueeze(0) < lengths.unsqueeze(1)
+    return candidate_ids.to(device), candidate_mask.to(device)
+
+
+def train_matrix_histories(train_matrix, user_ids, device, extra_items=()):
+    """
+    padded_histories of the users' rows of a CSR rating matrix, with extra_items added to every row
+    """
+    history = train_matrix[user_ids.cpu().numpy()]
+    histories = np.split(history.indices, history.indptr[1:-1])
+    if len(extra_items):
+        histories = [np.concatenate([items, np.asarray(extra_items, dtype=items.dtype)]) for items in histories]
+    return padded_histories(histories, device, train_matrix.shape[1])
+
+
+def in_history(history, candidates):
+    """
+    [batch num_candidates] bool, whether each candidate id is in its row of padded_histories
+    """
+    positions = torch.searchsorted(history, candidates).clamp_(max=history.size(1) - 1)
+    return history.gather(1, positions) == candidates
+
+
+class IVFIndex:
+    """
+    Inverted file index for maximum inner product search over the item embeddings.
+
+    Items are clustered with k-means into num_lists inverted lists. A query is scored
+    exactly against the items of the nprobe lists whose centroids have the highest inner
+    product with it, so the cost is about nprobe / num_lists of a full scoring; nprobe
+    trades speed for recall (nprobe = num_lists is exact). The padding id 0 and the mask id
+    are not indexed.
+
+    k-means lists are uneven (the longest is several times the mean), so probed lists are
+    scored one matmul each rather than gathered into a padded bmm. Each search still costs
+    a fixed overhead: on CPU, with nprobe 8, it only beats exact scoring from about 10^5
+    items on. At 20k items both take about 30 ms per batch of 256.
+    """
+
+    def __init__(self, item_embeddings, num_lists, nprobe=8, iters=10, seed=0, chunk_size=65536):
+        item_embeddings = item_embeddings.detach().float()
+        self.device = item_embeddings.device
+        self.item_size = item_embeddings.size(0)
+        self.nprobe = nprobe
+        self.chunk_size = chunk_size
+        item_ids = torch.arange(1, self.item_size - 1, device=self.device)
+        vectors = item_embeddings[item_ids]
+        num_lists = max(1, min(num_lists, vectors.size(0)))
+
+        # k-means on at most 256 items per list
+        generator = torch.Generator(device='cpu').manual_seed(seed)
+        sample = torch.randperm(vectors.size(0), generator=generator)[:256 * num_lists].to(self.device)
+        train_vectors = vectors[sample]
+        centroids = train_vectors[:num_lists].clone()
+        for _ in range(iters):
+            assignment = self._assign(train_vectors, centroids)
+            counts = torch.bincount(assignment, minlength=num_lists)
+            sums = torch.zeros_like(centroids).index_add_(0, assignment, train_vectors)
+            empty = counts == 0
+            centroids = sums / counts.clamp(min=1).unsqueeze(1).to(sums.dtype)
+            if empty.any():
+                # restart empty lists from random items
+                restart = torch.randint(train_vectors.size(0), (int(empty.sum()),), generator=generator)
+                centroids[empty] = train_vectors[restart.to(self.device)]
+        self.centroids = centroids
+
+        # items sorted by list, so every list is a contiguous block of list_embeddings
+        assignment = self._assign(vectors, centroids)
+        order = torch.argsort(assignment, stable=True)
+        self.list_lengths = torch.bincount(assignment, minlength=num_lists)
+        self.list_offsets = torch.cumsum(self.list_lengths, 0) - self.list_lengths
+        self.list_embeddings = vectors[order]
+        # padded inverted lists: [num_lists max_list_len] item ids, padded with the padding id 0
+        sorted_lists = assignment[order]
+        slots = torch.arange(order.size(0), device=self.device) - self.list_offsets[sorted_lists]
+        self.lists = torch.zeros(num_lists, int(self.list_lengths.max()), dtype=torch.long, device=self.device)
+        self.lists[sorted_lists, slots] = item_ids[order]
+
+    def _assign(self, vectors, centroids):
+        # nearest centroid by L2 distance, in chunks to bound the [items lists] distance matrix
+        centroid_norms = (centroids * centroids).sum(-1)
+        assignment = []
+        for start in range(0, vectors.size(0), self.chunk_size):
+            chunk = vectors[start:start + self.chunk_size]
+            assignment.append(torch.argmax(2 * chunk @ centroids.T - centroid_norms, dim=-1))
+        return torch.cat(assignment)
+
+    @property
+    def num_lists(self):
+        return self.lists.size(0)
+
+    def _score_probed_lists(self, queries, probes):
+        # one matmul per probed list against the queries probing it, instead of gathering
+        # [batch nprobe max_list_len hidden_size] item embeddings
+        nprobe = probes.size(1)
+        scores = queries.new_full((queries.size(0), nprobe, self.lists.size(1)), float('-inf'))
+        sorted_probes, pairs = torch.sort(probes.flatten())
+        lists, counts = torch.unique_consecutive(sorted_probes, return_counts=True)
+        starts = torch.cumsum(counts, 0) - counts
+        for list_id, start, count, offset, length in zip(
+                lists.tolist(), starts.tolist(), counts.tolist(),
+                self.list_offsets[lists].tolist(), self.list_lengths[lists].tolist()):
+            list_pairs = pairs[start:start + count]
+            rows, slots = list_pairs // nprobe, list_pairs % nprobe
+            scores[rows, slots, :length] = queries[rows] @ self.list_embeddings[offset:offset + length].T
+        return scores.flatten(1)
+
+    @torch.no_grad()
+    def search(self, queries, topk, history=None, nprobe=None):
+        """
+        queries: [batch hidden_size], history: padded_histories of items to exclude, or None
+        returns ([batch topk] item ids, [batch topk] scores); with too few candidates the tail
+        is filled with id 0 and -inf scores
+        """
+        queries = queries.float()
+        nprobe = min(nprobe or self.nprobe, self.num_lists)
+        probes = torch.topk(queries @ self.centroids.T, nprobe, dim=-1).indices
+        candidates = self.lists[probes].flatten(1)  # [batch nprobe*max_list_len]
+        scores = self._score_probed_lists(queries, probes)
+        if history is not None:
+            scores[in_history(history, candidates)] = float('-inf')
+        k = min(topk, candidates.size(1))
+        scores, positions = torch.topk(scores, k, dim=-1)
+        items = candidates.gather(1, positions)
+        items[scores == float('-inf')] = 0
+        if k < topk:
+            items = torch.cat([items, items.new_zeros(items.size(0), topk - k)], 1)
+            scores = torch.cat([scores, scores.new_full((scores.size(0), topk - k), float('-inf'))], 1)
+        return items, scores
+
+
+def blocked_topk(queries, item_embeddings, topk, block_size, history=None):
+    """
+    exact top-k over the item table scored in blocks of block_size items: each block keeps
+    its own top-k (history items set to -inf first) and the [batch num_blocks*topk] block
+    winners are merged, so the largest score matrix is [batch block_size]
+    """
+    queries = queries.float()
+    item_size = item_embeddings.size(0)
+    if history is not None:
+        rows = torch.arange(history.size(0), device=history.device).unsqueeze(1).expand_as(history)
+    block_items, block_scores = [], []
+    for start in range(0, item_size, block_size):
+        scores = queries @ item_embeddings[start:start + block_size].float().T
+        if history is not None:
+            in_block = (history >= start) & (history < start + scores.size(1))
+            scores[rows[in_block], history[in_block] - start] = float('-inf')
+        scores, items = torch.topk(scores, min(topk, scores.size(1)), dim=-1)
+        block_scores.append(scores)
+        block_items.append(items + start)
+    scores, positions = torch.topk(torch.cat(block_scores, 1), topk, dim=-1)
+    return torch.cat(block_items, 1).gather(1, positions), scores
+
+
+def exact_topk(queries, item_embeddings, topk, history=None):
+    """
+    reference top-k over the whole table with the same exclusions as IVFIndex.search
+    """
+    scores = queries.float() @ item_embeddings.float().T
+    scores[:, 0] = float('-inf')
+    scores[:, -1] = float('-inf')
+    if history is not None:
+        rows = torch.arange(history.size(0), device=history.device).unsqueeze(1).expand_as(history)
+        valid = history < scores.size(1)
+        scores[rows[valid], history[valid]] = float('-inf')
+    scores, items = torch.topk(scores, topk, dim=-1)
+    return items, scores
+
+
+def recall_vs_exact(approx_items, exact_items):
+    """
+    mean fraction of the exact top-k found by the approximate search
+    """
+    k = exact_items.size(1)
+    hits = (approx_items.unsqueeze(2) == exact_items.unsqueeze(1)).any(1).sum(-1)
+    return (hits.float() / k).mean().item()
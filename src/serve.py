@@ -0,0 +1,322 @@
+# -*- coding: utf-8 -*-
+"""
+Local top-N recommendation server for a trained checkpoint.
+
+    python serve.py --checkpoint output/MoCo4SRec-Beauty.pt --port 8080
+    curl -d '{"sequence": [12, 7, 431], "topn": 10}' localhost:8080/recommend
+    curl localhost:8080/stats
+
+Concurrent requests are coalesced into micro-batches: the batching thread waits at most
+--max_wait_ms after the first queued request (or until --max_batch requests) and runs one
+forward and one item scoring for the whole batch.
+"""
+
+import argparse
+import json
+import os
+import queue
+import socketserver
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import torch
+
+from export import load_inference_model, load_checkpoint_for_inference
+from quantization import quantize_encoder, QuantizedItemTable
+from retrieval import IVFIndex, blocked_topk, padded_histories
+from utils import configure_cpu_threads
+
+
+def load_model(path, device, fused_ops=False, **given):
+    """
+    query-path model from an export.py directory, or from a trainer checkpoint (sizes read
+    from the tensor shapes, heads, activation and position anchor from its saved training
+    args); given values (None: not given) must match the model's
+    """
+    if os.path.isdir(path):
+        return load_inference_model(path, device, fused_ops, **given)
+    return load_checkpoint_for_inference(path, device, fused_ops, **given)
+
+
+class Recommender:
+    """
+    batched top-N over the whole item set, through ann_index if given, or scored in blocks
+    of a reduced precision item_table if given: the padding and mask ids are never
+    recommended, and with exclude_seen neither are the items of the request's own sequence
+    """
+
+    def __init__(self, model, ann_index=None, item_table=None, block_size=65536):
+        self.model = model
+        self.ann_index = ann_index
+        self.item_table = item_table
+        self.block_size = block_size
+        self.item_size = model.args.item_size
+
+    @torch.no_grad()
+    def recommend(self, sequences, topn, exclude_seen):
+        seq_out = self.model.encode_sequences(sequences)
+        if self.ann_index is not None:
+            history = padded_histories([items if exclude else [] for items, exclude in zip(sequences, exclude_seen)],
+                                       seq_out.device, self.item_size)
+            items, scores = self.ann_index.search(seq_out.float(), topn, history)
+            return items.cpu().numpy(), scores.cpu().numpy()
+        if self.item_table is not None:
+            history = padded_histories([(items if exclude else []) + [0, self.item_size - 1]
+                                        for items, exclude in zip(sequences, exclude_seen)],
+                                       seq_out.device, self.item_size)
+            items, scores = blocked_topk(seq_out.float(), self.item_table, min(topn, self.item_size - 2),
+                                         self.block_size, history)
+            return items.cpu().numpy(), scores.cpu().numpy()
+        rating_pred = torch.matmul(seq_out, self.model.item_embeddings.weight.transpose(0, 1))
+        rating_pred[:, 0] = float('-inf')
+        rating_pred[:, self.item_size - 1] = float('-inf')
+        rows, cols = [], []
+        for row, (items, exclude) in enumerate(zip(sequences, exclude_seen)):
+            if exclude:
+                rows.extend([row] * len(items))
+                cols.extend(items)
+        if rows:
+            rating_pred[torch.tensor(rows, device=rating_pred.device),
+                        torch.tensor(cols, device=rating_pred.device)] = float('-inf')
+        topn = min(topn, self.item_size - 2)
+        scores, items = torch.topk(rating_pred, topn, dim=-1)
+        return items.cpu().numpy(), scores.float().cpu().numpy()
+
+
+class _Request:
+    def __init__(self, sequence, topn, exclude_seen):
+        self.sequence = sequence
+        self.topn = topn
+        self.exclude_seen = exclude_seen
+        self.arrival = time.perf_counter()
+        self.done = threading.Event()
+        self.items = None
+        self.scores = None
+        self.error = None
+
+
+class MicroBatcher:
+    """
+    a single thread drains the request queue into batches of up to max_batch requests,
+    waiting at most max_wait_ms after the first one, and keeps latency statistics
+    """
+
+    def __init__(self, recommender, max_batch=64, max_wait_ms=2.0, stats_window=10000):
+        self.recommender = recommender
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000.0
+        self.requests = queue.Queue()
+        self.latencies = deque(maxlen=stats_window)
+        self.batch_sizes = deque(maxlen=stats_window)
+        self.num_requests = 0
+        self.start_time = time.perf_counter()
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, sequence, topn=10, exclude_seen=True):
+        request = _Request(sequence, topn, exclude_seen)
+        self.requests.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.items, request.scores
+
+    def _next_batch(self):
+        batch = [self.requests.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.perf_counter()
+            try:
+                batch.append(self.requests.get(timeout=timeout) if timeout > 0 else self.requests.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                items, scores = self.recommender.recommend([request.sequence for request in batch],
+                                                           max(request.topn for request in batch),
+                                                           [request.exclude_seen for request in batch])
+                for row, request in enumerate(batch):
+                    # with fewer unseen candidates than topn the tail is masked items scored -inf,
+                    # which is not valid JSON: return only the candidates that were found
+                    found = np.isfinite(scores[row, :request.topn])
+                    request.items = items[row, :request.topn][found].tolist()
+                    request.scores = scores[row, :request.topn][found].tolist()
+            except Exception as e:
+                for request in batch:
+                    request.error = e
+            finished = time.perf_counter()
+            with self.lock:
+                self.num_requests += len(batch)
+                self.batch_sizes.append(len(batch))
+                self.latencies.extend(finished - request.arrival for request in batch)
+            for request in batch:
+                request.done.set()
+
+    def stats(self):
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000.0
+            batch_sizes = np.array(self.batch_sizes)
+            num_requests = self.num_requests
+        elapsed = time.perf_counter() - self.start_time
+        stats = {"requests": num_requests, "throughput_rps": num_requests / elapsed}
+        if len(latencies):
+            stats.update({
+                "latency_p50_ms": float(np.percentile(latencies, 50)),
+                "latency_p99_ms": float(np.percentile(latencies, 99)),
+                "mean_batch_size": float(batch_sizes.mean()),
+            })
+        return stats
+
+    def reset_stats(self):
+        with self.lock:
+            self.latencies.clear()
+            self.batch_sizes.clear()
+            self.num_requests = 0
+            self.start_time = time.perf_counter()
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    """
+    POST /recommend {"sequence": [item ids, oldest first], "topn": 10, "exclude_seen": true},
+    answers with at most topn items, fewer when the unseen items run out
+    GET /stats, POST /stats/reset
+    """
+
+    def _reply(self, code, body):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == '/stats':
+            self._reply(200, self.server.batcher.stats())
+        else:
+            self._reply(404, {"error": "unknown path " + self.path})
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length)
+        if self.path == '/stats/reset':
+            self.server.batcher.reset_stats()
+            self._reply(200, {})
+            return
+        if self.path != '/recommend':
+            self._reply(404, {"error": "unknown path " + self.path})
+            return
+        try:
+            request = json.loads(body)
+            sequence = [int(item) for item in request['sequence']]
+            topn = int(request.get('topn', 10))
+            exclude_seen = bool(request.get('exclude_seen', True))
+            item_size = self.server.batcher.recommender.item_size
+            if not sequence or topn < 1 or min(sequence) < 1 or max(sequence) > item_size - 2:
+                raise ValueError(f"sequence needs item ids in [1, {item_size - 2}] and topn >= 1")
+        except (KeyError, TypeError, ValueError) as e:
+            self._reply(400, {"error": str(e)})
+            return
+        items, scores = self.server.batcher.submit(sequence, topn, exclude_seen)
+        self._reply(200, {"items": items, "scores": scores})
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return str(self.client_address[0]) if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ThreadingTCPHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # the default listen backlog of 5 resets connections under many concurrent clients
+    request_queue_size = 1024
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+        socketserver.UnixStreamServer.server_bind(self)
+        self.server_name = 'localhost'
+        self.server_port = 0
+
+
+def build_server(batcher, host='127.0.0.1', port=8080, unix_socket=''):
+    if unix_socket:
+        server = ThreadingUnixHTTPServer(unix_socket, RequestHandler)
+    else:
+        server = ThreadingTCPHTTPServer((host, port), RequestHandler)
+    server.batcher = batcher
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--checkpoint', required=True, type=str,
+                        help="state dict saved by the trainer, or a directory written by export.py")
+    # only needed for checkpoints saved without <checkpoint>.args.json, must match it otherwise
+    parser.add_argument('--num_attention_heads', default=None, type=int)
+    parser.add_argument('--hidden_act', default=None, type=str)
+    parser.add_argument('--fused_ops', action='store_true')
+    parser.add_argument('--host', default='127.0.0.1', type=str)
+    parser.add_argument('--port', default=8080, type=int)
+    parser.add_argument('--unix_socket', default='', type=str, help="serve on this Unix socket path instead of TCP")
+    parser.add_argument('--max_batch', default=64, type=int, help="most requests coalesced into one forward")
+    parser.add_argument('--max_wait_ms', default=2.0, type=float,
+                        help="how long the first request of a batch waits for more to arrive")
+    parser.add_argument('--ann_lists', default=0, type=int,
+                        help="retrieve through an IVF index with this many lists, 0: exact scoring")
+    parser.add_argument('--ann_nprobe', default=8, type=int, help="lists scored per request with --ann_lists")
+    parser.add_argument('--quantize', action='store_true', help="dynamic int8 Linear layers in the encoder (CPU)")
+    parser.add_argument('--item_table', default='fp32', type=str, choices=['fp32', 'fp16', 'int8'],
+                        help="precision of the item table for exact scoring, int8 uses per-row scales")
+    parser.add_argument("--no_cuda", action="store_true")
+    parser.add_argument("--num_threads", type=int, default=0)
+    parser.add_argument("--num_interop_threads", type=int, default=0)
+    args = parser.parse_args()
+
+    # dynamic int8 Linear kernels only run on the CPU: the model, item table and histories stay there
+    args.cuda_condition = torch.cuda.is_available() and not args.no_cuda and not args.quantize
+    args.num_workers = 0
+    configure_cpu_threads(args)
+    device = torch.device("cuda" if args.cuda_condition else "cpu")
+    model = load_model(args.checkpoint, device, args.fused_ops, num_attention_heads=args.num_attention_heads,
+                       hidden_act=args.hidden_act)
+    print(f"loaded {args.checkpoint}: {model.args.item_size} items, {model.args.num_hidden_layers} layers, "
+          f"max_seq_length {model.args.max_seq_length}")
+
+    item_table = None
+    if args.item_table != 'fp32':
+        item_table = QuantizedItemTable(model.item_embeddings.weight, args.item_table)
+    if args.quantize:
+        model = quantize_encoder(model)
+    ann_index = None
+    if args.ann_lists > 0:
+        ann_index = IVFIndex(model.item_embeddings.weight, args.ann_lists, args.ann_nprobe)
+    batcher = MicroBatcher(Recommender(model, ann_index, item_table), args.max_batch, args.max_wait_ms)
+    server = build_server(batcher, args.host, args.port, args.unix_socket)
+    print("serving on", args.unix_socket or f"http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(json.dumps(batcher.stats()))
+
+
+if __name__ == '__main__':
+    main()
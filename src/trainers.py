@@ -8,10 +8,12 @@ import torch
 import torch.nn as nn
 from torch.optim import Adam, lr_scheduler
 
-from torch.utils.data import DataLoader, RandomSampler
-from datasets import RecWithContrastiveLearningDataset
+from datasets import RecWithContrastiveLearningDataset, build_dataloader
 from modules import NCELoss, NTXent
-from utils import recall_at_k, ndcg_k, get_metric, get_user_seqs, nCr
+from profiling import build_profiler, profile_range
+from retrieval import IVFIndex, blocked_topk, pack_candidates, train_matrix_histories
+from utils import FullSortMetricAccumulator, SampleMetricAccumulator, PhaseTimer, get_user_seqs, nCr, \
+    compile_with_fallback
 
 
 class Trainer:
@@ -32,9 +34,8 @@ class Trainer:
         self.projection = nn.Sequential(nn.Linear(self.args.max_seq_length * self.args.hidden_size,
                                                   512, bias=False), nn.BatchNorm1d(512), nn.ReLU(inplace=True),
                                         nn.Linear(512, self.args.hidden_size, bias=True))
-        if self.cuda_condition:
-            self.model.cuda()
-            self.projection.cuda()
+        self.model.to(self.device)
+        self.projection.to(self.device)
         # Setting the train and test data loader
         self.train_dataloader = train_dataloader
         self.eval_dataloader = eval_dataloader
@@ -42,9 +43,11 @@ class Trainer:
 
         # self.data_name = self.args.data_name
         betas = (self.args.adam_beta1, self.args.adam_beta2)
-        self.optim = Adam(self.model.parameters(), lr=self.args.lr, betas=betas,
-                          weight_decay=self.args.weight_decay)
-        self.scheduler = lr_scheduler.CosineAnnealingLR(self.optim, args.epochs, eta_min=self.args.sch_min)
+        if not self.model.inference_only:
+            # an evaluation-only model is never optimized (constructing Adam alone costs seconds of imports)
+            self.optim = Adam(self.model.parameters(), lr=self.args.lr, betas=betas,
+                              weight_decay=self.args.weight_decay)
+            self.scheduler = lr_scheduler.CosineAnnealingLR(self.optim, args.epochs, eta_min=self.args.sch_min)
 
         # self.optim = Adam(self.model.transformer_encoder.parameters(), lr=self.args.lr, betas=betas,
         #                   weight_decay=self.args.weight_decay)
@@ -59,9 +62,32 @@ class Trainer:
         # print("MoCo Parameters:", sum([p.nelement() for p in self.model.moco_encoder.parameters()]))
 
         self.cf_criterion = NCELoss(self.args.temperature, self.device)
+        self.moco_criterion = nn.CrossEntropyLoss().to(self.device)
+
+        self.phase_timer = PhaseTimer(self.args.phase_timing, self.device)
+        self.model.phase_timer = self.phase_timer
+        # --profile covers the first training epoch and the first evaluation pass
+        self.train_profiled = self.eval_profiled = not self.args.profile
+        # IVF index of --ann_lists and the item embedding version it was built from
+        self.ann_index, self.ann_index_version = None, None
+
+        if self.args.compile:
+            cache_dir = self.args.compile_cache_dir
+            self.model.transformer_encoder = compile_with_fallback(self.model.transformer_encoder,
+                                                                   'transformer_encoder', cache_dir)
+            self.cross_entropy = compile_with_fallback(self.cross_entropy, 'cross_entropy', cache_dir)
+            self.cf_criterion = compile_with_fallback(self.cf_criterion, 'NCELoss', cache_dir)
         # # self.cf_criterion = NTXent()
         # print("self.cf_criterion:", self.cf_criterion.__class__.__name__)
 
+    def autocast(self):
+        """
+        mixed precision context for the encoder forwards, a no-op for fp32.
+        parameters (and therefore the Adam states) stay in fp32.
+        """
+        return torch.autocast(device_type=self.device.type, dtype=torch.bfloat16,
+                              enabled=self.args.precision == 'bf16')
+
     def __refresh_training_dataset(self, item_embeddings):
         """
         use for updating item embedding
@@ -71,8 +97,7 @@ class Trainer:
         # training data for node classification
         train_dataset = RecWithContrastiveLearningDataset(self.args, user_seq,
                                                           data_type='train', similarity_model_type='hybrid')
-        train_sampler = RandomSampler(train_dataset)
-        train_dataloader = DataLoader(train_dataset, sampler=train_sampler, batch_size=self.args.batch_size)
+        train_dataloader = build_dataloader(self.args, train_dataset, shuffle=True)
         return train_dataloader
 
     def train(self, epoch):
@@ -80,22 +105,37 @@ class Trainer:
         if epoch > self.args.augmentation_warm_up_epoches:
             print("refresh dataset with updated item embedding")
             self.train_dataloader = self.__refresh_training_dataset(self.model.item_embeddings)
-        self.iteration(epoch, self.train_dataloader)
+        if not self.train_profiled:
+            self.train_profiled = True
+            window = self.args.profile_wait + 1 + self.args.profile_steps
+            if len(self.train_dataloader) < window:
+                print(f"warning: the profile window needs {window} steps, an epoch has {len(self.train_dataloader)}")
+            with build_profiler(self.args, 'train', self.device) as profiler:
+                self.iteration(epoch, self.train_dataloader, profiler=profiler)
+        else:
+            self.iteration(epoch, self.train_dataloader)
 
     def valid(self, epoch, full_sort=False):
-        return self.iteration(epoch, self.eval_dataloader, full_sort=full_sort, train=False)
+        return self.evaluate(epoch, self.eval_dataloader, full_sort)
 
     def test(self, epoch, full_sort=False):
-        return self.iteration(epoch, self.test_dataloader, full_sort=full_sort, train=False)
+        return self.evaluate(epoch, self.test_dataloader, full_sort)
+
+    def evaluate(self, epoch, dataloader, full_sort):
+        if not self.eval_profiled:
+            self.eval_profiled = True
+            with build_profiler(self.args, 'eval', self.device, steps=False):
+                return self.iteration(epoch, dataloader, full_sort=full_sort, train=False)
+        return self.iteration(epoch, dataloader, full_sort=full_sort, train=False)
 
-    def iteration(self, epoch, dataloader, full_sort=False, train=True):
+    def iteration(self, epoch, dataloader, full_sort=False, train=True, profiler=None):
         raise NotImplementedError
 
-    def get_sample_scores(self, epoch, pred_list):
-        pred_list = (-pred_list).argsort().argsort()[:, 0]
-        HIT_1, NDCG_1, MRR = get_metric(pred_list, 1)
-        HIT_5, NDCG_5, MRR = get_metric(pred_list, 5)
-        HIT_10, NDCG_10, MRR = get_metric(pred_list, 10)
+    def get_sample_scores(self, epoch, metrics):
+        HIT_1, NDCG_1 = metrics['HIT@1'], metrics['NDCG@1']
+        HIT_5, NDCG_5 = metrics['HIT@5'], metrics['NDCG@5']
+        HIT_10, NDCG_10 = metrics['HIT@10'], metrics['NDCG@10']
+        MRR = metrics['MRR']
         post_fix = {
             "Epoch": epoch,
             "HIT@1": '{:.4f}'.format(HIT_1), "NDCG@1": '{:.4f}'.format(NDCG_1),
@@ -108,28 +148,44 @@ class Trainer:
             f.write(str(post_fix) + '\n')
         return [HIT_1, NDCG_1, HIT_5, NDCG_5, HIT_10, NDCG_10, MRR], str(post_fix)
 
-    def get_full_sort_score(self, epoch, answers, pred_list):
-        recall, ndcg = [], []
-        for k in [5, 10, 15, 20]:
-            recall.append(recall_at_k(answers, pred_list, k))
-            ndcg.append(ndcg_k(answers, pred_list, k))
+    def get_full_sort_score(self, epoch, metrics):
         post_fix = {
             "Epoch": epoch,
-            "HIT@5": '{:.4f}'.format(recall[0]), "NDCG@5": '{:.4f}'.format(ndcg[0]),
-            "HIT@10": '{:.4f}'.format(recall[1]), "NDCG@10": '{:.4f}'.format(ndcg[1]),
-            "HIT@20": '{:.4f}'.format(recall[3]), "NDCG@20": '{:.4f}'.format(ndcg[3])
+            "HIT@5": '{:.4f}'.format(metrics['HIT@5']), "NDCG@5": '{:.4f}'.format(metrics['NDCG@5']),
+            "HIT@10": '{:.4f}'.format(metrics['HIT@10']), "NDCG@10": '{:.4f}'.format(metrics['NDCG@10']),
+            "HIT@20": '{:.4f}'.format(metrics['HIT@20']), "NDCG@20": '{:.4f}'.format(metrics['NDCG@20']),
+            "MRR@20": '{:.4f}'.format(metrics['MRR@20'])
         }
         print(post_fix)
         with open(self.args.log_file, 'a') as f:
             f.write(str(post_fix) + '\n')
-        return [recall[0], ndcg[0], recall[1], ndcg[1], recall[3], ndcg[3]], str(post_fix)
+        return [metrics['HIT@5'], metrics['NDCG@5'], metrics['HIT@10'], metrics['NDCG@10'],
+                metrics['HIT@20'], metrics['NDCG@20']], str(post_fix)
+
+    def log_phase_times(self, epoch):
+        """
+        print and log the per-step time of each training phase over the epoch, then start over
+        """
+        summary = self.phase_timer.summary()
+        print(f"phase times over {self.phase_timer.num_steps} steps (ms per step):")
+        for name, times in sorted(summary.items(), key=lambda item: -item[1]['mean_ms']):
+            print(f"  {name:<16} mean {times['mean_ms']:9.3f}  p50 {times['p50_ms']:9.3f}  "
+                  f"p90 {times['p90_ms']:9.3f}  p99 {times['p99_ms']:9.3f}  {times['share'] * 100:5.1f}%")
+        with open(self.args.log_file, 'a') as f:
+            f.write(str({"epoch": epoch, "phase_times": summary}) + '\n')
+        self.phase_timer.reset()
 
     def save(self, file_name):
         torch.save(self.model.cpu().state_dict(), file_name)
         self.model.to(self.device)
 
     def load(self, file_name):
-        self.model.load_state_dict(torch.load(file_name))
+        state_dict = torch.load(file_name, map_location=self.device)
+        if self.model.inference_only:
+            # the checkpoint also holds the key encoder, queue and projection head
+            model_keys = self.model.state_dict().keys()
+            state_dict = {name: tensor for name, tensor in state_dict.items() if name in model_keys}
+        self.model.load_state_dict(state_dict)
 
     def cross_entropy(self, seq_out, pos_ids, neg_ids):
         # [batch seq_len hidden_size]
@@ -141,7 +197,7 @@ class Trainer:
         seq_emb = seq_out.view(-1, self.args.hidden_size)  # [batch*seq_len hidden_size]
         pos_logits = torch.sum(pos * seq_emb, -1)  # [batch*seq_len]
         neg_logits = torch.sum(neg * seq_emb, -1)
-        istarget = (pos_ids > 0).view(pos_ids.size(0) * self.model.args.max_seq_length).float()  # [batch*seq_len]
+        istarget = (pos_ids > 0).view(-1).float()  # [batch*seq_len]
         loss = torch.sum(
             - torch.log(torch.sigmoid(pos_logits) + 1e-24) * istarget -
             torch.log(1 - torch.sigmoid(neg_logits) + 1e-24) * istarget
@@ -150,11 +206,63 @@ class Trainer:
         return loss
 
     def predict_sample(self, seq_out, test_neg_sample):
-        # [batch 100 hidden_size]
-        test_item_emb = self.model.item_embeddings(test_neg_sample)
-        # [batch hidden_size]
-        test_logits = torch.bmm(test_item_emb, seq_out.unsqueeze(-1)).squeeze(-1)  # [B 100]
-        return test_logits
+        # [batch 100]
+        return self.model.score_candidates(seq_out, test_neg_sample)
+
+    @torch.no_grad()
+    def rerank(self, sequences, candidates):
+        """
+        re-rank ragged candidate lists for the given item sequences (oldest first). candidates
+        are packed into one padded [batch max_candidates] tensor and scored with one bmm per
+        batch_size users; returns, per user, (candidate ids sorted by score, their scores)
+        """
+        was_training = self.model.training
+        self.model.eval()
+        ranked = []
+        try:
+            for start in range(0, len(sequences), self.args.batch_size):
+                with self.autocast():
+                    seq_out = self.model.encode_sequences(sequences[start:start + self.args.batch_size])
+                candidate_ids, candidate_mask = pack_candidates(candidates[start:start + self.args.batch_size],
+                                                                self.device)
+                scores = self.model.score_candidates(seq_out.float(), candidate_ids, candidate_mask)
+                scores, order = torch.sort(scores, dim=-1, descending=True)
+                items = candidate_ids.gather(1, order).cpu().numpy()
+                scores = scores.cpu().numpy()
+                for row, length in enumerate(candidate_mask.sum(-1).tolist()):
+                    ranked.append((items[row, :length], scores[row, :length]))
+        finally:
+            # callers in the middle of training get their model back in train mode
+            self.model.train(was_training)
+        return ranked
+
+    def full_sort_topk(self, rating_pred, user_ids, topk=20):
+        """
+        rank on the model's device: the users' items in train_matrix are set to -inf straight
+        from its CSR indices, as are the padding id 0 and the mask id, and only the
+        [batch topk] item ids are copied to the host
+        """
+        rating_pred[:, 0] = float('-inf')
+        rating_pred[:, self.args.item_size - 1] = float('-inf')
+        history = self.args.train_matrix[user_ids.cpu().numpy()]
+        rows = np.repeat(np.arange(history.shape[0]), np.diff(history.indptr))
+        rows = torch.from_numpy(rows).to(self.device)
+        cols = torch.from_numpy(history.indices).to(self.device, dtype=torch.long)
+        rating_pred[rows, cols] = float('-inf')
+        return torch.topk(rating_pred, topk, dim=-1).indices.cpu().numpy()
+
+    def build_ann_index(self):
+        """
+        IVF index over the current item embeddings for approximate full-sort evaluation, rebuilt
+        only when they changed since the last build: optimizer steps and loading a checkpoint
+        write the weight in place, which bumps its version counter
+        """
+        weight = self.model.item_embeddings.weight
+        version = (weight.data_ptr(), weight._version)
+        if self.ann_index is None or self.ann_index_version != version:
+            self.ann_index = IVFIndex(weight, self.args.ann_lists, self.args.ann_nprobe)
+            self.ann_index_version = version
+        return self.ann_index
 
     def predict_full(self, seq_out):
         # [item_num hidden_size]
@@ -186,7 +294,9 @@ class MoCo4SRecTrainer(Trainer):
         """
         cl_batch = torch.cat(inputs, dim=0)
         cl_batch = cl_batch.to(self.device)
-        cl_sequence_output = self.model.transformer_encoder(cl_batch, cutoff=cutoff, shuffle=shuffle, noise=noise)
+        with self.autocast():
+            cl_sequence_output = self.model.transformer_encoder(cl_batch, cutoff=cutoff, shuffle=shuffle, noise=noise)
+            cl_sequence_output = self.model.pad_sequence_output(cl_sequence_output, cl_batch)
         # cf_sequence_output = cf_sequence_output[:, -1, :]
         cl_sequence_flatten = cl_sequence_output.view(cl_batch.shape[0], -1)
         # cf_output = self.projection(cf_sequence_flatten)
@@ -203,26 +313,30 @@ class MoCo4SRecTrainer(Trainer):
         """
         inputs[0] = inputs[0].to(self.device)
         inputs[1] = inputs[1].to(self.device)
-        cl_sequence_output1 = self.model.transformer_encoder(inputs[0], cutoff=cutoff, shuffle=shuffle, noise=noise)
-        cl_sequence_flatten1 = cl_sequence_output1.view(inputs[0].shape[0], -1)
-        cl_sequence_output2 = self.model.transformer_encoder(inputs[1], cutoff=cutoff, shuffle=shuffle, noise=noise)
-        cl_sequence_flatten2 = cl_sequence_output2.view(inputs[1].shape[0], -1)
-
-        cl_loss = self.cf_criterion(cl_sequence_flatten1,
-                                    cl_sequence_flatten2)
+        with self.autocast():
+            cl_sequence_output1 = self.model.transformer_encoder(inputs[0], cutoff=cutoff, shuffle=shuffle, noise=noise)
+            cl_sequence_output1 = self.model.pad_sequence_output(cl_sequence_output1, inputs[0])
+            cl_sequence_flatten1 = cl_sequence_output1.view(inputs[0].shape[0], -1)
+            cl_sequence_output2 = self.model.transformer_encoder(inputs[1], cutoff=cutoff, shuffle=shuffle, noise=noise)
+            cl_sequence_output2 = self.model.pad_sequence_output(cl_sequence_output2, inputs[1])
+            cl_sequence_flatten2 = cl_sequence_output2.view(inputs[1].shape[0], -1)
+
+            cl_loss = self.cf_criterion(cl_sequence_flatten1,
+                                        cl_sequence_flatten2)
         return cl_loss
 
     def _debias_loss(self, cl_output_slice):
 
         z1, z2 = cl_output_slice[0], cl_output_slice[1]
         batch_size, hidden_size = z2.size()
-        z_negative = torch.randn([int(batch_size * self.args.noise_times), hidden_size]).cuda()  # * variation + avg
+        z_negative = torch.randn([int(batch_size * self.args.noise_times), hidden_size],
+                                 device=self.device)  # * variation + avg
         z_negative.requires_grad = True
 
         cos = nn.CosineSimilarity(dim=1, eps=1e-6)
         cos_sim = cos(z1, z2)
         cos_sim_diag = torch.diag(cos_sim)
-        labels = torch.arange(cos_sim.size(0)).long().cuda()
+        labels = torch.arange(cos_sim.size(0), dtype=torch.long, device=self.device)
         loss_fct = nn.CrossEntropyLoss()
 
         for _ in range(self.args.pgd):
@@ -268,6 +382,7 @@ class MoCo4SRecTrainer(Trainer):
         cl_batch = torch.cat(inputs, dim=0)
         cl_batch = cl_batch.to(self.device)
         cl_sequence_output = self.model.transformer_encoder(cl_batch)
+        cl_sequence_output = self.model.pad_sequence_output(cl_sequence_output, cl_batch)
         # cf_sequence_output = cf_sequence_output[:, -1, :]
         cl_sequence_flatten = cl_sequence_output.view(cl_batch.shape[0], -1)
         # cf_output = self.projection(cf_sequence_flatten)
@@ -285,13 +400,19 @@ class MoCo4SRecTrainer(Trainer):
         """
         moco_batch = torch.cat(inputs, dim=0)
         moco_batch = moco_batch.to(self.device)
-        moco_logits, moco_labels = self.model.moco_trans_encoder(moco_batch, cutoff=cutoff, shuffle=shuffle, noise=noise)
-        criterion = nn.CrossEntropyLoss().cuda(0)
-        moco_loss = criterion(moco_logits,
-                              moco_labels)
+        with self.autocast():
+            moco_logits, moco_labels = self.model.moco_trans_encoder(moco_batch, cutoff=cutoff, shuffle=shuffle, noise=noise)
+        moco_loss = self.moco_criterion(moco_logits,
+                                        moco_labels)
         return moco_loss
 
-    def iteration(self, epoch, dataloader, full_sort=True, train=True):
+    def _after_optimizer_step(self):
+        """
+        hook run once per optimizer step: the key encoder follows the updated query encoder
+        """
+        self.model._momentum_update_key_encoder()
+
+    def iteration(self, epoch, dataloader, full_sort=True, train=True, profiler=None):
 
         str_code = "train" if train else "test"
 
@@ -308,7 +429,10 @@ class MoCo4SRecTrainer(Trainer):
 
             print(f"rec dataset length: {len(dataloader)}")
             rec_cf_data_iter = tqdm(enumerate(dataloader), total=len(dataloader))
+            timer = self.phase_timer
 
+            # 'data' covers waiting for the next batch from the loader and copying it to the device
+            timer.start('data')
             for i, (rec_batch, cl_batches, moco_batches) in rec_cf_data_iter:
                 """
                 rec_batch shape: key_name x batch_size x feature_dim
@@ -318,42 +442,58 @@ class MoCo4SRecTrainer(Trainer):
                 # 0. batch_data will be sent into the device(GPU or CPU)
                 rec_batch = tuple(t.to(self.device) for t in rec_batch)
                 _, input_ids, target_pos, target_neg, _ = rec_batch
+                timer.stop('data')
 
                 # ---------- recommendation task ---------------#
-                sequence_output = self.model.transformer_encoder(input_ids, cutoff=self.args.cutoff, shuffle=self.args.token_shuffle, noise=self.args.guassian_noise)
-                rec_loss = self.cross_entropy(sequence_output, target_pos, target_neg)
+                with timer.phase('rec forward'), profile_range('rec'):
+                    with self.autocast():
+                        sequence_output = self.model.transformer_encoder(input_ids, cutoff=self.args.cutoff, shuffle=self.args.token_shuffle, noise=self.args.guassian_noise)
+                    rec_loss = self.cross_entropy(sequence_output.float(), target_pos, target_neg)
 
                 # ---------- contrastive learning task -------------#
                 cl_losses = []
-                for cl_batch in cl_batches:
-                    cl_loss = self._one_pair_contrastive_learning_sep(cl_batch, cutoff=self.args.cutoff, shuffle=self.args.token_shuffle, noise=self.args.guassian_noise)
-                    cl_losses.append(cl_loss)
+                with timer.phase('cl forward'), profile_range('cl'):
+                    for cl_batch in cl_batches:
+                        cl_loss = self._one_pair_contrastive_learning_sep(cl_batch, cutoff=self.args.cutoff, shuffle=self.args.token_shuffle, noise=self.args.guassian_noise)
+                        cl_losses.append(cl_loss)
 
                 moco_losses = []
-                for moco_batch in moco_batches:
-                    moco_loss = self._moco_pair_contrastive_learning(moco_batch, cutoff=self.args.cutoff, shuffle=self.args.token_shuffle, noise=self.args.guassian_noise)
-                    # moco_loss = self._debias_contrastive_learning(moco_batch)
-                    moco_losses.append(moco_loss)
+                with timer.phase('moco forward'), profile_range('moco'):
+                    for moco_batch in moco_batches:
+                        moco_loss = self._moco_pair_contrastive_learning(moco_batch, cutoff=self.args.cutoff, shuffle=self.args.token_shuffle, noise=self.args.guassian_noise)
+                        # moco_loss = self._debias_contrastive_learning(moco_batch)
+                        moco_losses.append(moco_loss)
 
                 joint_loss = self.args.rec_weight * rec_loss
                 for cl_loss in cl_losses:
                     joint_loss += self.args.cl_weight * cl_loss
                 for moco_loss in moco_losses:
                     joint_loss += self.args.moco_weight * moco_loss
-                self.optim.zero_grad()
-                joint_loss.backward()
-                self.optim.step()
-
-                rec_avg_loss += rec_loss.item()
-
-                for i, cl_loss in enumerate(cl_losses):
-                    cl_individual_avg_losses[i] += cl_loss.item()
-                    cl_sum_avg_loss += cl_loss.item()
-                for i, moco_loss in enumerate(moco_losses):
-                    moco_individual_avg_losses[i] += moco_loss.item()
-                    moco_sum_avg_loss += moco_loss.item()
-
-                joint_avg_loss += joint_loss.item()
+                with timer.phase('backward'):
+                    self.optim.zero_grad()
+                    joint_loss.backward()
+                with timer.phase('optimizer step'):
+                    self.optim.step()
+                with timer.phase('ema update'):
+                    self._after_optimizer_step()
+
+                with timer.phase('bookkeeping'):
+                    rec_avg_loss += rec_loss.item()
+
+                    for i, cl_loss in enumerate(cl_losses):
+                        cl_individual_avg_losses[i] += cl_loss.item()
+                        cl_sum_avg_loss += cl_loss.item()
+                    for i, moco_loss in enumerate(moco_losses):
+                        moco_individual_avg_losses[i] += moco_loss.item()
+                        moco_sum_avg_loss += moco_loss.item()
+
+                    joint_avg_loss += joint_loss.item()
+                timer.end_step()
+                if profiler is not None:
+                    profiler.step()
+                timer.start('data')
+            # the wait after the last batch is the loader shutting down, not a step
+            timer.cancel('data')
 
             self.scheduler.step()
 
@@ -379,6 +519,9 @@ class MoCo4SRecTrainer(Trainer):
             with open(self.args.log_file, 'a') as f:
                 f.write(str(post_fix) + '\n')
 
+            if timer.enabled:
+                self.log_phase_times(epoch)
+
         else:
             rec_data_iter = tqdm(enumerate(dataloader),
                                  desc="Recommendation EP_%s:%d" % (str_code, epoch),
@@ -386,53 +529,51 @@ class MoCo4SRecTrainer(Trainer):
                                  bar_format="{l_bar}{r_bar}")
             self.model.eval()
 
-            pred_list = None
-
             if full_sort:
-                answer_list = None
+                # metrics are accumulated per batch, predictions are not retained
+                metric_accumulator = FullSortMetricAccumulator([5, 10, 15, 20])
+                ann_index = self.build_ann_index() if self.args.ann_lists > 0 else None
                 for i, batch in rec_data_iter:
                     # 0. batch_data will be sent into the device(GPU or cpu)
                     batch = tuple(t.to(self.device) for t in batch)
                     user_ids, input_ids, target_pos, target_neg, answers = batch
-                    recommend_output = self.model.transformer_encoder(input_ids)
+                    with self.autocast():
+                        recommend_output = self.model.transformer_encoder(input_ids, last_position_only=True)
 
-                    recommend_output = recommend_output[:, -1, :]
+                    # rank with fp32 scores
+                    recommend_output = recommend_output[:, -1, :].float()
                     # recommendation results
 
-                    rating_pred = self.predict_full(recommend_output)
-
-                    rating_pred = rating_pred.cpu().data.numpy().copy()
-                    batch_user_index = user_ids.cpu().numpy()
-                    rating_pred[self.args.train_matrix[batch_user_index].toarray() > 0] = 0
-                    # reference: https://stackoverflow.com/a/23734295, https://stackoverflow.com/a/20104162
-                    # argpartition T: O(n)  argsort O(nlogn)
-                    ind = np.argpartition(rating_pred, -20)[:, -20:]
-                    arr_ind = rating_pred[np.arange(len(rating_pred))[:, None], ind]
-                    arr_ind_argsort = np.argsort(arr_ind)[np.arange(len(rating_pred)), ::-1]
-                    batch_pred_list = ind[np.arange(len(rating_pred))[:, None], arr_ind_argsort]
-
-                    if i == 0:
-                        pred_list = batch_pred_list
-                        answer_list = answers.cpu().data.numpy()
+                    # every path excludes the train items, the padding id 0 and the mask id
+                    if ann_index is not None:
+                        history = train_matrix_histories(self.args.train_matrix, user_ids, self.device)
+                        batch_pred_list = ann_index.search(recommend_output, 20, history)[0].cpu().numpy()
+                    elif self.args.eval_block_size > 0:
+                        # exact, without the dense [batch item_size] score matrix
+                        history = train_matrix_histories(self.args.train_matrix, user_ids, self.device,
+                                                         (0, self.args.item_size - 1))
+                        batch_pred_list = blocked_topk(recommend_output, self.model.item_embeddings.weight, 20,
+                                                       self.args.eval_block_size, history)[0].cpu().numpy()
                     else:
-                        pred_list = np.append(pred_list, batch_pred_list, axis=0)
-                        answer_list = np.append(answer_list, answers.cpu().data.numpy(), axis=0)
-                return self.get_full_sort_score(epoch, answer_list, pred_list)
+                        rating_pred = self.predict_full(recommend_output)
+                        batch_pred_list = self.full_sort_topk(rating_pred, user_ids, 20)
+                    metric_accumulator.update(answers.cpu().numpy(), batch_pred_list)
+                return self.get_full_sort_score(epoch, metric_accumulator.result())
 
             else:
+                metric_accumulator = SampleMetricAccumulator([1, 5, 10])
                 for i, batch in rec_data_iter:
                     # 0. batch_data will be sent into the device(GPU or cpu)
                     batch = tuple(t.to(self.device) for t in batch)
                     user_ids, input_ids, target_pos, target_neg, answers, sample_negs = batch
-                    recommend_output = self.model.finetune(input_ids)
+                    with self.autocast():
+                        recommend_output = self.model.transformer_encoder(input_ids, last_position_only=True)
                     test_neg_items = torch.cat((answers, sample_negs), -1)
-                    recommend_output = recommend_output[:, -1, :]
+                    recommend_output = recommend_output[:, -1, :].float()
 
                     test_logits = self.predict_sample(recommend_output, test_neg_items)
-                    test_logits = test_logits.cpu().detach().numpy().copy()
-                    if i == 0:
-                        pred_list = test_logits
-                    else:
-                        pred_list = np.append(pred_list, test_logits, axis=0)
+                    # rank of the answer (column 0): the number of negatives scored higher
+                    ranks = (test_logits[:, 1:] > test_logits[:, :1]).sum(-1)
+                    metric_accumulator.update(ranks.cpu().numpy())
 
-                return self.get_sample_scores(epoch, pred_list)
+                return self.get_sample_scores(epoch, metric_accumulator.result())
@@ -6,6 +6,9 @@ import random
 import os
 import json
 import pickle
+import time
+import traceback
+from contextlib import contextmanager, nullcontext
 from scipy.sparse import csr_matrix
 
 import torch
@@ -22,6 +25,85 @@ def set_seed(seed):
     # unless you tell it to be deterministic
     torch.backends.cudnn.deterministic = True
 
+def available_cores():
+    # cores this process may run on (taskset, cgroup cpusets), not every core of the host
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+def configure_cpu_threads(args):
+    """
+    split the cores between intra-op threads of the main process and DataLoader workers.
+    num_threads / num_interop_threads <= 0 means choose automatically; GPU runs keep
+    torch's intra-op default unless num_threads is given.
+    """
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+    elif not args.cuda_condition:
+        torch.set_num_threads(max(1, available_cores() - args.num_workers))
+    if args.num_interop_threads > 0:
+        try:
+            torch.set_num_interop_threads(args.num_interop_threads)
+        except RuntimeError:
+            # can only be set once, before any inter-op parallel work has started
+            print("num_interop_threads is already fixed, ignoring --num_interop_threads")
+    print(f"CPU threads: intra-op {torch.get_num_threads()}, inter-op {torch.get_num_interop_threads()}, "
+          f"dataloader workers {args.num_workers}")
+
+def dataloader_worker_init(worker_id):
+    # workers only run python-side augmentation, leave the cores to the main process
+    torch.set_num_threads(1)
+
+def _compiler_errors():
+    """
+    exceptions raised when torch.compile cannot trace or compile a function; anything else
+    (OOM, shape errors, bad inputs) is a real error of the eager code as well
+    """
+    import torch._dynamo.exc as dynamo_exc
+    errors = [dynamo_exc.BackendCompilerFailed, dynamo_exc.Unsupported]
+    try:
+        import torch._inductor.exc as inductor_exc
+        errors += [getattr(inductor_exc, name) for name in ('InductorError', 'LoweringException', 'CppCompileError')
+                   if hasattr(inductor_exc, name)]
+    except ImportError:
+        pass
+    return tuple(errors)
+
+def compile_with_fallback(fn, name, cache_dir=None):
+    """
+    torch.compile fn with static shapes, falling back to the eager fn if compilation fails.
+    only compiler errors of the forward call trigger the fallback, every other exception is
+    re-raised; a backward graph that fails to compile raises from backward().
+    compiled artifacts are cached in cache_dir and reused by later runs.
+    """
+    if not hasattr(torch, 'compile'):
+        print(f"torch.compile is not available, {name} runs eagerly")
+        return fn
+    if cache_dir:
+        check_path(cache_dir)
+        os.environ.setdefault('TORCHINDUCTOR_CACHE_DIR', os.path.abspath(cache_dir))
+    compiler_errors = _compiler_errors()
+    compiled = {'fn': torch.compile(fn, dynamic=False), 'first_call': True}
+
+    def run(*args, **kwargs):
+        if compiled['fn'] is fn:
+            return fn(*args, **kwargs)
+        start = time.perf_counter()
+        try:
+            output = compiled['fn'](*args, **kwargs)
+        except compiler_errors:
+            print(f"compiling {name} failed, falling back to eager mode:")
+            traceback.print_exc()
+            compiled['fn'] = fn
+        if compiled['fn'] is fn:
+            return fn(*args, **kwargs)
+        if compiled['first_call']:
+            # the first call traces and compiles: the one-off cost to weigh against the speedup
+            compiled['first_call'] = False
+            print(f"compiled {name} forward in {time.perf_counter() - start:.1f}s")
+        return output
+    return run
+
 def nCr(n,r):
     f = math.factorial
     return f(n) // f(r) // f(n-r)
@@ -89,6 +171,91 @@ class EarlyStopping:
         torch.save(model.state_dict(), self.checkpoint_path)
         self.score_min = score
 
+_NULL_PHASE = nullcontext()
+
+class PhaseTimer:
+    """
+    wall time of named phases, collected per training step and summarised (mean and
+    percentiles over the steps of an epoch). phases may nest: a phase's time excludes its
+    nested phases, so the phases of a step add up to the step. on cuda the device is
+    synchronized at phase boundaries. when disabled every call returns immediately.
+    """
+    def __init__(self, enabled=False, device=None):
+        self.enabled = enabled
+        self.synchronize = enabled and device is not None and torch.device(device).type == 'cuda'
+        self.steps = {}
+        self.num_steps = 0
+        self._step = {}
+        self._stack = []
+
+    def _now(self):
+        if self.synchronize:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def start(self, name):
+        if self.enabled:
+            self._stack.append([name, self._now(), 0.0])
+
+    def stop(self, name):
+        if not self.enabled:
+            return
+        started_name, start, nested = self._stack.pop()
+        assert started_name == name, f"phase '{name}' stopped while '{started_name}' is running"
+        elapsed = self._now() - start
+        self._step[name] = self._step.get(name, 0.0) + elapsed - nested
+        if self._stack:
+            self._stack[-1][2] += elapsed
+
+    def cancel(self, name):
+        """
+        drop a started phase without recording it
+        """
+        if self.enabled:
+            started_name = self._stack.pop()[0]
+            assert started_name == name, f"phase '{name}' cancelled while '{started_name}' is running"
+
+    def phase(self, name):
+        return self._phase(name) if self.enabled else _NULL_PHASE
+
+    @contextmanager
+    def _phase(self, name):
+        self.start(name)
+        try:
+            yield
+        finally:
+            self.stop(name)
+
+    def end_step(self):
+        if not self.enabled:
+            return
+        for name in set(self.steps) | set(self._step):
+            # a phase that did not run in a step counts as 0 for that step
+            self.steps.setdefault(name, [0.0] * self.num_steps).append(self._step.get(name, 0.0))
+        self.num_steps += 1
+        self._step = {}
+
+    def summary(self):
+        """
+        {phase: {mean_ms, p50_ms, p90_ms, p99_ms, share}} over the steps since the last reset
+        """
+        total = sum(sum(times) for times in self.steps.values()) or 1.0
+        summary = {}
+        for name, times in self.steps.items():
+            times_ms = np.array(times) * 1000.0
+            summary[name] = {'mean_ms': round(float(times_ms.mean()), 3),
+                             'p50_ms': round(float(np.percentile(times_ms, 50)), 3),
+                             'p90_ms': round(float(np.percentile(times_ms, 90)), 3),
+                             'p99_ms': round(float(np.percentile(times_ms, 99)), 3),
+                             'share': round(sum(times) / total, 4)}
+        return summary
+
+    def reset(self):
+        self.steps = {}
+        self.num_steps = 0
+        self._step = {}
+        self._stack = []
+
 def kmax_pooling(x, dim, k):
     index = x.topk(k, dim=dim)[1].sort(dim=dim)[0]
     return x.gather(dim, index).squeeze(dim)
@@ -192,6 +359,59 @@ def get_user_seqs_and_sample(data_file, sample_file):
 
     return user_seq, max_item, sample_seq
 
+def generate_sample_negatives(user_seq, item_size, num_negatives=99, seed=0):
+    """
+    [num_users num_negatives] items in 1..item_size-2 that are not in the user's sequence,
+    without repeats per user. candidates are drawn for all users at once and only the
+    conflicting entries are redrawn.
+    """
+    rng = np.random.default_rng(seed)
+    num_users = len(user_seq)
+    max_item = item_size - 2
+    seq_lengths = np.array([len(items) for items in user_seq])
+    history = np.unique(np.repeat(np.arange(num_users, dtype=np.int64), seq_lengths) * item_size +
+                        np.concatenate(user_seq).astype(np.int64))
+    if (max_item - np.bincount(history // item_size, minlength=num_users)).min() < num_negatives:
+        raise ValueError(f"some users have fewer than {num_negatives} unseen items to sample from")
+    user_keys = np.arange(num_users, dtype=np.int64)[:, None] * item_size
+    negatives = rng.integers(1, max_item + 1, size=(num_users, num_negatives))
+    conflict = np.ones_like(negatives, dtype=bool)
+    while conflict.any():
+        negatives[conflict] = rng.integers(1, max_item + 1, size=int(conflict.sum()))
+        conflict = np.isin(user_keys + negatives, history)
+        # repeated items within a user: keep the first occurrence
+        order = np.argsort(negatives, axis=1, kind='stable')
+        sorted_negatives = np.take_along_axis(negatives, order, axis=1)
+        repeated = np.zeros_like(conflict)
+        repeated[:, 1:] = sorted_negatives[:, 1:] == sorted_negatives[:, :-1]
+        np.put_along_axis(conflict, order, np.take_along_axis(conflict, order, axis=1) | repeated, axis=1)
+    return negatives.astype(np.int32)
+
+def load_sample_negatives(sample_file):
+    """
+    per-user negative samples: a memory-mapped .npy [num_users num_negatives] int32 array,
+    or the text format of get_user_seqs_and_sample (`user item item ...` per line)
+    """
+    if sample_file.endswith('.npy'):
+        return np.load(sample_file, mmap_mode='r')
+    sample_seq = []
+    for line in open(sample_file).readlines():
+        user, items = line.strip().split(' ', 1)
+        sample_seq.append([int(item) for item in items.split(' ')])
+    return np.array(sample_seq, dtype=np.int32)
+
+def get_sample_negatives(sample_file, user_seq, item_size, num_negatives=99, seed=0):
+    if not os.path.exists(sample_file):
+        if not sample_file.endswith('.npy'):
+            # np.save would write <sample_file>.npy and the text loader would then miss it
+            raise FileNotFoundError(f"{sample_file} not exist; negatives are only generated "
+                                    f"to a .npy file, pass a --sample_file ending in .npy")
+        print(f"{sample_file} not exist, generating {num_negatives} negatives per user...")
+        np.save(sample_file, generate_sample_negatives(user_seq, item_size, num_negatives, seed))
+    sample_negatives = load_sample_negatives(sample_file)
+    assert len(sample_negatives) == len(user_seq)
+    return sample_negatives
+
 def get_item2attribute_json(data_file):
     item2attribute = json.loads(open(data_file).readline())
     attribute_set = set()
@@ -200,17 +420,104 @@ def get_item2attribute_json(data_file):
     attribute_size = max(attribute_set) # 331
     return item2attribute, attribute_size
 
+def sequential_sum(values):
+    """
+    left-to-right float sum, bit-identical to accumulating in a python loop
+    (np.sum uses pairwise summation)
+    """
+    values = np.asarray(values, dtype=np.float64)
+    return float(np.cumsum(values)[-1]) if len(values) else 0.0
+
 def get_metric(pred_list, topk=10):
-    NDCG = 0.0
-    HIT = 0.0
-    MRR = 0.0
     # [batch] the answer's rank
-    for rank in pred_list:
-        MRR += 1.0 / (rank + 1.0)
-        if rank < topk:
-            NDCG += 1.0 / np.log2(rank + 2.0)
-            HIT += 1.0
-    return HIT /len(pred_list), NDCG /len(pred_list), MRR /len(pred_list)
+    accumulator = SampleMetricAccumulator([topk])
+    accumulator.update(pred_list)
+    metrics = accumulator.result()
+    return metrics[f'HIT@{topk}'], metrics[f'NDCG@{topk}'], metrics['MRR']
+
+class SampleMetricAccumulator:
+    """
+    streaming HIT@k, NDCG@k and MRR over the ranks of the answer among sampled candidates;
+    only running sums are kept, in the same order as get_metric's loop
+    """
+    def __init__(self, topk_list=(1, 5, 10)):
+        self.topk_list = topk_list
+        self.sums = {}
+        self.num_users = 0
+
+    def _add(self, name, values):
+        self.sums[name] = sequential_sum(np.concatenate([[self.sums.get(name, 0.0)], values]))
+
+    def update(self, ranks):
+        ranks = np.asarray(ranks, dtype=np.float64)
+        for k in self.topk_list:
+            in_topk = ranks < k
+            self._add(f'HIT@{k}', in_topk.astype(np.float64))
+            self._add(f'NDCG@{k}', 1.0 / np.log2(ranks[in_topk] + 2.0))
+        self._add('MRR', 1.0 / (ranks + 1.0))
+        self.num_users += len(ranks)
+
+    def result(self):
+        return {name: total / self.num_users for name, total in self.sums.items()}
+
+def full_sort_user_metrics(actual, predicted, topk_list):
+    """
+    per-user HIT (recall), NDCG and MRR at every cutoff from one [users topk] hit matrix.
+    actual: [users num_answers] answer ids, predicted: [users >= max(topk_list)] ranked item ids.
+    returns {metric@k: [users] values} and the mask of users counted by recall
+    (recall_at_k skips users without answers).
+    """
+    actual = np.asarray(actual).reshape(len(actual), -1)
+    predicted = np.asarray(predicted)[:, :max(topk_list)]
+    hits = (predicted[:, :, None] == actual[:, None, :]).any(-1)
+    cum_hits = np.cumsum(hits, axis=1)
+    # same discounts (and summation order) as ndcg_k
+    discounts = np.array([math.log(j + 2, 2) for j in range(predicted.shape[1])])
+    dcg = np.cumsum(hits / discounts, axis=1)
+    sorted_actual = np.sort(actual, axis=1)
+    num_unique = (np.diff(sorted_actual, axis=1) != 0).sum(1) + (actual.shape[1] > 0)
+    first_hit = np.where(hits.any(1), hits.argmax(1), predicted.shape[1])
+    has_answer = num_unique != 0
+    metrics = {}
+    for k in topk_list:
+        metrics[f'HIT@{k}'] = cum_hits[:, k - 1] / np.maximum(num_unique, 1).astype(np.float64)
+        metrics[f'NDCG@{k}'] = dcg[:, k - 1] / idcg_k(min(k, actual.shape[1]))
+        metrics[f'MRR@{k}'] = np.where(first_hit < k, 1.0 / (first_hit + 1.0), 0.0)
+    return metrics, has_answer
+
+class FullSortMetricAccumulator:
+    """
+    streaming HIT, NDCG and MRR for all cutoffs: each batch of [batch topk] predictions is
+    reduced to running sums and dropped, so evaluation memory stays O(batch).
+    the sums run left to right, so results equal recall_at_k / ndcg_k on the whole set.
+    """
+    def __init__(self, topk_list=(5, 10, 15, 20)):
+        self.topk_list = topk_list
+        self.sums = {}
+        self.num_users = 0
+        self.num_answered_users = 0
+
+    def update(self, actual, predicted):
+        metrics, has_answer = full_sort_user_metrics(actual, predicted, self.topk_list)
+        for name, values in metrics.items():
+            if name.startswith('HIT'):
+                values = values[has_answer]
+            self.sums[name] = sequential_sum(np.concatenate([[self.sums.get(name, 0.0)], values]))
+        self.num_users += len(has_answer)
+        self.num_answered_users += int(has_answer.sum())
+
+    def result(self):
+        return {name: total / (self.num_answered_users if name.startswith('HIT') else float(self.num_users))
+                for name, total in self.sums.items()}
+
+def get_full_sort_metrics(actual, predicted, topk_list=(5, 10, 15, 20)):
+    """
+    HIT, NDCG and MRR for all cutoffs in one pass; HIT@k and NDCG@k equal
+    recall_at_k and ndcg_k exactly
+    """
+    accumulator = FullSortMetricAccumulator(topk_list)
+    accumulator.update(actual, predicted)
+    return accumulator.result()
 
 def precision_at_k_per_sample(actual, predicted, topk):
     num_hits = 0